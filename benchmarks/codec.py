@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Compares the compiled struct codec against the bitstruct path for building and
+parsing packets.
+"""
+import timeit
+
+import lifx.protocol
+from lifx.protocol import pack_section, unpack_section, section_size
+
+ROUNDS = 2000
+
+# A LIGHT_STATE reply, the packet we see most often when polling
+STATE_ARGS = (21845, 65535, 65535, 3500, 0, 65535, bytearray('Kitchen'.ljust(32, '\x00')), 0)
+STATE_KWARGS = {
+    'source': 45,
+    'target': 4930653221840,
+    'ack_required': False,
+    'res_required': False,
+    'sequence': 97,
+    'pkt_type': lifx.protocol.TYPE_LIGHT_STATE,
+}
+
+def bitstruct_make_packet(*args, **kwargs):
+    """The make_packet implementation from before the codec"""
+    pkt_type = kwargs['pkt_type']
+    target = kwargs['target']
+    packet_size = ( section_size(lifx.protocol.frame_header)
+           + section_size(lifx.protocol.frame_address)
+           + section_size(lifx.protocol.protocol_header)
+           + section_size(lifx.protocol.messages[pkt_type]) ) / 8
+
+    return (pack_section(lifx.protocol.frame_header, packet_size, 0, 1 if target is None else 0, 1, 1024, kwargs['source'])
+          + pack_section(lifx.protocol.frame_address, target or 0, 0, 0, int(kwargs['ack_required']), int(kwargs['res_required']), kwargs['sequence'])
+          + pack_section(lifx.protocol.protocol_header, 0, pkt_type, 0)
+          + pack_section(lifx.protocol.messages[pkt_type], *args))
+
+def bitstruct_parse_packet(data):
+    """The parse_packet implementation from before the codec"""
+    sections = (lifx.protocol.frame_header, lifx.protocol.frame_address, lifx.protocol.protocol_header)
+    offset = 0
+    parsed = []
+    for section in sections:
+        size = section_size(section) / 8
+        parsed.append(unpack_section(section, data[offset:offset + size]))
+        offset += size
+
+    payload = lifx.protocol.messages[parsed[2].pkt_type]
+    parsed.append(unpack_section(payload, data[offset:offset + section_size(payload) / 8]))
+    return lifx.protocol.lifx_packet(*parsed)
+
+def rate(func):
+    seconds = min(timeit.repeat(func, number=ROUNDS, repeat=3))
+    return ROUNDS / seconds
+
+def compare(name, old, new):
+    old_rate = rate(old)
+    new_rate = rate(new)
+    print '%-12s bitstruct: %10.0f pkt/s   codec: %10.0f pkt/s   speedup: %5.1fx' % (name, old_rate, new_rate, new_rate / old_rate)
+
+if __name__ == '__main__':
+    packet = lifx.protocol.make_packet(*STATE_ARGS, **STATE_KWARGS)
+    data = str(packet)
+
+    # Make sure we are comparing like with like
+    assert bitstruct_make_packet(*STATE_ARGS, **STATE_KWARGS) == packet
+    assert bitstruct_parse_packet(data) == lifx.protocol.parse_packet(data)
+
+    compare('make_packet', lambda: bitstruct_make_packet(*STATE_ARGS, **STATE_KWARGS), lambda: lifx.protocol.make_packet(*STATE_ARGS, **STATE_KWARGS))
+    compare('parse_packet', lambda: bitstruct_parse_packet(data), lambda: lifx.protocol.parse_packet(data))
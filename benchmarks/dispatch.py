@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Measures how long the transport takes to dispatch a packet as the number of
+registered devices grows. With the indexed dispatch table the cost should be
+flat.
+"""
+import timeit
+
+import lifx.protocol
+from lifx.network import NetworkTransport
+
+ROUNDS = 20000
+ADDRESS = ('192.168.0.10', 56700)
+PKT_TYPES = (lifx.protocol.TYPE_ACKNOWLEDGEMENT, lifx.protocol.TYPE_ECHORESPONSE) + lifx.protocol.CLASS_TYPE_STATE
+
+def handler(host, port, packet):
+    packet.frame_address.sequence
+
+def dispatch_rate(devices):
+    transport = NetworkTransport(address='127.0.0.1')
+    transport.register_source(45)
+    for device_id in range(1, devices + 1):
+        transport.register_packet_handler(handler, PKT_TYPES, device_id)
+
+    data = str(lifx.protocol.make_packet(
+            0,
+            source=45,
+            target=devices,
+            ack_required=False,
+            res_required=False,
+            sequence=1,
+            pkt_type=lifx.protocol.TYPE_STATEPOWER,
+    ))
+
+    seconds = min(timeit.repeat(lambda: transport._handle_packet(ADDRESS, data), number=ROUNDS, repeat=3))
+    return ROUNDS / seconds
+
+if __name__ == '__main__':
+    for devices in (1, 10, 100, 400, 1000):
+        print '%5d devices: %10.0f pkt/s' % (devices, dispatch_rate(devices))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Measures the time from a packet arriving on the socket to its handler
+finishing, with handlers on the listener thread and on dispatch workers. A
+slow handler for one device shows how the workers keep other devices moving.
+"""
+import socket
+import time
+
+import lifx.protocol
+from lifx.network import NetworkTransport
+
+PACKETS = 2000
+DEVICES = 8
+SLOW_DEVICE = 1
+SLOW_HANDLER_TIME = 0.001
+
+def make_packet(target, level):
+    return str(lifx.protocol.make_packet(
+            level,
+            source=45,
+            target=target,
+            ack_required=False,
+            res_required=False,
+            sequence=level % 256,
+            pkt_type=lifx.protocol.TYPE_STATEPOWER,
+    ))
+
+def handler(host, port, packet):
+    if packet.frame_address.target == SLOW_DEVICE:
+        time.sleep(SLOW_HANDLER_TIME)
+    packet.payload.level
+
+def measure(workers):
+    transport = NetworkTransport(address='127.0.0.1', rcvbuf=4 * 1024 * 1024, workers=workers)
+    transport.register_packet_handler(handler, (lifx.protocol.TYPE_STATEPOWER,))
+
+    packets = [make_packet(1 + i % DEVICES, i % 65536) for i in range(PACKETS)]
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    destination = transport._socket.getsockname()
+    for packet in packets:
+        sender.sendto(packet, destination)
+        time.sleep(0.0001)
+
+    deadline = time.time() + 30
+    while transport.dispatch_stats.dispatched_packets + transport.dispatch_stats.dropped_packets < PACKETS and time.time() < deadline:
+        time.sleep(0.01)
+
+    return transport.dispatch_stats, transport.stats
+
+if __name__ == '__main__':
+    for workers in (0, 4):
+        dispatch, listener = measure(workers)
+        print '%d workers: mean %6.2f ms, max %7.2f ms, dispatched %d, queue drops %d, kernel drops %s' % (
+                workers,
+                dispatch.mean_latency * 1000,
+                dispatch.max_latency * 1000,
+                dispatch.dispatched_packets,
+                dispatch.dropped_packets,
+                listener.kernel_drops,
+        )
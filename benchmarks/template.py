@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Compares building packets section by section against patching a cached
+packet template, both into a new buffer and into a reused one.
+"""
+import timeit
+
+import lifx.protocol
+from lifx.protocol import frame_header, frame_address, protocol_header, messages
+
+ROUNDS = 20000
+
+COLOR_ARGS = (0, 21845, 65535, 65535, 3500, 200)
+COLOR_KWARGS = {
+    'source': 45,
+    'target': 4930653221840,
+    'ack_required': True,
+    'res_required': False,
+    'sequence': 97,
+    'pkt_type': lifx.protocol.TYPE_LIGHT_SETCOLOR,
+}
+
+def section_make_packet(*args, **kwargs):
+    """The make_packet implementation from before templates, packing every section"""
+    pkt_type = kwargs['pkt_type']
+    target = kwargs['target']
+    payload_codec = messages[pkt_type]['codec']
+    size = lifx.protocol.HEADER_SIZE + payload_codec.size
+
+    packet = bytearray(size)
+    frame_header['codec'].pack_into(packet, 0, size, 0, 1 if target is None else 0, 1, 1024, kwargs['source'])
+    frame_address['codec'].pack_into(packet, lifx.protocol.FRAME_ADDRESS_OFFSET, target or 0, 0, 0, int(kwargs['ack_required']), int(kwargs['res_required']), kwargs['sequence'])
+    protocol_header['codec'].pack_into(packet, lifx.protocol.PROTOCOL_HEADER_OFFSET, 0, pkt_type, 0)
+    payload_codec.pack_into(packet, lifx.protocol.HEADER_SIZE, *args)
+    return packet
+
+def template_pack_into(buf, *args, **kwargs):
+    """What NetworkTransport.send_packet does with its reusable buffer"""
+    template = lifx.protocol.packet_template(
+            kwargs['source'],
+            kwargs['pkt_type'],
+            kwargs['ack_required'],
+            kwargs['res_required'],
+            kwargs['target'] is None,
+    )
+    return template.pack_into(buf, kwargs['target'], kwargs['sequence'], *args)
+
+def rate(func):
+    seconds = min(timeit.repeat(func, number=ROUNDS, repeat=3))
+    return ROUNDS / seconds
+
+if __name__ == '__main__':
+    buf = bytearray(1500)
+
+    # Make sure we are comparing like with like
+    packet = section_make_packet(*COLOR_ARGS, **COLOR_KWARGS)
+    assert lifx.protocol.make_packet(*COLOR_ARGS, **COLOR_KWARGS) == packet
+    assert buf[:template_pack_into(buf, *COLOR_ARGS, **COLOR_KWARGS)] == packet
+
+    baseline = rate(lambda: section_make_packet(*COLOR_ARGS, **COLOR_KWARGS))
+    print '%-24s %10.0f pkt/s' % ('per section', baseline)
+
+    for name, func in [
+            ('make_packet (template)', lambda: lifx.protocol.make_packet(*COLOR_ARGS, **COLOR_KWARGS)),
+            ('pack_into reused buffer', lambda: template_pack_into(buf, *COLOR_ARGS, **COLOR_KWARGS)),
+    ]:
+        result = rate(func)
+        print '%-24s %10.0f pkt/s   speedup: %4.1fx' % (name, result, result / baseline)
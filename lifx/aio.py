@@ -0,0 +1,407 @@
+"""
+Asynchronous versions of the transport, client and device, built on an
+asyncio event loop instead of threads. Every request is a coroutine, so one
+event loop can have thousands of requests outstanding at once.
+
+On Python 2 this needs trollius, install it with the 'asyncio' extra::
+
+    pip install lifx-sdk[asyncio]
+
+Coroutines use the trollius style::
+
+    client = yield From(AsyncClient.create())
+    devices = yield From(client.discover())
+    colors = yield From(asyncio.gather(*[d.color() for d in devices]))
+"""
+import random
+import socket
+from datetime import datetime
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    raise ImportError('lifx.aio needs trollius, install lifx-sdk[asyncio]')
+
+import color
+import network
+import protocol
+from device import DeviceEvictedError, DeviceTimeoutError, DEFAULT_DURATION, DEFAULT_TIMEOUT, DEFAULT_RETRANSMITS
+from request import SEQUENCE_SPACE
+
+DEFAULT_DISCOVERY_TIME = 1.0
+
+class AsyncNetworkTransport(network.PacketDispatcher, asyncio.DatagramProtocol):
+    """
+    The asynchronous network transport. Packets are received by the event
+    loop and routed to handlers the same way as :class:`lifx.network.NetworkTransport`.
+    """
+    def __init__(self, broadcast='255.255.255.255'):
+        network.PacketDispatcher.__init__(self)
+
+        self._broadcast = broadcast
+        self._transport = None
+
+    @classmethod
+    @asyncio.coroutine
+    def create(cls, address='0.0.0.0', broadcast='255.255.255.255', loop=None):
+        """
+        Opens a socket on the event loop.
+
+        :param address: The address to receive packets on.
+        :param broadcast: The address to broadcast discovery packets to.
+        :param loop: The event loop to use, defaults to the current one.
+        :returns: AsyncNetworkTransport -- The connected transport
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        transport, protocol_ = yield From(loop.create_datagram_endpoint(
+                lambda: cls(broadcast),
+                local_addr=(address, 0),
+        ))
+        raise Return(protocol_)
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+        sock = transport.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def datagram_received(self, data, addr):
+        header, matched = self._match(data)
+        if not matched:
+            return
+
+        packet = protocol.PacketView(data)
+        host, port = addr
+        for handler_id, handler in matched:
+            handler(host, port, packet)
+
+    def send_packet(self, *args, **kwargs):
+        target = kwargs['target']
+
+        template = protocol.packet_template(
+                kwargs['source'],
+                kwargs['pkt_type'],
+                kwargs['ack_required'],
+                kwargs['res_required'],
+                target is None,
+        )
+
+        # The event loop may hold on to the packet, so it can't share a buffer
+        packet = template.build(0 if target is None else target, kwargs['sequence'], *args)
+        self._transport.sendto(packet, (kwargs['address'], kwargs['port']))
+
+    def send_discovery(self, source, sequence):
+        self._transport.sendto(protocol.discovery_packet(source, sequence), (self._broadcast, network.DEFAULT_LIFX_PORT))
+
+    def close(self):
+        self._transport.close()
+
+class AsyncClient(object):
+    """
+    Discovers lights and matches replies to the coroutines waiting for them.
+    Use :meth:`create` to make one.
+    """
+    def __init__(self, transport, loop=None):
+        self._transport = transport
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+
+        # Generate Random Client ID
+        self._source = random.randrange(1, pow(2, 32) - 1)
+
+        # Sequence numbers are counted per device
+        self._sequences = {}
+
+        # Futures waiting for replies, keyed on (target, sequence)
+        self._pending = {}
+
+        # Storage for devices
+        self._devices = {}
+
+        # Only accept replies to our own packets
+        self._transport.register_source(self._source)
+
+        # Install our handlers
+        self._transport.register_packet_handler(self._servicepacket, (protocol.TYPE_STATESERVICE,))
+        pkt_types = (protocol.TYPE_ACKNOWLEDGEMENT, protocol.TYPE_ECHORESPONSE) + protocol.CLASS_TYPE_STATE
+        self._transport.register_packet_handler(self._responsepacket, pkt_types)
+
+    @classmethod
+    @asyncio.coroutine
+    def create(cls, broadcast='255.255.255.255', address='0.0.0.0', loop=None):
+        """
+        Makes a client with its own transport.
+
+        :param broadcast: The address to broadcast to when discovering devices.
+        :param address: The address to receive packet on.
+        :param loop: The event loop to use, defaults to the current one.
+        :returns: AsyncClient -- The new client
+        """
+        transport = yield From(AsyncNetworkTransport.create(address, broadcast, loop))
+        raise Return(cls(transport, loop))
+
+    def __repr__(self):
+        return '<AsyncClient %s>' % repr(self.devices)
+
+    def _next_sequence(self, target):
+        """
+        Picks the next sequence number for a target that no waiting request
+        is using.
+        """
+        start = self._sequences.get(target, 0)
+        for offset in range(0, SEQUENCE_SPACE):
+            sequence = (start + offset) % SEQUENCE_SPACE
+            if (target, sequence) not in self._pending:
+                self._sequences[target] = (sequence + 1) % SEQUENCE_SPACE
+                return sequence
+
+        # Every sequence is in use, so the request that has had its sequence longest loses out
+        future, pkt_types = self._pending.pop((target, start))
+        if not future.done():
+            future.set_exception(DeviceEvictedError(self._devices[target]))
+        self._sequences[target] = (start + 1) % SEQUENCE_SPACE
+        return start
+
+    def _servicepacket(self, host, port, packet):
+        service = packet.payload.service
+        port = packet.payload.port
+        deviceid = packet.frame_address.target
+
+        if deviceid not in self._devices and service == protocol.SERVICE_UDP:
+            self._devices[deviceid] = AsyncDevice(deviceid, host, port, self)
+
+    def _responsepacket(self, host, port, packet):
+        device = self._devices.get(packet.frame_address.target)
+        if device is not None:
+            device._seen()
+
+        key = (packet.frame_address.target, packet.frame_address.sequence)
+        waiting = self._pending.get(key)
+        if waiting is None:
+            return
+
+        future, pkt_types = waiting
+        if packet.protocol_header.pkt_type in pkt_types and not future.done():
+            future.set_result(packet.materialize())
+
+    @asyncio.coroutine
+    def request(self, device, pkt_type, *args, **kwargs):
+        """
+        Sends a packet to a device and waits for the reply, retransmitting
+        if none comes back.
+
+        :param device: The device to send to.
+        :param pkt_type: The type of packet to send.
+        :param \*args: The payload of the packet.
+        :param ack_required: Wait for an acknowledgement, defaults to False.
+        :param res_required: Wait for a response, defaults to True.
+        :param timeout: The number of seconds to wait for a reply in total.
+        :returns: The payload of the response, True for an acknowledgement or None if no reply was wanted.
+        """
+        ack_required = kwargs.get('ack_required', False)
+        res_required = kwargs.get('res_required', True)
+        timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
+        sub_timeout = timeout / DEFAULT_RETRANSMITS
+
+        sequence = self._next_sequence(device.id)
+        key = (device.id, sequence)
+        future = asyncio.Future(loop=self._loop)
+        self._pending[key] = (future, protocol.response_types(pkt_type, ack_required, res_required))
+
+        try:
+            for i in range(0, DEFAULT_RETRANSMITS):
+                if i != 0:
+                    device._dropped_packets += 1
+
+                device._sent_packets += 1
+                self._transport.send_packet(
+                        *args,
+                        source=self._source,
+                        target=device.id,
+                        ack_required=ack_required,
+                        res_required=res_required,
+                        sequence=sequence,
+                        pkt_type=pkt_type,
+                        address=device.host,
+                        port=device.port
+                )
+
+                # If we don't care about a response, don't wait at all
+                if not (ack_required or res_required):
+                    raise Return(None)
+
+                try:
+                    packet = yield From(asyncio.wait_for(asyncio.shield(future, loop=self._loop), sub_timeout, loop=self._loop))
+                except asyncio.TimeoutError:
+                    continue
+
+                if res_required:
+                    raise Return(packet.payload)
+                else:
+                    raise Return(True)
+        finally:
+            # The sequence may have been given to a newer request already
+            waiting = self._pending.get(key)
+            if waiting is not None and waiting[0] is future:
+                del self._pending[key]
+
+        raise DeviceTimeoutError(device, timeout, DEFAULT_RETRANSMITS)
+
+    @asyncio.coroutine
+    def discover(self, timeout=DEFAULT_DISCOVERY_TIME):
+        """
+        Broadcast a discovery packet and collect replies.
+
+        :param timeout: The number of seconds to wait for replies.
+        :returns: list -- Every device known to the client
+        """
+        self._transport.send_discovery(self._source, self._next_sequence(None))
+        yield From(asyncio.sleep(timeout, loop=self._loop))
+        raise Return(self.devices)
+
+    def by_id(self, id):
+        """
+        Return the device with the id specified.
+
+        :param id: The device id
+        :returns: AsyncDevice -- The device with the matching id.
+        """
+        return self._devices[id]
+
+    def close(self):
+        self._transport.close()
+
+    @property
+    def devices(self):
+        return sorted(self._devices.values(), key=lambda k:k.id)
+
+class AsyncDevice(object):
+    """
+    A device whose network operations are coroutines. These are made by the
+    :class:`AsyncClient` during discovery.
+    """
+    def __init__(self, device_id, host, port, client):
+        self._device_id = device_id
+        self._host = host
+        self._port = port
+        self._client = client
+
+        # Last seen time
+        self._lastseen = datetime.now()
+
+        # Stats tracking
+        self._dropped_packets = 0
+        self._sent_packets = 0
+
+    def __repr__(self):
+        return u'<AsyncDevice MAC:%s>' % protocol.mac_string(self._device_id)
+
+    def _seen(self):
+        self._lastseen = datetime.now()
+
+    @property
+    def id(self):
+        """
+        The device id. Read Only.
+        """
+        return self._device_id
+
+    @property
+    def host(self):
+        """
+        The ip address of the device. Read Only.
+        """
+        return self._host
+
+    @property
+    def port(self):
+        """
+        The port of the UDP service. Read Only.
+        """
+        return self._port
+
+    @property
+    def seen_ago(self):
+        """
+        The time in seconds since we last saw a packet from the device. Read Only.
+        """
+        return datetime.now() - self._lastseen
+
+    @asyncio.coroutine
+    def label(self):
+        """
+        Get the label for the device.
+        """
+        response = yield From(self._client.request(self, protocol.TYPE_GETLABEL))
+        raise Return(protocol.bytes_to_label(response.label))
+
+    @asyncio.coroutine
+    def set_label(self, label):
+        """
+        Change the label on the device.
+
+        :param label: The new label
+        """
+        newlabel = bytearray(label.encode('utf-8')[0:protocol.LABEL_MAXLEN])
+        result = yield From(self._client.request(self, protocol.TYPE_SETLABEL, newlabel, ack_required=True, res_required=False))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def power(self):
+        """
+        Get the power state of the device, True if it is on.
+        """
+        response = yield From(self._client.request(self, protocol.TYPE_GETPOWER))
+        raise Return(response.level > 0)
+
+    @asyncio.coroutine
+    def fade_power(self, power, duration=DEFAULT_DURATION):
+        """
+        Transition to another power state slowly.
+
+        :param power: The new power state
+        :param duration: The number of milliseconds to perform the transition over.
+        """
+        msgpower = protocol.UINT16_MAX if power else 0
+        result = yield From(self._client.request(
+                self,
+                protocol.TYPE_LIGHT_SETPOWER,
+                msgpower,
+                duration,
+                ack_required=True,
+                res_required=False,
+        ))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def color(self):
+        """
+        Get the color the device is currently set to.
+        """
+        response = yield From(self._client.request(self, protocol.TYPE_LIGHT_GET))
+        raise Return(color.color_from_message(response))
+
+    @asyncio.coroutine
+    def fade_color(self, newcolor, duration=DEFAULT_DURATION):
+        """
+        Transition the light to a new color.
+
+        :param newcolor: The HSBK tuple of the new color to transition to
+        :param duration: The number of milliseconds to perform the transition over.
+        """
+        colormsg = color.message_from_color(newcolor)
+        result = yield From(self._client.request(
+                self,
+                protocol.TYPE_LIGHT_SETCOLOR,
+                0,
+                colormsg.hue,
+                colormsg.saturation,
+                colormsg.brightness,
+                colormsg.kelvin,
+                duration,
+                ack_required=True,
+                res_required=False,
+        ))
+        raise Return(result)
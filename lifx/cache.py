@@ -0,0 +1,113 @@
+"""
+The last known state of a device, as reported in the State packets it sends.
+"""
+from collections import namedtuple
+import threading
+import time
+
+DEFAULT_TTL = 1.0
+
+# Values for max_age, any cached value at all, or always ask the device
+CACHED = float('inf')
+FRESH = 0
+
+CacheEntry = namedtuple('CacheEntry', ['value', 'updated_at', 'age', 'stale'])
+
+class StateCache(object):
+    """
+    Stores values with the time they were reported, so reads can choose how
+    old a value they will accept.
+    """
+    def __init__(self, ttl=DEFAULT_TTL):
+        """
+        :param ttl: The number of seconds a value is used for by default.
+        """
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+        # key -> (value, updated_at)
+        self._values = {}
+
+    @property
+    def ttl(self):
+        """
+        The number of seconds a value is used for by default.
+        """
+        return self._ttl
+
+    def update(self, key, value, updated_at=None):
+        """
+        Store a value reported by the device.
+
+        :param key: The name of the value.
+        :param value: The value.
+        :param updated_at: When the value was reported, defaults to now.
+        """
+        if updated_at is None:
+            updated_at = time.time()
+
+        with self._lock:
+            self._values[key] = (value, updated_at)
+
+    def invalidate(self, key):
+        """
+        Forget a value, for when the device has been told to change it.
+
+        :param key: The name of the value.
+        """
+        with self._lock:
+            self._values.pop(key, None)
+
+    def lookup(self, key, max_age=None):
+        """
+        Get a value if one was reported recently enough.
+
+        :param key: The name of the value.
+        :param max_age: The oldest value in seconds to accept, None for the ttl, CACHED for any age or FRESH for none.
+        :returns: CacheEntry -- The value with its age, or None
+        """
+        if max_age is None:
+            max_age = self._ttl
+
+        entry = self.entry(key)
+        if entry is None or entry.age > max_age or max_age == FRESH:
+            return None
+        return entry
+
+    def entry(self, key):
+        """
+        Get a value however old it is.
+
+        :param key: The name of the value.
+        :returns: CacheEntry -- The value with its age, or None
+        """
+        with self._lock:
+            stored = self._values.get(key)
+
+        if stored is None:
+            return None
+
+        value, updated_at = stored
+        age = max(time.time() - updated_at, 0)
+        return CacheEntry(
+                value=value,
+                updated_at=updated_at,
+                age=age,
+                stale=age > self._ttl,
+        )
+
+    def entries(self):
+        """
+        Get every value however old they are.
+
+        :returns: dict -- CacheEntry values keyed by name
+        """
+        with self._lock:
+            keys = self._values.keys()
+
+        entries = {}
+        for key in keys:
+            entry = self.entry(key)
+            if entry is not None:
+                entries[key] = entry
+        return entries
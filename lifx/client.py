@@ -1,16 +1,36 @@
+from collections import namedtuple, OrderedDict
+import Queue
 import random
 import threading
+import time
 from datetime import datetime, timedelta
 from pkg_resources import iter_entry_points
+import concurrent.futures
 
+from color import message_from_color
+import cache
 import network
 import protocol
 import device
+import request
 import util
 import group
 
 MISSED_POLLS = 3
 
+# The most a poll is delayed at random, as a fraction of its interval
+POLL_JITTER = 0.1
+
+# How broadcast_set checks the change reached each device
+CONFIRM_NONE = None
+CONFIRM_ACK = 'ack'
+CONFIRM_STATE = 'state'
+
+# How long to listen for replies to a broadcast before asking by unicast
+BROADCAST_WAIT = 0.5
+
+QueryResult = namedtuple('QueryResult', ['device', 'payload', 'error'])
+
 # Get all the mixins for the device class from the plugins available
 ENTRYPOINT = 'lifx.device.mixin'
 devicebases = [entrypoint.load() for entrypoint in iter_entry_points(ENTRYPOINT)]
@@ -19,7 +39,9 @@ Device = type('Device', tuple(devicebases), {})
 del devicebases
 
 class Client(object):
-    def __init__(self, broadcast='255.255.255.255', address='0.0.0.0', discoverpoll=60, devicepoll=5):
+    def __init__(self, broadcast='255.255.255.255', address='0.0.0.0', discoverpoll=60, devicepoll=5, rcvbuf=None,
+            workers=0, overflow=network.OVERFLOW_DROP_OLDEST, cache_ttl=cache.DEFAULT_TTL,
+            send_rate=device.DEFAULT_SEND_RATE, send_burst=device.DEFAULT_SEND_BURST):
         """
         The Client object is responsible for discovering lights and managing
         incoming and outgoing packets. This is the class most people will use to
@@ -29,62 +51,110 @@ class Client(object):
         :param address: The address to receive packet on.
         :param discoverpoll: The time in second between attempts to discover new bulbs.
         :param devicepoll: The time is seconds between polls to check if devices still respond.
+        :param rcvbuf: The size in bytes of the socket receive buffer, raise this if replies get dropped during discovery.
+        :param workers: The number of threads running packet handlers, use this if slow mixins hold up packet reception.
+        :param overflow: What to do when packets arrive faster than the workers handle them, drop the oldest or block.
+        :param cache_ttl: The number of seconds device state is reused for before asking the device again.
+        :param send_rate: The most packets a second sent to each device, None for no limit.
+        :param send_burst: The number of packets that can be sent to a device at once before the rate applies.
         """
 
         # Get Transport
-        self._transport = network.NetworkTransport(address=address, broadcast=broadcast)
+        self._transport = network.NetworkTransport(
+                address=address,
+                broadcast=broadcast,
+                rcvbuf=rcvbuf,
+                workers=workers,
+                overflow=overflow,
+        )
 
         # Arguments
         self._discoverpolltime = discoverpoll
         self._devicepolltime = devicepoll
 
+        # Group labels are refreshed with the membership each discovery
+        self._label_ttl = discoverpoll * MISSED_POLLS
+        self._cache_ttl = cache_ttl
+        self._send_rate = send_rate
+        self._send_burst = send_burst
+
         # Generate Random Client ID
         self._source = random.randrange(1, pow(2, 32) - 1)
 
-        # Start packet sequence at zero
-        self._sequence = 0
+        # Broadcast queries get their own, so their replies can never be
+        # taken for the reply to a request with the same sequence
+        self._broadcast_source = self._source
+        while self._broadcast_source == self._source:
+            self._broadcast_source = random.randrange(1, pow(2, 32) - 1)
+
+        # Sequence numbers per device, and the requests waiting on replies
+        self._pending = request.PendingTable()
+
+        # One thread runs the polls and resends every request that hasn't been answered
+        self._scheduler = util.Scheduler()
+        self._scheduler.start()
+        self._window = request.CongestionWindow()
+        self._retransmitter = request.Retransmitter(self._pending, self._scheduler, self._window)
 
         # Storage for devices
         self._devices = {}
         self._groups = {}
         self._locations = {}
 
+        # Which group and location each device is in
+        self._group_index = group.MembershipIndex()
+        self._location_index = group.MembershipIndex()
+
+        # Which devices have each label and power state, these can change
+        # without us hearing so are only trusted as long as the cache
+        self._label_index = group.MembershipIndex(cache_ttl)
+        self._power_index = group.MembershipIndex(cache_ttl)
+        self._state_indexes = {
+                device.STATE_LABEL: self._label_index,
+                device.STATE_POWER: self._power_index,
+        }
+
+        # Only accept replies to our own packets
+        self._transport.register_source(self._source)
+        self._transport.register_source(self._broadcast_source)
+
         # Install our service packet handler
-        pktfilter = lambda p:p.protocol_header.pkt_type == protocol.TYPE_STATESERVICE
-        self._transport.register_packet_handler(self._servicepacket, pktfilter)
+        self._transport.register_packet_handler(self._servicepacket, (protocol.TYPE_STATESERVICE,))
 
         # Install the group packet handler
-        pktfilter = lambda p:p.protocol_header.pkt_type == protocol.TYPE_STATEGROUP
-        self._transport.register_packet_handler(self._grouppacket, pktfilter)
+        self._transport.register_packet_handler(self._grouppacket, (protocol.TYPE_STATEGROUP,))
 
         # Install the location packet handler
-        pktfilter = lambda p:p.protocol_header.pkt_type == protocol.TYPE_STATELOCATION
-        self._transport.register_packet_handler(self._locationpacket, pktfilter)
+        self._transport.register_packet_handler(self._locationpacket, (protocol.TYPE_STATELOCATION,))
 
         # Send initial discovery packet
         self.discover()
 
-        # Start polling threads
-        self._discoverpoll = util.RepeatTimer(discoverpoll, self.discover)
-        self._discoverpoll.daemon = True
-        self._discoverpoll.start()
-        self._devicepoll = util.RepeatTimer(devicepoll, self.poll_devices)
-        self._devicepoll.daemon = True
-        self._devicepoll.start()
+        # Start polling, and keep the group and location indexes current
+        self._discoverpoll = self._scheduler.call_every(discoverpoll, self.discover,
+                jitter=discoverpoll * POLL_JITTER)
+        self._devicepoll = self._scheduler.call_every(devicepoll, self.poll_devices,
+                jitter=devicepoll * POLL_JITTER)
+        self._membershippoll = self._scheduler.call_every(discoverpoll, self.refresh_membership,
+                jitter=discoverpoll * POLL_JITTER)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Stop polling and resending, waiting for any that is running to finish,
+        then shut down the transport.
+        """
         self._discoverpoll.cancel()
         self._devicepoll.cancel()
+        self._membershippoll.cancel()
+        self._scheduler.stop()
+        self._transport.close()
 
     def __repr__(self):
         return '<Client %s>' % repr(self.get_devices())
 
-    @property
-    def _seq(self):
-        seq = self._sequence
-        self._sequence = (self._sequence + 1) % pow(2, 8)
-        return seq
-
     def _servicepacket(self, host, port, packet):
         service = packet.payload.service
         port = packet.payload.port
@@ -92,52 +162,81 @@ class Client(object):
 
         if deviceid not in self._devices and service == protocol.SERVICE_UDP:
             # Create a new Device
-            new_device = Device(deviceid, host, self)
+            new_device = Device(deviceid, host, self, self._cache_ttl, self._send_rate, self._send_burst)
 
             # Send its own packets to it
-            pktfilter = lambda p:(
-                    p.frame_address.target == deviceid
-                    and (
-                        p.protocol_header.pkt_type == protocol.TYPE_ACKNOWLEDGEMENT
-                        or p.protocol_header.pkt_type == protocol.TYPE_ECHORESPONSE
-                        or p.protocol_header.pkt_type in protocol.CLASS_TYPE_STATE
-                    ))
-            self._transport.register_packet_handler(new_device._packethandler, pktfilter)
+            pkt_types = (protocol.TYPE_ACKNOWLEDGEMENT, protocol.TYPE_ECHORESPONSE) + protocol.CLASS_TYPE_STATE
+            self._transport.register_packet_handler(new_device._packethandler, pkt_types, deviceid)
 
             # Send the service packet directly to the device
             new_device._packethandler(host, port, packet)
 
+            # Nothing is indexed for it until it tells us
+            for index in (self._group_index, self._location_index) + tuple(self._state_indexes.values()):
+                index.expect(deviceid)
+
             # Store it
             self._devices[deviceid] = new_device
 
     def _grouppacket(self, host, port, packet):
+        self._update_group(packet.frame_address.target, packet.payload)
+
+    def _update_group(self, device_id, payload):
         # Gather Data
-        group_id = packet.payload.group
+        group_id = payload.group
         group_id_tuple = tuple(group_id) # Hashable type
-        group_label = packet.payload.label
-        updated_at = packet.payload.updated_at
+        group_label = payload.label
+        updated_at = payload.updated_at
 
         if group_id_tuple not in self._groups:
             # Make a new Group
-            new_group = group.Group(group_id, self, self.by_group_id, device.Device._get_group_data)
+            new_group = group.Group(group_id, self, self.by_group_id, device.Device._get_group_data_async, self._label_ttl)
 
             # Store it
             self._groups[group_id_tuple] = new_group
 
+        self._groups[group_id_tuple].update(group_label, updated_at)
+
+        self._group_index.update(device_id, group_id_tuple)
+
     def _locationpacket(self, host, port, packet):
+        self._update_location(packet.frame_address.target, packet.payload)
+
+    def _update_location(self, device_id, payload):
         # Gather Data
-        location_id = packet.payload.location
+        location_id = payload.location
         location_id_tuple = tuple(location_id) # Hashable type
-        location_label = packet.payload.label
-        updated_at = packet.payload.updated_at
+        location_label = payload.label
+        updated_at = payload.updated_at
 
         if location_id_tuple not in self._locations:
             # Make a new Group for the location
-            new_location = group.Group(location_id, self, self.by_location_id, device.Device._get_location_data)
+            new_location = group.Group(location_id, self, self.by_location_id, device.Device._get_location_data_async, self._label_ttl)
 
             # Store it
             self._locations[location_id_tuple] = new_location
 
+        self._locations[location_id_tuple].update(location_label, updated_at)
+
+        self._location_index.update(device_id, location_id_tuple)
+
+    def _update_state(self, device_id, key, value):
+        """
+        Called by a device for each value in the State packets it receives.
+        """
+        index = self._state_indexes.get(key)
+        if index is not None:
+            index.update(device_id, value)
+
+    def _forget_state(self, device_id, key):
+        """
+        Called by a device when it has been told to change a value, so the
+        index doesn't answer with the old one.
+        """
+        index = self._state_indexes.get(key)
+        if index is not None:
+            index.invalidate(device_id)
+
     def send_packet(self, *args, **kwargs):
         """
         Sends a packet to a device. The client fills in the sequence and source
@@ -145,7 +244,7 @@ class Client(object):
         """
         # Add a sequence number if a higher layer didnt
         if 'sequence' not in kwargs.keys():
-            kwargs['sequence'] = self._seq
+            kwargs['sequence'] = self._pending.next_sequence(kwargs['target'])
 
         kwargs['source'] = self._source
 
@@ -158,33 +257,278 @@ class Client(object):
         """
         Perform device discovery now.
         """
-        return self._transport.send_discovery(self._source, self._seq)
+        return self._transport.send_discovery(self._source, self._pending.next_sequence(None))
 
-    def poll_devices(self):
+    def gather(self, futures, timeout=None, return_exceptions=False):
         """
-        Poll all devices right now.
+        Wait for a number of futures, such as those returned by the *_async
+        methods on devices, so requests to many devices share one wait.
+
+        :param futures: The futures to wait for.
+        :param timeout: The most seconds to wait, None to wait until they are all done.
+        :param return_exceptions: Return exceptions in place of results instead of raising the first one.
+        :returns: list -- The results, in the same order as the futures
         """
-        poll_delta = timedelta(seconds=self._devicepolltime - 1)
+        futures = list(futures)
+        concurrent.futures.wait(futures, timeout)
+
+        results = []
+        for future in futures:
+            if future.done():
+                error = future.exception()
+            else:
+                error = concurrent.futures.TimeoutError()
+
+            if error is None:
+                results.append(future.result())
+            elif return_exceptions:
+                results.append(error)
+            else:
+                raise error
+
+        return results
+
+    def broadcast_set(self, power=None, color=None, waveform=None, duration=device.DEFAULT_DURATION, group_id=None,
+            confirm=CONFIRM_NONE, port=network.DEFAULT_LIFX_PORT):
+        """
+        Change every device with one tagged broadcast packet for each setting,
+        so they all change together.
+
+        Tagged packets reach every device, so when a group is given the
+        settings are sent to each member of the group instead.
+
+        :param power: The new power state, None to leave it.
+        :param color: The HSBK tuple of the new color, None to leave it.
+        :param waveform: A device.Waveform to run, None for none.
+        :param duration: The number of milliseconds to perform power and color transitions over.
+        :param group_id: Only change the devices in this group.
+        :param confirm: CONFIRM_ACK to resend to each device until it acknowledges, CONFIRM_STATE to fetch the state of each device afterwards.
+        :param port: The port devices listen on.
+        :returns: GroupResult -- The outcome for each device, or None without confirm
+        """
+        messages = []
+        if power is not None:
+            msgpower = protocol.UINT16_MAX if power else 0
+            messages.append((protocol.TYPE_LIGHT_SETPOWER, (msgpower, duration)))
+        if color is not None:
+            colormsg = message_from_color(color)
+            messages.append((protocol.TYPE_LIGHT_SETCOLOR, (0,) + tuple(colormsg) + (duration,)))
+        if waveform is not None:
+            messages.append((protocol.TYPE_LIGHT_SETWAVEFORM, device.waveform_args(waveform)))
+        if not messages:
+            raise ValueError('Nothing to set, give a power, color or waveform.')
+
+        if group_id is None:
+            devices = self.get_devices()
+            for pkt_type, args in messages:
+                self._transport.send_broadcast(
+                        *args,
+                        source=self._source,
+                        sequence=self._pending.next_sequence(None),
+                        ack_required=False,
+                        res_required=False,
+                        pkt_type=pkt_type,
+                        port=port
+                )
+        else:
+            devices = self.by_group_id(group_id)
+            if confirm != CONFIRM_ACK:
+                for d in devices:
+                    for pkt_type, args in messages:
+                        d._send_packet(*args, ack_required=False, res_required=False, pkt_type=pkt_type)
+
+        for d in devices:
+            d._invalidate(device.STATE_POWER)
+            d._invalidate(device.STATE_COLOR)
+
+        if confirm == CONFIRM_ACK:
+            def acknowledged(d):
+                future = util.resolved_future()
+                for pkt_type, args in messages:
+                    future = util.compose_future(
+                            future,
+                            lambda result, pkt_type=pkt_type, args=args: d._request(True, False, *args, pkt_type=pkt_type),
+                    )
+                return future
+
+            return group.fan_out(devices, acknowledged, len(messages) * device.DEFAULT_TIMEOUT)
+
+        if confirm == CONFIRM_STATE:
+            def state(d):
+                return util.chain_future(
+                        d._request(False, True, pkt_type=protocol.TYPE_LIGHT_GET),
+                        device.light_state_from_message,
+                )
+
+            return group.fan_out(devices, state)
+
+        return None
+
+    def broadcast_query(self, pkt_type, *args, **kwargs):
+        """
+        Ask every device for something with one tagged broadcast packet,
+        yielding the replies as they arrive. Devices that haven't answered
+        once every device has, or the wait is over, are asked again by
+        unicast.
+
+        :param pkt_type: The type of Get to send.
+        :param args: The fields of the payload.
+        :param wait: The number of seconds to wait for replies to the broadcast.
+        :param timeout: The number of seconds to wait for replies to the unicast requests.
+        :param port: The port devices listen on.
+        :returns: generator -- QueryResult tuples, the error is set for devices that never answered
+        """
+        wait = kwargs.get('wait', BROADCAST_WAIT)
+        timeout = kwargs.get('timeout', device.DEFAULT_TIMEOUT)
+        port = kwargs.get('port', network.DEFAULT_LIFX_PORT)
+
+        devices = dict((d.id, d) for d in self.get_devices())
+        sequence = self._pending.next_sequence(None)
+        replies = Queue.Queue()
+
+        def handler(host, port, packet):
+            if packet.frame_header.source == self._broadcast_source and packet.frame_address.sequence == sequence:
+                replies.put((packet.frame_address.target, packet.payload))
+
+        handle = self._transport.register_packet_handler(handler, (protocol.responses[pkt_type],))
+        try:
+            self._transport.send_broadcast(
+                    *args,
+                    source=self._broadcast_source,
+                    sequence=sequence,
+                    ack_required=False,
+                    res_required=True,
+                    pkt_type=pkt_type,
+                    port=port
+            )
+
+            deadline = time.time() + wait
+            silent = set(devices.keys())
+            while silent:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    device_id, payload = replies.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+
+                if device_id in silent:
+                    silent.remove(device_id)
+                    yield QueryResult(devices[device_id], payload, None)
+        finally:
+            self._transport.unregister_packet_handler(handle)
+
+        # Ask the ones that stayed quiet directly
+        futures = dict((devices[device_id].request(pkt_type, *args, timeout=timeout), devices[device_id]) for device_id in silent)
+        for future in concurrent.futures.as_completed(futures.keys()):
+            error = future.exception()
+            if error is None:
+                yield QueryResult(futures[future], future.result(), None)
+            else:
+                yield QueryResult(futures[future], None, error)
+
+    def snapshot(self, wait=BROADCAST_WAIT, timeout=device.DEFAULT_TIMEOUT, port=network.DEFAULT_LIFX_PORT):
+        """
+        Get the power, color and label of every device with one broadcast
+        LIGHT_GET, asking by unicast only the devices that don't answer it.
 
-        for device in filter(lambda x:x.seen_ago > poll_delta,  self._devices.values()):
-            device.send_poll_packet()
+        :param wait: The number of seconds to wait for replies to the broadcast.
+        :param timeout: The number of seconds to wait for replies to the unicast requests.
+        :param port: The port devices listen on.
+        :returns: OrderedDict -- A device.LightState for each device by device id order, None for devices that never answered
+        """
+        states = {}
+        for result in self.broadcast_query(protocol.TYPE_LIGHT_GET, wait=wait, timeout=timeout, port=port):
+            if result.error is None:
+                states[result.device] = device.light_state_from_message(result.payload)
+            else:
+                states[result.device] = None
 
-    def get_devices(self, max_seen=None):
+        return OrderedDict((d, states.get(d)) for d in sorted(states.keys(), key=lambda d: d.id))
+
+    def refresh_membership(self, devices=None):
         """
-        Get a list of all responding devices.
+        Ask devices which group and location they are in, all at once and
+        without waiting. The replies update the group and location indexes.
 
-        :param max_seen: The number of seconds since the device was last seen, defaults to 3 times the devicepoll interval.
+        :param devices: The devices to ask, defaults to the responding ones.
+        :returns: list -- Futures for the replies
+        """
+        if devices is None:
+            devices = self.get_devices()
+
+        # The packet handlers update the indexes too, but doing it here
+        # means they are current by the time the futures finish
+        futures = []
+        for d in devices:
+            futures.append(util.chain_future(
+                    d.request(protocol.TYPE_GETGROUP, priority=util.PRIORITY_BACKGROUND),
+                    lambda payload, device_id=d.id: self._update_group(device_id, payload),
+            ))
+            futures.append(util.chain_future(
+                    d.request(protocol.TYPE_GETLOCATION, priority=util.PRIORITY_BACKGROUND),
+                    lambda payload, device_id=d.id: self._update_location(device_id, payload),
+            ))
+        return futures
+
+    def _indexed(self, index):
+        """
+        Make sure the membership index knows about all the responding
+        devices, asking the ones it doesn't all at once.
+        """
+        missing = self._responding(index.unknown())
+        if missing:
+            self.gather(self.refresh_membership(missing), return_exceptions=True)
+
+    def _state_indexed(self, key):
+        """
+        Make sure the index for a state value knows about all the responding
+        devices, asking the ones it doesn't, or hasn't heard from within the
+        cache ttl, all at once.
+        """
+        missing = self._responding(self._state_indexes[key].unknown())
+        futures = [d.get_state_async(key) for d in missing]
+        if futures:
+            self.gather(futures, return_exceptions=True)
+
+    def _responding(self, device_ids, max_seen=None):
+        """
+        Get the devices with the ids given that are still responding, sorted
+        by device id.
         """
         if max_seen is None:
             max_seen = self._devicepolltime * MISSED_POLLS
 
         seen_delta = timedelta(seconds=max_seen)
 
-        devices = filter(lambda x:x.seen_ago < seen_delta, self._devices.values())
+        devices = []
+        for device_id in device_ids:
+            d = self._devices.get(device_id)
+            if d is not None and d.seen_ago < seen_delta:
+                devices.append(d)
 
         # Sort by device id to ensure consistent ordering
         return sorted(devices, key=lambda k:k.id)
 
+    def poll_devices(self):
+        """
+        Poll all devices right now.
+        """
+        poll_delta = timedelta(seconds=self._devicepolltime - 1)
+
+        for device in filter(lambda x:x.seen_ago > poll_delta,  self._devices.values()):
+            device.send_poll_packet()
+
+    def get_devices(self, max_seen=None):
+        """
+        Get a list of all responding devices.
+
+        :param max_seen: The number of seconds since the device was last seen, defaults to 3 times the devicepoll interval.
+        """
+        return self._responding(self._devices.keys(), max_seen)
+
     def get_groups(self, max_seen=None):
         """
         Get a list of all groups with responding devices.
@@ -192,7 +536,8 @@ class Client(object):
         :param max_seen: The number of seconds since a device in the group was last seen, defaults to 3 times the devicepoll interval.
         """
         devices = self.get_devices(max_seen)
-        group_ids = set(map(lambda x:tuple(x.group_id), devices))
+        self._indexed(self._group_index)
+        group_ids = set(self._group_index.group_of(d.id) for d in devices) - set([None])
         groups = map(lambda x:self._groups[x], group_ids)
 
         # Sort by group id to ensure consistent ordering
@@ -205,7 +550,8 @@ class Client(object):
         :param max_seen: The number of seconds since a device in the location was last seen, defaults to 3 times the devicepoll interval.
         """
         devices = self.get_devices(max_seen)
-        location_ids = set(map(lambda x:tuple(x.location_id), devices))
+        self._indexed(self._location_index)
+        location_ids = set(self._location_index.group_of(d.id) for d in devices) - set([None])
         locations = map(lambda x:self._locations[x], location_ids)
 
         # Sort by location id to ensure consistent ordering
@@ -227,7 +573,8 @@ class Client(object):
         :param by_label: The label we are looking for.
         :returns: list -- The devices that match criteria
         """
-        return filter(lambda d: d.label == label, self.get_devices())
+        self._state_indexed(device.STATE_LABEL)
+        return self._responding(self._label_index.members(label))
 
     def by_id(self, id):
         """
@@ -235,8 +582,12 @@ class Client(object):
 
         :param id: The device id
         :returns: Device -- The device with the matching id.
+        :raises: IndexError -- If no responding device has the id.
         """
-        return filter(lambda d: d.id == id, self.get_devices())[0]
+        devices = self._responding((id,))
+        if not devices:
+            raise IndexError('No responding device with id %s' % id)
+        return devices[0]
 
     def by_power(self, power):
         """
@@ -245,7 +596,8 @@ class Client(object):
         :param power: True returns all devices that are on, False returns ones that are off.
         :returns: list -- The devices that match criteria
         """
-        return filter(lambda d: d.power == power, self.get_devices())
+        self._state_indexed(device.STATE_POWER)
+        return self._responding(self._power_index.members(bool(power)))
 
     def by_group_id(self, group_id):
         """
@@ -254,7 +606,8 @@ class Client(object):
         :param group_id: The group id to match on each light.
         :returns: list -- The devices that match criteria
         """
-        return filter(lambda d: d.group_id == group_id, self.get_devices())
+        self._indexed(self._group_index)
+        return self._responding(self._group_index.members(tuple(group_id)))
 
     def by_location_id(self, location_id):
         """
@@ -263,11 +616,27 @@ class Client(object):
         :param group_id: The group id to match on each light.
         :returns: list -- The devices that match criteria
         """
-        return filter(lambda d: d.location_id == location_id, self.get_devices())
+        self._indexed(self._location_index)
+        return self._responding(self._location_index.members(tuple(location_id)))
 
     def __getitem__(self, key):
         return self.get_devices()[key]
 
+    @property
+    def congestion(self):
+        """
+        The congestion window over requests in flight to every device, see
+        request.CongestionWindow. Read Only.
+        """
+        return self._window.stats
+
+    @property
+    def job_stats(self):
+        """
+        The run times of the polls and resends, see util.Scheduler.stats. Read Only.
+        """
+        return self._scheduler.stats
+
     @property
     def devices(self):
         return self.get_devices()
@@ -0,0 +1,289 @@
+"""
+Precompiled encoders and decoders for protocol sections.
+
+The section definitions in :mod:`lifx.protocol` describe each header and
+payload as a bitstruct format plus a byteswap string. Running them through
+bitstruct on every packet means re-parsing the format and building a string of
+bits each time. This module compiles a section once into a little-endian
+:class:`struct.Struct` plus a small amount of bit fiddling for the fields
+that share a byte group, giving byte-for-byte the same output.
+"""
+import re
+import struct
+
+from bitstruct import unpack, pack, byteswap
+
+# Struct codes for little-endian integers and floats by size in bytes
+UNSIGNED_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+SIGNED_CODES = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+FLOAT_CODES = {4: 'f', 8: 'd'}
+
+def parse_format(fmt):
+    """
+    Splits a bitstruct format string into its fields
+
+    :param fmt: The bitstruct format string, eg 'u16u2u1u1u12u32'
+    :returns: list -- A list of (type, bits) tuples
+    """
+    return [(t, int(bits)) for t, bits in re.findall(r'([a-z])(\d+)', fmt)]
+
+def _pieces(nbytes):
+    """
+    Splits an odd sized group (eg 6 bytes) into native struct integer sizes
+    """
+    pieces = []
+    for size in (8, 4, 2, 1):
+        while nbytes >= size:
+            pieces.append(size)
+            nbytes -= size
+    return pieces
+
+class _Field(object):
+    """A single value inside a group of bytes, counted from the most significant bit"""
+    def __init__(self, fieldtype, bits, shift):
+        self.fieldtype = fieldtype
+        self.bits = bits
+        self.shift = shift
+        self.mask = (1 << bits) - 1
+
+class _Chunk(object):
+    """
+    A run of the format that starts and ends on a byteswap boundary. The
+    chunk knows how many raw struct values it uses and how to turn them into
+    field values and back again.
+    """
+    def __init__(self, codes, nraw, fields, decode, encode):
+        self.codes = codes
+        self.nraw = nraw
+        self.nfields = len(fields)
+        self.decode = decode
+        self.encode = encode
+
+def _bytes_chunk(fieldtype, bits, groups):
+    if bits % 8 != 0 or any(g != 1 for g in groups):
+        raise ValueError('Byte fields must be whole bytes that are not swapped')
+
+    nbytes = bits / 8
+
+    if fieldtype == 'p':
+        return _Chunk('%dx' % nbytes, 0, [], lambda raw: [], lambda values: [])
+
+    return _Chunk(
+            '%ds' % nbytes,
+            1,
+            [fieldtype],
+            lambda raw: [bytearray(raw[0])],
+            lambda values: [bytes(values[0])],
+    )
+
+def _integer_chunk(fields, nbytes):
+    """
+    Builds a chunk for one byteswap group of integer, float or padding fields.
+    """
+    # A lone field that fills a natively sized group needs no work at all
+    if len(fields) == 1:
+        fieldtype, bits = fields[0]
+        if fieldtype == 'u' and nbytes in UNSIGNED_CODES:
+            return _Chunk(UNSIGNED_CODES[nbytes], 1, fields, None, None)
+        if fieldtype == 's' and nbytes in SIGNED_CODES:
+            return _Chunk(SIGNED_CODES[nbytes], 1, fields, None, None)
+        if fieldtype == 'f' and nbytes in FLOAT_CODES:
+            return _Chunk(FLOAT_CODES[nbytes], 1, fields, None, None)
+        if fieldtype == 'p':
+            return _Chunk('%dx' % nbytes, 0, [], lambda raw: [], lambda values: [])
+
+    if any(t not in 'usp' for t, _ in fields):
+        raise ValueError('Only integers and padding can share a byteswap group')
+
+    # Read the group as one little-endian integer, made of native pieces
+    pieces = _pieces(nbytes)
+    codes = ''.join(UNSIGNED_CODES[p] for p in pieces)
+    offsets = []
+    offset = 0
+    for p in pieces:
+        offsets.append(offset * 8)
+        offset += p
+
+    # Bitstruct packs the first field into the most significant bits
+    layout = []
+    remaining = nbytes * 8
+    for fieldtype, bits in fields:
+        remaining -= bits
+        layout.append(_Field(fieldtype, bits, remaining))
+    values_layout = [f for f in layout if f.fieldtype != 'p']
+
+    def decode(raw):
+        value = 0
+        for piece, shift in zip(raw, offsets):
+            value |= piece << shift
+
+        result = []
+        for f in values_layout:
+            v = (value >> f.shift) & f.mask
+            if f.fieldtype == 's' and v >> (f.bits - 1):
+                v -= 1 << f.bits
+            result.append(v)
+        return result
+
+    def encode(values):
+        value = 0
+        for f, v in zip(values_layout, values):
+            value |= (v & f.mask) << f.shift
+
+        return [(value >> shift) & ((1 << (p * 8)) - 1) for p, shift in zip(pieces, offsets)]
+
+    return _Chunk(codes, len(pieces), values_layout, decode, encode)
+
+def _chunks(fmt, swap):
+    """
+    Walks the format and byteswap strings together, cutting them into chunks
+    wherever a field boundary and a byteswap boundary line up.
+    """
+    fields = parse_format(fmt)
+    groups = [int(g) for g in swap]
+
+    if sum(bits for _, bits in fields) != sum(groups) * 8:
+        raise ValueError('Format %r and byteswap %r are different sizes' % (fmt, swap))
+
+    chunks = []
+    fi = gi = 0
+    while fi < len(fields):
+        chunk_fields = [fields[fi]]
+        chunk_groups = [groups[gi]]
+        fi += 1
+        gi += 1
+
+        # Grow the chunk until both ends line up
+        while True:
+            field_bits = sum(bits for _, bits in chunk_fields)
+            group_bits = sum(chunk_groups) * 8
+            if field_bits < group_bits:
+                chunk_fields.append(fields[fi])
+                fi += 1
+            elif group_bits < field_bits:
+                chunk_groups.append(groups[gi])
+                gi += 1
+            else:
+                break
+
+        fieldtype, bits = chunk_fields[0]
+        if len(chunk_fields) == 1 and (fieldtype == 'b' or (fieldtype == 'p' and len(chunk_groups) > 1)):
+            chunks.append(_bytes_chunk(fieldtype, bits, chunk_groups))
+        elif len(chunk_groups) == 1:
+            chunks.append(_integer_chunk(chunk_fields, chunk_groups[0]))
+        else:
+            raise ValueError('Fields spanning several byteswap groups are not supported')
+
+    return chunks
+
+class Codec(object):
+    """
+    Encodes and decodes one protocol section. Build these with
+    :func:`compile_section` rather than directly.
+    """
+    def __init__(self, fmt, swap, fields):
+        chunks = _chunks(fmt, swap)
+
+        self._struct = struct.Struct('<' + ''.join(c.codes for c in chunks))
+        self._fields = fields
+        self.size = self._struct.size
+
+        # When every chunk maps one raw value to one field we can skip the
+        # per chunk work entirely
+        self._direct = all(c.decode is None for c in chunks)
+        self._chunks = [(c.nraw, c.nfields, c.decode, c.encode) for c in chunks]
+
+    def _encode(self, args):
+        if self._direct:
+            return args
+
+        raw = []
+        i = 0
+        for nraw, nfields, decode, encode in self._chunks:
+            if encode is None:
+                raw.append(args[i])
+            else:
+                raw.extend(encode(args[i:i + nfields]))
+            i += nfields
+        return raw
+
+    def _decode(self, raw):
+        if self._direct:
+            return raw
+
+        values = []
+        i = 0
+        for nraw, nfields, decode, encode in self._chunks:
+            if decode is None:
+                values.append(raw[i])
+            else:
+                values.extend(decode(raw[i:i + nraw]))
+            i += nraw
+        return values
+
+    def pack(self, *args):
+        """
+        Packs the values into a new bytearray
+
+        :param \*args: Values for the section in the order they are in the format
+        :returns: bytearray -- The packed bytes of the section
+        """
+        return bytearray(self._struct.pack(*self._encode(args)))
+
+    def pack_into(self, buf, offset, *args):
+        """
+        Packs the values into an existing buffer
+
+        :param buf: A writable buffer, such as a bytearray
+        :param offset: The byte offset in the buffer to start writing at
+        :param \*args: Values for the section in the order they are in the format
+        """
+        self._struct.pack_into(buf, offset, *self._encode(args))
+
+    def unpack_from(self, data, offset=0):
+        """
+        Unpacks the section from a buffer
+
+        :param data: The buffer holding the section
+        :param offset: The byte offset in the buffer the section starts at
+        :returns: namedtuple -- A namedtuple containing the data from the section
+        """
+        return self._fields(*self._decode(self._struct.unpack_from(data, offset)))
+
+class BitstructCodec(object):
+    """
+    Fallback codec for section layouts the struct compiler cannot express. It
+    has the same interface as :class:`Codec` but runs bitstruct every time.
+    """
+    def __init__(self, fmt, swap, fields):
+        self._format = fmt
+        self._byteswap = swap
+        self._fields = fields
+        self.size = sum(bits for _, bits in parse_format(fmt)) / 8
+
+    def pack(self, *args):
+        return byteswap(self._byteswap, pack(self._format, *args))
+
+    def pack_into(self, buf, offset, *args):
+        buf[offset:offset + self.size] = self.pack(*args)
+
+    def unpack_from(self, data, offset=0):
+        data = bytearray(data[offset:offset + self.size])
+        return self._fields(*unpack(self._format, byteswap(self._byteswap, data)))
+
+def compile_section(section):
+    """
+    Compiles a section definition and stores the codec on it under the
+    'codec' key. Sections that are already compiled are left alone.
+
+    :param section: The definition of the format, byteswap and namedtuple for this section
+    :returns: Codec -- The codec for this section
+    """
+    codec = section.get('codec')
+    if codec is None:
+        try:
+            codec = Codec(section['format'], section['byteswap'], section['fields'])
+        except ValueError:
+            codec = BitstructCodec(section['format'], section['byteswap'], section['fields'])
+        section['codec'] = codec
+    return codec
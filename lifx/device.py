@@ -1,16 +1,103 @@
 from datetime import datetime
 import protocol
-from threading import Event
 from collections import namedtuple
 from lifx.color import modify_color
+from request import RttEstimator
+from cache import StateCache, DEFAULT_TTL
+from concurrent.futures import Future
+import concurrent.futures
 import color
+import threading
 import time
+import util
 
 DEFAULT_DURATION = 200
 DEFAULT_TIMEOUT = 2.0
 DEFAULT_RETRANSMITS = 10
-
-StatsTuple = namedtuple('StatsTuple', ['dropped_packets', 'sent_packets'])
+REQUEST_SLACK = 1.0
+
+# The most messages a second a bulb is sent when streaming
+STREAM_RATE = 20
+
+# The rate and burst size of everything sent to a bulb
+DEFAULT_SEND_RATE = 20
+DEFAULT_SEND_BURST = 5
+
+StatsTuple = namedtuple('StatsTuple', ['dropped_packets', 'sent_packets', 'coalesced_requests', 'superseded_writes'])
+RttTuple = namedtuple('RttTuple', ['srtt', 'rttvar', 'rto'])
+QueueTuple = namedtuple('QueueTuple', ['interactive_depth', 'background_depth', 'mean_wait', 'max_wait'])
+LightState = namedtuple('LightState', ['power', 'color', 'label'])
+Waveform = namedtuple('Waveform', ['color', 'waveform', 'period', 'cycles', 'skew_ratio', 'transient'])
+
+def light_state_from_message(payload):
+    """
+    Get the power, color and label from a LIGHT_STATE payload.
+
+    :param payload: The LIGHT_STATE payload.
+    :returns: LightState -- The state of the light
+    """
+    return LightState(
+            power=payload.power > 0,
+            color=color.color_from_message(payload),
+            label=protocol.bytes_to_label(payload.label),
+    )
+
+def waveform_args(wave):
+    """
+    Get the payload for a LIGHT_SETWAVEFORM message.
+
+    :param wave: The Waveform to run.
+    :returns: tuple -- The payload fields
+    """
+    colormsg = color.message_from_color(wave.color)
+    return (
+            0,
+            int(wave.transient),
+            colormsg.hue,
+            colormsg.saturation,
+            colormsg.brightness,
+            colormsg.kelvin,
+            wave.period,
+            wave.cycles,
+            int(wave.skew_ratio * protocol.UINT16_MAX) - pow(2, 15),
+            wave.waveform,
+    )
+
+# Names of the values in the state cache
+STATE_LABEL = 'label'
+STATE_POWER = 'power'
+STATE_COLOR = 'color'
+STATE_GROUP = 'group'
+STATE_LOCATION = 'location'
+
+def _power_from_message(payload):
+    return payload.level > 0
+
+def _label_from_message(payload):
+    return protocol.bytes_to_label(payload.label)
+
+# The cached values carried by each type of State packet
+STATE_FIELDS = {
+    protocol.TYPE_LIGHT_STATE: {
+        STATE_COLOR: color.color_from_message,
+        STATE_POWER: lambda payload: payload.power > 0,
+        STATE_LABEL: _label_from_message,
+    },
+    protocol.TYPE_STATEPOWER: {STATE_POWER: _power_from_message},
+    protocol.TYPE_LIGHT_STATEPOWER: {STATE_POWER: _power_from_message},
+    protocol.TYPE_STATELABEL: {STATE_LABEL: _label_from_message},
+    protocol.TYPE_STATEGROUP: {STATE_GROUP: lambda payload: payload},
+    protocol.TYPE_STATELOCATION: {STATE_LOCATION: lambda payload: payload},
+}
+
+# The Get that asks for each cached value
+STATE_REQUESTS = {
+    STATE_LABEL: protocol.TYPE_GETLABEL,
+    STATE_POWER: protocol.TYPE_GETPOWER,
+    STATE_COLOR: protocol.TYPE_LIGHT_GET,
+    STATE_GROUP: protocol.TYPE_GETGROUP,
+    STATE_LOCATION: protocol.TYPE_GETLOCATION,
+}
 
 class DeviceTimeoutError(Exception):
     '''Raise when we time out waiting for a response'''
@@ -22,8 +109,19 @@ class DeviceTimeoutError(Exception):
         self.timeout = timeout
         self.retransmits = retransmits
 
+class DeviceEvictedError(DeviceTimeoutError):
+    '''Raise when a request is dropped to make room for newer ones before it could time out'''
+    def __init__(self, device, transmissions=None):
+        message = "Device with id:'%s' request was dropped for newer requests before it timed out." % (protocol.mac_string(device.id),)
+
+        Exception.__init__(self, message)
+        self.device = device
+        self.timeout = None
+        self.retransmits = transmissions
+
 class Device(object):
-    def __init__(self, device_id, host, client):
+    def __init__(self, device_id, host, client, cache_ttl=DEFAULT_TTL, send_rate=DEFAULT_SEND_RATE,
+            send_burst=DEFAULT_SEND_BURST):
         # Our Device
         self._device_id = device_id
         self._host = host
@@ -37,30 +135,84 @@ class Device(object):
         # For sending packets
         self._client = client
 
-        # Tools for tracking responses
-        self._tracked = {}
-        self._responses = {}
-
         # Stats tracking
         self._dropped_packets = 0
         self._sent_packets = 0
+        self._coalesced_requests = 0
 
-    @property
-    def _seq(self):
-        return self._client._seq
+        # Everything sent to the bulb goes through here, so it isn't flooded
+        if send_rate:
+            bucket = util.TokenBucket(send_rate, send_burst)
+        else:
+            bucket = None
+        self._send_queue = util.SendQueue(client._scheduler, bucket)
+
+        # Unacknowledged writes, sent at the rate the bulb can take
+        self._stream = util.LatestWriter(client._scheduler, 1.0 / STREAM_RATE)
+
+        # Gets waiting on a reply, pkt_type -> Future
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # (target, sequence) of Sets waiting on a State reply, which holds
+        # the old values, keyed like the pending table
+        self._set_requests = set()
+
+        # Round trip times, these set how long we wait before retransmitting
+        self._rtt = RttEstimator()
+
+        # The last state the device told us about
+        self._cache = StateCache(cache_ttl)
 
     def _packethandler(self, host, port, packet):
         self._seen()
 
+        pkt_type = packet.protocol_header.pkt_type
+
         # If it was a service packet
-        if packet.protocol_header.pkt_type == protocol.TYPE_STATESERVICE:
+        if pkt_type == protocol.TYPE_STATESERVICE:
             self._services[packet.payload.service] = packet.payload.port
 
-        # Store packet and fire events
-        self._responses[packet.frame_address.sequence] = packet
-        event = self._tracked.get(packet.frame_address.sequence, None)
-        if event is not None:
-            event.set()
+        # Remember any state it carries, whoever asked for it, unless it is
+        # the reply to one of our Sets, which is sent before the Set is applied
+        answers_set = (packet.frame_header.source == self._client._source
+                and (packet.frame_address.target, packet.frame_address.sequence) in self._set_requests)
+        fields = STATE_FIELDS.get(pkt_type)
+        if fields is not None and not answers_set:
+            payload = packet.payload
+            for key, func in fields.items():
+                self._store(key, func(payload))
+
+        # Wake up whoever is waiting for this packet, replies to broadcast
+        # queries share sequences with requests so never answer them
+        if packet.frame_header.source == self._client._source:
+            self._client._pending.complete(packet)
+
+    def _store(self, key, value):
+        """
+        Cache a value the device has, and tell the client about it.
+        """
+        self._cache.update(key, value)
+        self._client._update_state(self._device_id, key, value)
+
+    def _acknowledged(self, future, key, value):
+        """
+        Cache the value a Set sent once the device acknowledges it.
+
+        :returns: Future -- The value, once acknowledged
+        """
+        def store(ack):
+            self._store(key, value)
+            return value
+        return util.chain_future(future, store)
+
+    def _invalidate(self, key):
+        """
+        Forget a cached value, and tell the client it no longer knows it,
+        for when the device has been told to change it.
+        """
+        self._cache.invalidate(key)
+        self._client._forget_state(self._device_id, key)
 
     def _send_packet(self, *args, **kwargs):
         """
@@ -71,7 +223,14 @@ class Device(object):
         * res_required
         * pkt_type
         * Arguments for the payload
+
+        It may also be given a priority, background packets wait for
+        interactive ones when the device's send rate is used up, and a
+        send_key, a packet waiting for the send rate is replaced by a newer
+        one with the same send_key.
         """
+        priority = kwargs.pop('priority', util.PRIORITY_INTERACTIVE)
+        kwargs['key'] = kwargs.pop('send_key', None)
 
         kwargs['address'] = self.host
         kwargs['port'] = self.get_port()
@@ -79,7 +238,9 @@ class Device(object):
 
         self._sent_packets += 1
 
-        return self._client.send_packet(
+        return self._send_queue.submit(
+                priority,
+                self._client.send_packet,
                 *args,
                 **kwargs
         )
@@ -96,57 +257,162 @@ class Device(object):
 
         Only needs the type and an optional payload.
         """
-        if need_ack and need_res:
-            raise NotImplemented('Waiting for both acknowledgement and response not yet supported.')
-
-        sequence = self._seq
         timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
-        sub_timeout = timeout / DEFAULT_RETRANSMITS
+        return self._wait(self._request(need_ack, need_res, *args, **kwargs), timeout)
+
+    def _wait(self, future, timeout=DEFAULT_TIMEOUT):
+        """
+        Block for the result of a future from this device.
+        """
+        # The retransmitter finishes the request by the timeout, the slack
+        # only matters if its thread has died
+        try:
+            return future.result(timeout + REQUEST_SLACK)
+        except concurrent.futures.TimeoutError:
+            raise DeviceTimeoutError(self, timeout, DEFAULT_RETRANSMITS)
 
-        for i in range(1, DEFAULT_RETRANSMITS):
-            if i != 1:
-                self._dropped_packets += 1
+    def _request(self, need_ack, need_res, *args, **kwargs):
+        """
+        Send a packet and return a future for the replies.
 
-            e = Event()
-            self._tracked[sequence] = e
+        Only needs the type and an optional payload.
+        """
+        timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
 
+        # If we don't care about a response, don't track or wait at all
+        if not (need_ack or need_res):
+            self._send_packet(
+                    ack_required=False,
+                    res_required=False,
+                    *args,
+                    **kwargs
+            )
+            return util.resolved_future()
+
+        pkt_type = kwargs['pkt_type']
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        # Identical Gets sent while one is waiting share its reply
+        if need_res and not need_ack and not args and pkt_type in protocol.CLASS_TYPE_GET:
+            with self._inflight_lock:
+                inflight = self._inflight.get(pkt_type)
+                if inflight is not None:
+                    self._coalesced_requests += 1
+                    return inflight
+                self._inflight[pkt_type] = future
+            future.add_done_callback(lambda f: self._inflight_done(pkt_type, f))
+
+        # The State reply to a Set holds the values from before it
+        answers_set = need_res and pkt_type in protocol.CLASS_TYPE_SET
+
+        def send(sequence, on_sent):
+            if answers_set:
+                self._set_requests.add((self._device_id, sequence))
             self._send_packet(
                     ack_required=need_ack,
                     res_required=need_res,
                     sequence=sequence,
+                    on_sent=on_sent,
+                    send_key=sequence,
                     *args,
                     **kwargs
             )
 
-            # If we don't care about a response, don't block at all
-            if not (need_ack or need_res):
-                return None
+        def retransmitted():
+            self._dropped_packets += 1
+
+        def finished(request):
+            if answers_set:
+                self._set_requests.discard(request.key)
+
+            if request.error is not None:
+                future.set_exception(request.error)
+            elif request.evicted:
+                future.set_exception(DeviceEvictedError(self, request.attempts))
+            elif request.response is None:
+                future.set_exception(DeviceTimeoutError(self, timeout, DEFAULT_RETRANSMITS))
+            elif need_res:
+                future.set_result(request.response.payload)
+            else:
+                future.set_result(True)
+
+        request = self._client._retransmitter.submit(
+                self._device_id,
+                protocol.response_types(pkt_type, need_ack, need_res),
+                send,
+                timeout,
+                DEFAULT_RETRANSMITS,
+                retransmitted,
+                self._rtt,
+                kwargs.get('priority', util.PRIORITY_INTERACTIVE),
+        )
+        request.add_done_callback(finished)
+
+        return future
+
+    def _inflight_done(self, pkt_type, future):
+        with self._inflight_lock:
+            if self._inflight.get(pkt_type) is future:
+                del self._inflight[pkt_type]
 
-            if e.wait(sub_timeout):
-                response = self._responses[sequence]
+    def request(self, pkt_type, *args, **kwargs):
+        """
+        Send a packet to the device without waiting for the reply.
 
-                # TODO: Check if the response was actually what we expected
+        :param pkt_type: The type of packet to send.
+        :param args: The fields of the payload.
+        :param ack_required: Wait for an acknowledgement, defaults to False.
+        :param res_required: Wait for a response, defaults to True.
+        :param timeout: The number of seconds to wait for the reply.
+        :param priority: util.PRIORITY_INTERACTIVE, the default, or util.PRIORITY_BACKGROUND for polls that can wait.
+        :returns: Future -- The payload of the response, True for an acknowledgement or None if neither was asked for
+        """
+        ack_required = kwargs.pop('ack_required', False)
+        res_required = kwargs.pop('res_required', True)
+        return self._request(ack_required, res_required, pkt_type=pkt_type, *args, **kwargs)
+
+    def get_state_async(self, key, max_age=None):
+        """
+        Read a value from the state cache, asking the device for it if the
+        cached value is too old.
+
+        :param key: The name of the value, one of the STATE_* names.
+        :param max_age: The oldest value in seconds to accept, None for the cache ttl, cache.CACHED for any age or cache.FRESH to always ask.
+        :returns: Future -- The value
+        """
+        entry = self._cache.lookup(key, max_age)
+        if entry is not None:
+            return util.resolved_future(entry.value)
 
-                if need_res:
-                    return response.payload
-                else:
-                    return True
+        pkt_type = STATE_REQUESTS[key]
+        return util.chain_future(
+                self._request(False, True, pkt_type=pkt_type),
+                STATE_FIELDS[protocol.responses[pkt_type]][key],
+        )
 
-        # We did get a response
-        raise DeviceTimeoutError(self, timeout, DEFAULT_RETRANSMITS)
+    def get_state(self, key, max_age=None):
+        """
+        Read a value from the state cache, asking the device for it if the
+        cached value is too old.
 
+        :param key: The name of the value, one of the STATE_* names.
+        :param max_age: The oldest value in seconds to accept, None for the cache ttl, cache.CACHED for any age or cache.FRESH to always ask.
+        :returns: The value
+        """
+        return self._wait(self.get_state_async(key, max_age))
 
-    def _get_group_data(self):
+    def _get_group_data_async(self):
         """
         Called by the group object so it can see the updated_at from the group
         """
-        return self._block_for_response(pkt_type=protocol.TYPE_GETGROUP)
+        return self.get_state_async(STATE_GROUP)
 
-    def _get_location_data(self):
+    def _get_location_data_async(self):
         """
         Called by the group object so it can see the updated_at from the location
         """
-        return self._block_for_response(pkt_type=protocol.TYPE_GETLOCATION)
+        return self.get_state_async(STATE_LOCATION)
 
     def send_poll_packet(self):
         """
@@ -158,13 +424,16 @@ class Device(object):
                 ack_required=False,
                 res_required=True,
                 pkt_type=protocol.TYPE_GETSERVICE,
+                priority=util.PRIORITY_BACKGROUND,
         )
 
     def _seen(self):
         self._lastseen = datetime.now()
 
     def __repr__(self):
-        return u'<Device MAC:%s, Label:%s>' % (protocol.mac_string(self._device_id), repr(self.label))
+        entry = self._cache.entry(STATE_LABEL)
+        label = entry.value if entry is not None else None
+        return u'<Device MAC:%s, Label:%s>' % (protocol.mac_string(self._device_id), repr(label))
 
     def get_port(self, service_id=protocol.SERVICE_UDP):
         """
@@ -179,23 +448,84 @@ class Device(object):
         return StatsTuple(
                 dropped_packets=self._dropped_packets,
                 sent_packets=self._sent_packets,
+                coalesced_requests=self._coalesced_requests,
+                superseded_writes=self._stream.superseded,
+        )
+
+    @property
+    def send_queue(self):
+        """
+        The number of packets waiting for the device's send rate in each
+        priority class, and the mean and longest time in seconds packets
+        have waited. Read Only.
+        """
+        depth = self._send_queue.depth
+        return QueueTuple(
+                interactive_depth=depth[util.PRIORITY_INTERACTIVE],
+                background_depth=depth[util.PRIORITY_BACKGROUND],
+                mean_wait=self._send_queue.mean_wait,
+                max_wait=self._send_queue.max_wait,
         )
 
+    @property
+    def rtt(self):
+        """
+        The smoothed round trip time and its variance in seconds, as measured
+        from acknowledgements and responses, and the retransmit timeout they
+        give. The round trip values are None until the device has replied.
+        Read Only.
+        """
+        return RttTuple(
+                srtt=self._rtt.srtt,
+                rttvar=self._rtt.rttvar,
+                rto=self._rtt.rto,
+        )
+
+    @property
+    def cached_state(self):
+        """
+        Everything the device has reported about its state, with how old
+        each value is and whether it is older than the cache ttl. Read Only.
+        """
+        return self._cache.entries()
+
     @property
     def group_id(self):
         """
         The id of the group that the Device is in. Read Only.
         """
-        response = self._get_group_data()
-        return response.group
+        return self._wait(self.group_id_async())
+
+    def group_id_async(self, max_age=None):
+        """
+        Fetch the id of the group that the Device is in.
+
+        :param max_age: The oldest cached value in seconds to accept.
+        :returns: Future -- The group id
+        """
+        return util.chain_future(
+                self.get_state_async(STATE_GROUP, max_age),
+                lambda response: response.group,
+        )
 
     @property
     def location_id(self):
         """
         The id of the group that the Device is in. Read Only.
         """
-        response = self._get_location_data()
-        return response.location
+        return self._wait(self.location_id_async())
+
+    def location_id_async(self, max_age=None):
+        """
+        Fetch the id of the location that the Device is in.
+
+        :param max_age: The oldest cached value in seconds to accept.
+        :returns: Future -- The location id
+        """
+        return util.chain_future(
+                self.get_state_async(STATE_LOCATION, max_age),
+                lambda response: response.location,
+        )
 
     @property
     def udp_port(self):
@@ -223,16 +553,36 @@ class Device(object):
         """
         The version string representing the firmware version.
         """
-        response = self._block_for_response(pkt_type=protocol.TYPE_GETHOSTFIRMWARE)
-        return protocol.version_string(response.version)
+        return self._wait(self.host_firmware_async())
+
+    def host_firmware_async(self):
+        """
+        Fetch the host firmware version string.
+
+        :returns: Future -- The version string
+        """
+        return util.chain_future(
+                self._request(False, True, pkt_type=protocol.TYPE_GETHOSTFIRMWARE),
+                lambda response: protocol.version_string(response.version),
+        )
 
     @property
     def wifi_firmware(self):
         """
         The version string representing the firmware version.
         """
-        response = self._block_for_response(pkt_type=protocol.TYPE_GETWIFIFIRMWARE)
-        return protocol.version_string(response.version)
+        return self._wait(self.wifi_firmware_async())
+
+    def wifi_firmware_async(self):
+        """
+        Fetch the wifi firmware version string.
+
+        :returns: Future -- The version string
+        """
+        return util.chain_future(
+                self._request(False, True, pkt_type=protocol.TYPE_GETWIFIFIRMWARE),
+                lambda response: protocol.version_string(response.version),
+        )
 
     @property
     def id(self):
@@ -257,14 +607,45 @@ class Device(object):
         """
         The label for the device, setting this will change the label on the device.
         """
-        response = self._block_for_response(pkt_type=protocol.TYPE_GETLABEL)
-        return protocol.bytes_to_label(response.label)
+        return self._wait(self.label_async())
 
     @label.setter
     def label(self, label):
+        self.set_label(label)
+
+    def label_async(self, max_age=None):
+        """
+        Fetch the label for the device.
+
+        :param max_age: The oldest cached value in seconds to accept.
+        :returns: Future -- The label
+        """
+        return self.get_state_async(STATE_LABEL, max_age)
+
+    def set_label(self, label):
+        """
+        Change the label on the device.
+
+        :param label: The new label.
+        :returns: unicode -- The label set, once the device acknowledges
+        """
+        return self._wait(self.set_label_async(label))
+
+    def set_label_async(self, label):
+        """
+        Change the label on the device, without waiting.
+
+        :param label: The new label.
+        :returns: Future -- The label set, once the device acknowledges
+        """
         newlabel = bytearray(label.encode('utf-8')[0:protocol.LABEL_MAXLEN])
 
-        return self._block_for_ack(newlabel, pkt_type=protocol.TYPE_SETLABEL)
+        self._invalidate(STATE_LABEL)
+        return self._acknowledged(
+                self._request(True, False, newlabel, pkt_type=protocol.TYPE_SETLABEL),
+                STATE_LABEL,
+                newlabel.decode('utf-8', 'ignore'),
+        )
 
     def fade_power(self, power, duration=DEFAULT_DURATION):
         """
@@ -273,36 +654,111 @@ class Device(object):
         :param power: The new power state
         :param duration: The number of milliseconds to perform the transition over.
         """
+        return self._wait(self.fade_power_async(power, duration))
+
+    def fade_power_async(self, power, duration=DEFAULT_DURATION):
+        """
+        Transition to another power state slowly, without waiting.
+
+        :param power: The new power state
+        :param duration: The number of milliseconds to perform the transition over.
+        :returns: Future -- True once the device acknowledges
+        """
+        if power:
+            msgpower = protocol.UINT16_MAX
+        else:
+            msgpower = 0
+
+        self._invalidate(STATE_POWER)
+        return self._request(True, False, msgpower, duration, pkt_type=protocol.TYPE_LIGHT_SETPOWER)
+
+    def set_power(self, power, duration=DEFAULT_DURATION):
+        """
+        Transition to another power state, remembering it once the device
+        acknowledges the change.
+
+        :param power: The new power state
+        :param duration: The number of milliseconds to perform the transition over.
+        :returns: bool -- The power state set
+        """
+        return self._wait(self.set_power_async(power, duration))
+
+    def set_power_async(self, power, duration=DEFAULT_DURATION):
+        """
+        Transition to another power state, without waiting.
+
+        :param power: The new power state
+        :param duration: The number of milliseconds to perform the transition over.
+        :returns: Future -- The power state set, once the device acknowledges
+        """
         if power:
             msgpower = protocol.UINT16_MAX
         else:
             msgpower = 0
 
-        return self._block_for_ack(msgpower, duration, pkt_type=protocol.TYPE_LIGHT_SETPOWER)
+        self._invalidate(STATE_POWER)
+        return self._acknowledged(
+                self._request(True, False, msgpower, duration, pkt_type=protocol.TYPE_LIGHT_SETPOWER),
+                STATE_POWER,
+                msgpower > 0,
+        )
 
     def power_toggle(self, duration=DEFAULT_DURATION):
         """
         Transition to the opposite power state slowly.
 
         :param duration: The number of milliseconds to perform the transition over.
+        :returns: bool -- The power state set
         """
-        self.fade_power(not self.power, duration)
+        return self.set_power(not self.power, duration)
+
+    def stream_power(self, power, duration=0):
+        """
+        Change the power state without waiting for an acknowledgement. Writes
+        are sent at most STREAM_RATE times a second, and a write that hasn't
+        gone out yet is replaced by a newer one.
+
+        :param power: The new power state
+        :param duration: The number of milliseconds to perform the transition over.
+        """
+        if power:
+            msgpower = protocol.UINT16_MAX
+        else:
+            msgpower = 0
+
+        self._invalidate(STATE_POWER)
+        self._stream.write(
+                STATE_POWER,
+                self._send_packet,
+                msgpower,
+                duration,
+                ack_required=False,
+                res_required=False,
+                pkt_type=protocol.TYPE_LIGHT_SETPOWER,
+                priority=util.PRIORITY_BACKGROUND,
+                send_key=('stream', STATE_POWER),
+        )
 
     @property
     def power(self):
         """
         The power state of the device. Set to False to turn of and True to turn on.
         """
-        response = self._block_for_response(pkt_type=protocol.TYPE_GETPOWER)
-        if response.level > 0:
-            return True
-        else:
-            return False
+        return self._wait(self.power_async())
 
     @power.setter
     def power(self, power):
         self.fade_power(power)
 
+    def power_async(self, max_age=None):
+        """
+        Fetch the power state of the device.
+
+        :param max_age: The oldest cached value in seconds to accept.
+        :returns: Future -- True if the device is on
+        """
+        return self.get_state_async(STATE_POWER, max_age)
+
     def fade_color(self, newcolor, duration=DEFAULT_DURATION):
         """
         Transition the light to a new color.
@@ -310,8 +766,21 @@ class Device(object):
         :param newcolor: The HSBK tuple of the new color to transition to
         :param duration: The number of milliseconds to perform the transition over.
         """
+        return self._wait(self.fade_color_async(newcolor, duration))
+
+    def fade_color_async(self, newcolor, duration=DEFAULT_DURATION):
+        """
+        Transition the light to a new color, without waiting.
+
+        :param newcolor: The HSBK tuple of the new color to transition to
+        :param duration: The number of milliseconds to perform the transition over.
+        :returns: Future -- True once the device acknowledges
+        """
         colormsg = color.message_from_color(newcolor)
-        return self._block_for_ack(
+        self._invalidate(STATE_COLOR)
+        return self._request(
+                True,
+                False,
                 0,
                 colormsg.hue,
                 colormsg.saturation,
@@ -321,19 +790,115 @@ class Device(object):
                 pkt_type=protocol.TYPE_LIGHT_SETCOLOR
         )
 
+    def waveform(self, newcolor, waveform, period, cycles, skew_ratio=0.5, transient=True):
+        """
+        Run a waveform between the current color and another one.
+
+        :param newcolor: The HSBK tuple of the color to cycle to
+        :param waveform: The shape of the waveform, one of the protocol.WAVEFORM_* values.
+        :param period: The number of milliseconds each cycle takes.
+        :param cycles: The number of cycles to run, fractions are allowed.
+        :param skew_ratio: Between 0 and 1, how much of each cycle is spent at the new color.
+        :param transient: Return to the original color when the waveform ends.
+        """
+        return self._wait(self.waveform_async(newcolor, waveform, period, cycles, skew_ratio, transient))
+
+    def waveform_async(self, newcolor, waveform, period, cycles, skew_ratio=0.5, transient=True):
+        """
+        Run a waveform between the current color and another one, without
+        waiting. Takes the same arguments as waveform.
+
+        :returns: Future -- True once the device acknowledges
+        """
+        wave = Waveform(newcolor, waveform, period, cycles, skew_ratio, transient)
+        self._invalidate(STATE_COLOR)
+        return self._request(True, False, *waveform_args(wave), pkt_type=protocol.TYPE_LIGHT_SETWAVEFORM)
+
+    def stream_color(self, newcolor, duration=0):
+        """
+        Change the color without waiting for an acknowledgement, for
+        animations. Writes are sent at most STREAM_RATE times a second, and a
+        write that hasn't gone out yet is replaced by a newer one.
+
+        :param newcolor: The HSBK tuple of the new color to transition to
+        :param duration: The number of milliseconds to perform the transition over.
+        """
+        colormsg = color.message_from_color(newcolor)
+        self._invalidate(STATE_COLOR)
+        self._stream.write(
+                STATE_COLOR,
+                self._send_packet,
+                0,
+                colormsg.hue,
+                colormsg.saturation,
+                colormsg.brightness,
+                colormsg.kelvin,
+                duration,
+                ack_required=False,
+                res_required=False,
+                pkt_type=protocol.TYPE_LIGHT_SETCOLOR,
+                priority=util.PRIORITY_BACKGROUND,
+                send_key=('stream', STATE_COLOR),
+        )
+
     @property
     def color(self):
         """
         The color the device is currently set to. Set this value to change the
         color of the bulb all at once.
         """
-        response = self._block_for_response(pkt_type=protocol.TYPE_LIGHT_GET)
-        return color.color_from_message(response)
+        return self._wait(self.color_async())
 
     @color.setter
     def color(self, newcolor):
         self.fade_color(newcolor)
 
+    def set_color(self, newcolor, duration=DEFAULT_DURATION):
+        """
+        Transition the light to a new color, remembering it once the device
+        acknowledges the change.
+
+        :param newcolor: The HSBK tuple of the new color to transition to
+        :param duration: The number of milliseconds to perform the transition over.
+        :returns: HSBK -- The color set
+        """
+        return self._wait(self.set_color_async(newcolor, duration))
+
+    def set_color_async(self, newcolor, duration=DEFAULT_DURATION):
+        """
+        Transition the light to a new color, without waiting.
+
+        :param newcolor: The HSBK tuple of the new color to transition to
+        :param duration: The number of milliseconds to perform the transition over.
+        :returns: Future -- The color set, once the device acknowledges
+        """
+        colormsg = color.message_from_color(newcolor)
+        self._invalidate(STATE_COLOR)
+        return self._acknowledged(
+                self._request(
+                    True,
+                    False,
+                    0,
+                    colormsg.hue,
+                    colormsg.saturation,
+                    colormsg.brightness,
+                    colormsg.kelvin,
+                    duration,
+                    pkt_type=protocol.TYPE_LIGHT_SETCOLOR
+                ),
+                STATE_COLOR,
+                color.color_from_message(colormsg),
+        )
+
+    def color_async(self, max_age=None):
+        """
+        Fetch the color the device is currently set to.
+
+        :param max_age: The oldest cached value in seconds to accept.
+        :returns: Future -- The HSBK color
+        """
+        return self.get_state_async(STATE_COLOR, max_age)
+
     # Helpers to change the color on the bulb
     @property
     def hue(self):
@@ -1,13 +1,246 @@
-from device import DEFAULT_DURATION
+from collections import namedtuple
+from device import DEFAULT_DURATION, DEFAULT_TIMEOUT, REQUEST_SLACK, DeviceTimeoutError
+import concurrent.futures
+import threading
+import time
 
 import protocol
+import util
+
+DeviceResult = namedtuple('DeviceResult', ['device', 'success', 'timed_out', 'latency', 'value', 'error'])
+
+class GroupResult(object):
+    """
+    The outcome of an operation sent to every member of a group at once,
+    with a DeviceResult for each member.
+    """
+    def __init__(self, results):
+        self._results = results
+
+    def __repr__(self):
+        return "<GroupResult %d succeeded, %d timed out, %d failed>" % (len(self.succeeded), len(self.timed_out), len(self.failed) - len(self.timed_out))
+
+    def __iter__(self):
+        return iter(self._results)
+
+    def __len__(self):
+        return len(self._results)
+
+    def __getitem__(self, key):
+        return self._results[key]
+
+    @property
+    def success(self):
+        """
+        True if every member succeeded. Read Only.
+        """
+        return all(r.success for r in self._results)
+
+    @property
+    def succeeded(self):
+        """
+        The devices that succeeded. Read Only.
+        """
+        return [r.device for r in self._results if r.success]
+
+    @property
+    def failed(self):
+        """
+        The devices that timed out or failed. Read Only.
+        """
+        return [r.device for r in self._results if not r.success]
+
+    @property
+    def timed_out(self):
+        """
+        The devices that timed out. Read Only.
+        """
+        return [r.device for r in self._results if r.timed_out]
+
+def fan_out(devices, func, timeout=DEFAULT_TIMEOUT):
+    """
+    Start an asynchronous operation on many devices at once and wait for
+    them all. A device that fails doesn't stop the others.
+
+    :param devices: The devices to run the operation on.
+    :param func: Called with each device, returns a Future.
+    :param timeout: The number of seconds the operation is allowed on each device.
+    :returns: GroupResult -- The result for each device
+    """
+    started = time.time()
+    latencies = {}
+
+    def finished(device):
+        def done(f):
+            latencies[device.id] = time.time() - started
+        return done
+
+    futures = []
+    for device in devices:
+        try:
+            future = func(device)
+        except Exception as e:
+            future = util.failed_future(e)
+        future.add_done_callback(finished(device))
+        futures.append((device, future))
+
+    concurrent.futures.wait([f for d, f in futures], timeout + REQUEST_SLACK)
+
+    results = []
+    for device, future in futures:
+        if future.done():
+            error = future.exception()
+        else:
+            error = DeviceTimeoutError(device, timeout, 0)
+
+        results.append(DeviceResult(
+                device=device,
+                success=error is None,
+                timed_out=isinstance(error, DeviceTimeoutError),
+                latency=latencies.get(device.id),
+                value=future.result() if error is None else None,
+                error=error,
+        ))
+
+    return GroupResult(results)
+
+class MembershipIndex(object):
+    """
+    Tracks which group each device is in, both ways round, from the
+    STATEGROUP or STATELOCATION packets devices send. Any other value a
+    device reports, like its label or power, can be indexed the same way.
+    """
+    def __init__(self, ttl=None):
+        """
+        :param ttl: The number of seconds a device's group is trusted for before it is unknown again, None for ever.
+        """
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+        # group key -> set of device ids
+        self._members = {}
+
+        # device id -> group key
+        self._groups = {}
+
+        # device id -> when it last told us its group
+        self._updated = {}
+
+        # device ids we expect to hear about but haven't yet
+        self._unknown = set()
+
+    def update(self, device_id, group_key):
+        """
+        Record the group a device says it is in.
+
+        :param device_id: The id of the device.
+        :param group_key: The hashable group id.
+        :returns: bool -- True if the device changed group
+        """
+        with self._lock:
+            self._unknown.discard(device_id)
+            self._updated[device_id] = time.time()
+            old_key = self._groups.get(device_id)
+            if old_key == group_key:
+                return False
+
+            if old_key is not None:
+                self._members[old_key].discard(device_id)
+                if not self._members[old_key]:
+                    del self._members[old_key]
+
+            self._groups[device_id] = group_key
+            self._members.setdefault(group_key, set()).add(device_id)
+            return True
+
+    def expect(self, device_id):
+        """
+        Record a device we haven't heard the group of yet.
+
+        :param device_id: The id of the device.
+        """
+        with self._lock:
+            if device_id not in self._groups:
+                self._unknown.add(device_id)
+
+    def invalidate(self, device_id):
+        """
+        Forget the group of a device, for when it has been told to change it.
+        The device is expected again.
+
+        :param device_id: The id of the device.
+        """
+        with self._lock:
+            self._remove(device_id)
+            self._unknown.add(device_id)
+
+    def remove(self, device_id):
+        """
+        Forget a device.
+
+        :param device_id: The id of the device.
+        """
+        with self._lock:
+            self._remove(device_id)
+            self._unknown.discard(device_id)
+
+    def _remove(self, device_id):
+        self._updated.pop(device_id, None)
+        group_key = self._groups.pop(device_id, None)
+        if group_key is not None:
+            self._members[group_key].discard(device_id)
+            if not self._members[group_key]:
+                del self._members[group_key]
+
+    def members(self, group_key):
+        """
+        :param group_key: The hashable group id.
+        :returns: set -- The ids of the devices in the group
+        """
+        with self._lock:
+            return set(self._members.get(group_key, ()))
+
+    def group_of(self, device_id):
+        """
+        :param device_id: The id of the device.
+        :returns: The group key of the device, or None if we haven't heard
+        """
+        return self._groups.get(device_id)
+
+    def unknown(self):
+        """
+        :returns: set -- The ids of the expected devices we haven't heard the group of, or not within the ttl
+        """
+        with self._lock:
+            unknown = set(self._unknown)
+            if self._ttl is not None:
+                stale = time.time() - self._ttl
+                unknown.update(device_id for device_id, updated_at in self._updated.items() if updated_at < stale)
+            return unknown
+
+    def __contains__(self, device_id):
+        return device_id in self._groups
 
 class Group(object):
-    def __init__(self, group_id, client, member_func, label_func):
+    def __init__(self, group_id, client, member_func, label_func, label_ttl=None):
+        """
+        :param group_id: The id of the group.
+        :param client: The client the group's devices belong to.
+        :param member_func: Called with the group id, returns the devices in the group.
+        :param label_func: Called with a device, returns a Future for its group data.
+        :param label_ttl: The number of seconds the label is trusted for without news of it, None for ever.
+        """
         self._client = client
         self._id = group_id
         self._membership_func = member_func
         self._label_func = label_func
+        self._label_ttl = label_ttl
+
+        # The newest label any device has told us about
+        self._label = None
+        self._updated_at = None
+        self._label_seen = None
+        self._lock = threading.Lock()
 
     def __repr__(self):
         return "<Group Label:%s, %s>" % (repr(self.label), repr(self.members))
@@ -15,6 +248,24 @@ class Group(object):
     def __getitem__(self, key):
         return self.members[key]
 
+    def update(self, label, updated_at):
+        """
+        Record the label a device reported for the group, keeping it if it
+        is the newest seen.
+
+        :param label: The label as bytes.
+        :param updated_at: When the label was set, as reported by the device.
+        :returns: bool -- True if this is now the label of the group
+        """
+        with self._lock:
+            self._label_seen = time.time()
+            if self._updated_at is not None and updated_at < self._updated_at:
+                return False
+
+            self._label = label
+            self._updated_at = updated_at
+            return True
+
     @property
     def members(self):
         """
@@ -29,14 +280,40 @@ class Group(object):
         """
         return self._id
 
+    @property
+    def stale(self):
+        """
+        True if we don't know the label or haven't heard of it recently. Read Only.
+        """
+        if self._label is None:
+            return True
+        if self._label_ttl is None:
+            return False
+        return time.time() - self._label_seen > self._label_ttl
+
+    @property
+    def updated_at(self):
+        """
+        When the label was set, as reported by the devices. Read Only.
+        """
+        return self._updated_at
+
     @property
     def label(self):
         """
-        The Label on this group
+        The Label on this group, the newest one the members have reported
         """
-        labels = map(self._label_func, self.members)
-        labels.sort(key=lambda k:k.updated_at)
-        return protocol.bytes_to_label(labels[0].label)
+        if self.stale:
+            futures = [self._label_func(l) for l in self.members]
+            concurrent.futures.wait(futures, DEFAULT_TIMEOUT + REQUEST_SLACK)
+            for future in futures:
+                if future.done() and future.exception() is None:
+                    data = future.result()
+                    self.update(data.label, data.updated_at)
+
+        if self._label is None:
+            return None
+        return protocol.bytes_to_label(self._label)
 
     def fade_power(self, power, duration=DEFAULT_DURATION):
         """
@@ -44,9 +321,9 @@ class Group(object):
 
         :param power: The power state to transition every bulb in the group to.
         :param duration: The amount of time to perform the transition over.
+        :returns: GroupResult -- The outcome for each bulb
         """
-        for l in self.members:
-            l.fade_power(power, duration)
+        return fan_out(self.members, lambda l: l.fade_power_async(power, duration))
 
     def power_toggle(self, duration=DEFAULT_DURATION):
         """
@@ -54,9 +331,16 @@ class Group(object):
         Essentially it inverts the power state across the group.
 
         :param duration: The amount of time to perform the transition over.
+        :returns: GroupResult -- The outcome for each bulb, with the power state set
         """
-        for l in self.members:
-            l.power_toggle(duration)
+        def toggle(l):
+            return util.compose_future(
+                    l.power_async(),
+                    lambda power: l.set_power_async(not power, duration),
+            )
+
+        # Reading and then setting the power takes two requests
+        return fan_out(self.members, toggle, 2 * DEFAULT_TIMEOUT)
 
     def fade_color(self, newcolor, duration=DEFAULT_DURATION):
         """
@@ -64,7 +348,6 @@ class Group(object):
 
         :param power: The color to transition every bulb in the group to.
         :param duration: The amount of time to perform the transition over.
+        :returns: GroupResult -- The outcome for each bulb
         """
-        for l in self.members:
-            l.fade_color(newcolor, duration)
-
+        return fan_out(self.members, lambda l: l.fade_color_async(newcolor, duration))
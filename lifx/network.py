@@ -1,67 +1,384 @@
+import errno
+import os
 import protocol
 import socket
 import threading
+import time
 from binascii import hexlify
 from collections import namedtuple
+from Queue import Queue, Full, Empty
 
 DEFAULT_LIFX_PORT = 56700
+SEND_BUFFER_SIZE = 1500
+RECV_BUFFER_SIZE = 1500
+DEFAULT_RING_SIZE = 64
 
-PacketHandler = namedtuple('PacketHandler', ['handler', 'pktfilter'])
-default_filter = lambda x:True
+# Lets the listener drain the socket without blocking, where supported
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
 
-class NetworkTransport(object):
+# Where Linux reports per socket statistics, including drops
+PROC_NET_UDP = '/proc/net/udp'
+
+# What to do when a dispatch worker's queue is full
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_BLOCK = 'block'
+DEFAULT_QUEUE_SIZE = 1024
+
+# Matches any target or any packet type when registering a handler
+ANY = None
+
+HandlerHandle = namedtuple('HandlerHandle', ['handler_id', 'keys'])
+ListenerStats = namedtuple('ListenerStats', ['received_packets', 'rejected_packets', 'kernel_drops'])
+DispatchStats = namedtuple('DispatchStats', ['dispatched_packets', 'dropped_packets', 'mean_latency', 'max_latency'])
+
+class PacketDispatcher(object):
+    """
+    Routes received packets to handlers, looking them up by target and
+    packet type using only the packet header.
+    """
+    def __init__(self):
+        # Handlers indexed by (target, pkt_type), either of which may be ANY.
+        # Buckets are tuples that get replaced rather than changed, so the
+        # listener can read them without taking the lock.
+        self._packet_handlers = {}
+        self._handler_lock = threading.Lock()
+
+        self._current_handler_id = 0
+
+        # Sources we accept replies for, see register_source
+        self._sources = set()
+
+    def register_source(self, source):
+        """
+        Only accept packets sent in reply to this source. Packets for other
+        sources, such as replies to other LIFX controllers on the LAN, are
+        dropped before they are decoded. With no sources registered every
+        packet is accepted.
+
+        :param source: The source id from the frame header.
+        """
+        self._sources.add(source)
+
+    def register_packet_handler(self, handler, pkt_types=ANY, target=ANY):
+        """
+        Call a handler for each packet matching the target and packet types.
+
+        :param handler: Called with the host, port and packet.
+        :param pkt_types: The packet types the handler wants, or ANY.
+        :param target: The device id the packets must be from, or ANY.
+        :returns: HandlerHandle -- Pass this to unregister_packet_handler to remove the handler.
+        """
+        if pkt_types is ANY:
+            keys = ((target, ANY),)
+        else:
+            keys = tuple((target, pkt_type) for pkt_type in pkt_types)
+
+        with self._handler_lock:
+            handler_id = self._current_handler_id
+
+            # Save handler
+            for key in keys:
+                bucket = self._packet_handlers.get(key, ())
+                self._packet_handlers[key] = bucket + ((handler_id, handler),)
+
+            # move to next handler id
+            self._current_handler_id += 1
+
+        return HandlerHandle(handler_id, keys)
+
+    def unregister_packet_handler(self, handle):
+        """
+        Stop calling a handler.
+
+        :param handle: The handle returned when the handler was registered.
+        """
+        with self._handler_lock:
+            for key in handle.keys:
+                bucket = tuple(h for h in self._packet_handlers.get(key, ()) if h[0] != handle.handler_id)
+                if bucket:
+                    self._packet_handlers[key] = bucket
+                else:
+                    self._packet_handlers.pop(key, None)
+
+    def _match(self, data):
+        """
+        Finds the handlers that want a datagram using only the header.
+
+        :returns: tuple -- The packet header and the (handler_id, handler) pairs to call, which are empty if the packet should be dropped.
+        """
+        header = protocol.peek_header(data)
+        if header is None:
+            return None, ()
+
+        if self._sources and header.source not in self._sources:
+            return header, ()
+
+        # Look up the exact match and each of the wildcard slots
+        handlers = self._packet_handlers
+        target = header.target
+        pkt_type = header.pkt_type
+        return header, (
+                handlers.get((target, pkt_type), ())
+                + handlers.get((target, ANY), ())
+                + handlers.get((ANY, pkt_type), ())
+                + handlers.get((ANY, ANY), ())
+        )
+
+class NetworkTransport(PacketDispatcher):
     """The network transport manages the network sockets and the networking threads"""
-    def __init__(self, address='0.0.0.0', broadcast='255.255.255.255'):
+    def __init__(self, address='0.0.0.0', broadcast='255.255.255.255', rcvbuf=None,
+            workers=0, queue_size=DEFAULT_QUEUE_SIZE, overflow=OVERFLOW_DROP_OLDEST):
+        """
+        :param address: The address to receive packets on.
+        :param broadcast: The address to broadcast discovery packets to.
+        :param rcvbuf: The size in bytes of the kernel receive buffer, None leaves the system default.
+        :param workers: The number of threads that run packet handlers. With zero, handlers run on the listener thread.
+        :param queue_size: The number of packets each dispatch worker can have waiting.
+        :param overflow: OVERFLOW_DROP_OLDEST or OVERFLOW_BLOCK, what to do when a worker's queue is full.
+        """
         # Prepare a socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
         sock.bind((address, 0))
 
+        super(NetworkTransport, self).__init__()
+
         self._socket = sock
 
-        self._listener = ListenerThread(sock, self._handle_packet)
-        self._listener.start()
+        self._broadcast = broadcast
 
-        self._packet_handlers = {}
+        # Each sending thread gets its own buffer to build packets in
+        self._local = threading.local()
 
-        self._current_handler_id = 0
+        # Latency and counters for handlers run on the listener thread
+        self._dispatch_counters = DispatchCounters()
 
-        self._broadcast = broadcast
+        # Optionally hand packets off to a pool of dispatch workers
+        self._workers = [DispatchWorker(self._dispatch, queue_size, overflow, i) for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+        if self._workers:
+            self._listener = ListenerThread(sock, self._enqueue_packet)
+        else:
+            self._listener = ListenerThread(sock, self._handle_packet)
+        self._listener.start()
+        self._closed = False
+
+    def close(self):
+        """
+        Stop the listener and dispatch workers, then close the socket.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        self._listener.stop()
+        for worker in self._workers:
+            worker.stop()
+        self._socket.close()
 
     def _sendto(self, packet, address, port):
         return self._socket.sendto(packet, (address, port))
 
+    def _send_buffer(self):
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            buf = bytearray(SEND_BUFFER_SIZE)
+            self._local.buffer = buf
+            self._local.view = memoryview(buf)
+        return buf, self._local.view
+
     def send_packet(self, *args, **kwargs):
-        # Make the packet
-        packetargs = kwargs.copy()
-        del packetargs['address']
-        del packetargs['port']
-        packet = protocol.make_packet(*args, **packetargs)
+        target = kwargs['target']
 
-        # Send it
+        template = protocol.packet_template(
+                kwargs['source'],
+                kwargs['pkt_type'],
+                kwargs['ack_required'],
+                kwargs['res_required'],
+                target is None,
+        )
+
+        target = 0 if target is None else target
         address = kwargs['address']
         port = kwargs['port']
-        return self._sendto(packet, address, port)
+
+        # Packets too big for the reusable buffer get one of their own
+        if template.size > SEND_BUFFER_SIZE:
+            packet = template.build(target, kwargs['sequence'], *args)
+            return self._sendto(packet, address, port)
+
+        # Fill in the target, sequence and payload, then send it
+        buf, view = self._send_buffer()
+        size = template.pack_into(buf, target, kwargs['sequence'], *args)
+        return self._sendto(view[:size], address, port)
 
     def send_discovery(self, source, sequence):
         return self._sendto(protocol.discovery_packet(source, sequence), self._broadcast, DEFAULT_LIFX_PORT)
 
-    def register_packet_handler(self, handler, pktfilter=default_filter):
-        # Save handler
-        self._packet_handlers[self._current_handler_id] = PacketHandler(handler, pktfilter)
+    def send_broadcast(self, *args, **kwargs):
+        """
+        Send a tagged packet to every device on the broadcast address. Takes
+        the same arguments as send_packet, less the target and address.
+        """
+        kwargs['target'] = None
+        kwargs['address'] = self._broadcast
+        kwargs.setdefault('port', DEFAULT_LIFX_PORT)
+        return self.send_packet(*args, **kwargs)
+
+    def _dispatch(self, address, data, matched, received_at, counters):
+        packet = protocol.PacketView(data)
+        host, port = address
+        for handler_id, handler in matched:
+            handler(host, port, packet)
+
+        if received_at is not None:
+            counters.record(time.time() - received_at)
+
+    def _handle_packet(self, address, data, received_at=None):
+        """
+        Dispatches a datagram to the handlers that want it, on this thread.
+
+        :returns: bool -- False if the packet was rejected before decoding.
+        """
+        header, matched = self._match(data)
+        if not matched:
+            return False
 
-        # move to next handler id
-        self._current_handler_id += 1
+        self._dispatch(address, data, matched, received_at, self._dispatch_counters)
+        return True
 
-    def _handle_packet(self, address, packet):
-        for h in self._packet_handlers.values():
-            if h.pktfilter(packet):
-                host, port = address
-                h.handler(host, port, packet)
+    def _enqueue_packet(self, address, data, received_at=None):
+        """
+        Queues a datagram for a dispatch worker. Packets from one device
+        always go to the same worker so they are handled in order.
+
+        :returns: bool -- False if the packet was rejected before decoding.
+        """
+        header, matched = self._match(data)
+        if not matched:
+            return False
+
+        # The receive buffer gets reused, so the queue needs its own copy
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        worker = self._workers[header.target % len(self._workers)]
+        worker.put((address, data, matched, received_at))
+        return True
+
+    @property
+    def dispatch_stats(self):
+        """
+        How many packets were handed to handlers, how many were dropped
+        because a worker's queue overflowed, and the mean and maximum time in
+        seconds from the socket to the handlers finishing. Read Only.
+        """
+        counters = [self._dispatch_counters] + [w.counters for w in self._workers]
+        return DispatchCounters.combine(counters)
+
+    @property
+    def stats(self):
+        """
+        Packet counters from the listener thread. Read Only.
+        """
+        return self._listener.stats
+
+class DispatchCounters(object):
+    """Counts packets through a dispatcher and the time they took"""
+    def __init__(self):
+        self.dispatched_packets = 0
+        self.dropped_packets = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency):
+        self.dispatched_packets += 1
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+    @staticmethod
+    def combine(counters):
+        dispatched = sum(c.dispatched_packets for c in counters)
+        total = sum(c.total_latency for c in counters)
+        return DispatchStats(
+                dispatched_packets=dispatched,
+                dropped_packets=sum(c.dropped_packets for c in counters),
+                mean_latency=total / dispatched if dispatched else 0.0,
+                max_latency=max(c.max_latency for c in counters),
+        )
+
+class DispatchWorker(threading.Thread):
+    """
+    Runs packet handlers off the listener thread, so a slow handler doesn't
+    stop packets being received.
+    """
+    def __init__(self, dispatch, queue_size, overflow, index):
+        super(DispatchWorker, self).__init__(
+                name='DispatchWorker-%d' % index
+        )
+
+        # Exit on script exit
+        self.daemon = True
+
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK):
+            raise ValueError('Unknown overflow policy %r' % overflow)
+
+        self._dispatch = dispatch
+        self._queue = Queue(queue_size)
+        self._overflow = overflow
+        self.counters = DispatchCounters()
+
+    def put(self, item):
+        """
+        Queue a packet, applying the overflow policy if the queue is full.
+        """
+        if self._overflow == OVERFLOW_BLOCK:
+            self._queue.put(item)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    self._queue.get_nowait()
+                    self.counters.dropped_packets += 1
+                except Empty:
+                    pass
+
+    def stop(self):
+        """
+        Stop once the packets already queued have been handled.
+        """
+        if self._overflow == OVERFLOW_BLOCK:
+            self._queue.put(None)
+        else:
+            self.put(None)
+
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            address, data, matched, received_at = item
+            self._dispatch(address, data, matched, received_at, self.counters)
 
 class ListenerThread(threading.Thread):
-    """The Listener Thread grabs incoming packets, parses them and forwards them to the right listeners"""
-    def __init__(self, socket, handler):
+    """
+    The Listener Thread grabs incoming packets and forwards them to the
+    transport. Packets are received into a ring of preallocated buffers, and
+    everything waiting on the socket is drained on each wakeup.
+    """
+    def __init__(self, socket, handler, ring_size=DEFAULT_RING_SIZE):
         super(ListenerThread, self).__init__(
                 name='ListenerThread'
         )
@@ -73,8 +390,100 @@ class ListenerThread(threading.Thread):
         self._socket = socket
         self._handler = handler
 
+        # Receive buffers, reused once the handler has returned
+        self._buffers = [bytearray(RECV_BUFFER_SIZE) for i in range(ring_size)]
+        self._views = [memoryview(b) for b in self._buffers]
+
+        # Counters
+        self._received_packets = 0
+        self._rejected_packets = 0
+
+        self._running = True
+
+    @property
+    def stats(self):
+        """
+        How many packets were received, how many of those were rejected by
+        the fast path without being decoded, and how many the kernel dropped
+        because the receive buffer was full (None where the platform doesn't
+        tell us). Read Only.
+        """
+        return ListenerStats(
+                received_packets=self._received_packets,
+                rejected_packets=self._rejected_packets,
+                kernel_drops=self._kernel_drops(),
+        )
+
+    def _kernel_drops(self):
+        """
+        Finds our socket in /proc/net/udp by its inode and reads the drops column.
+        """
+        try:
+            inode = str(os.fstat(self._socket.fileno()).st_ino)
+            with open(PROC_NET_UDP) as f:
+                lines = f.readlines()[1:]
+        except (IOError, OSError, socket.error):
+            return None
+
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 12 and fields[9] == inode:
+                return int(fields[12])
+
+        return None
+
+    def _drain(self):
+        """
+        Blocks for one datagram, then takes whatever else is already waiting
+        until the socket is empty or the ring is full.
+
+        :returns: list -- (address, memoryview) for each datagram received.
+        """
+        received = []
+        flags = 0
+        for view in self._views:
+            try:
+                nbytes, addr = self._socket.recvfrom_into(view, 0, flags)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            received.append((addr, view[:nbytes]))
+
+            # Without a non-blocking flag we take one datagram per wakeup
+            if not MSG_DONTWAIT:
+                break
+            flags = MSG_DONTWAIT
+
+        return received
+
+    def stop(self, timeout=1.0):
+        """
+        Stop the thread, waking it from the socket with an empty datagram.
+
+        :param timeout: The most number of seconds to wait for it to stop.
+        """
+        self._running = False
+
+        host, port = self._socket.getsockname()
+        if host == '0.0.0.0':
+            host = '127.0.0.1'
+        try:
+            self._socket.sendto(b'', (host, port))
+        except socket.error:
+            pass
+
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
     def run(self):
         while True:
-            data, addr = self._socket.recvfrom(1500)
-            self._handler(addr, protocol.parse_packet(data))
-
+            batch = self._drain()
+            if not self._running:
+                return
+            received_at = time.time()
+            self._received_packets += len(batch)
+            for addr, data in batch:
+                if not self._handler(addr, data, received_at):
+                    self._rejected_packets += 1
@@ -3,6 +3,9 @@ from binascii import hexlify
 from collections import namedtuple
 from pkg_resources import iter_entry_points
 from datetime import datetime
+from struct import Struct
+
+from codec import compile_section
 
 UINT16_MAX = pow(2, 16) - 1
 LABEL_MAXLEN = 32
@@ -11,6 +14,9 @@ ENTRYPOINT = 'lifx.protocol'
 # Packet tuple
 lifx_packet = namedtuple('lifx_packet', ['frame_header', 'frame_address', 'protocol_header', 'payload'])
 
+# The header fields needed to route a packet, see peek_header()
+packet_header = namedtuple('packet_header', ['size', 'source', 'target', 'sequence', 'pkt_type'])
+
 # Header Descriptions
 frame_header = {
         'format': 'u16u2u1u1u12u32',
@@ -80,6 +86,7 @@ TYPE_ECHORESPONSE = 59
 # Light Messages
 TYPE_LIGHT_GET = 101
 TYPE_LIGHT_SETCOLOR = 102
+TYPE_LIGHT_SETWAVEFORM = 103
 TYPE_LIGHT_STATE = 107
 TYPE_LIGHT_GETPOWER = 116
 TYPE_LIGHT_SETPOWER = 117
@@ -106,6 +113,7 @@ CLASS_TYPE_SET = (
     TYPE_SETPOWER,
     TYPE_SETLABEL,
     TYPE_LIGHT_SETCOLOR,
+    TYPE_LIGHT_SETWAVEFORM,
     TYPE_LIGHT_SETPOWER,
 )
 
@@ -131,6 +139,36 @@ CLASS_TYPE_OTHER = (
     TYPE_ECHORESPONSE,
 )
 
+# The State message a device replies with when a response is required
+responses = {
+    TYPE_GETSERVICE: TYPE_STATESERVICE,
+    TYPE_GETHOSTINFO: TYPE_STATEHOSTINFO,
+    TYPE_GETHOSTFIRMWARE: TYPE_STATEHOSTFIRMWARE,
+    TYPE_GETWIFIINFO: TYPE_STATEWIFIINFO,
+    TYPE_GETWIFIFIRMWARE: TYPE_STATEWIFIFIRMWARE,
+    TYPE_GETPOWER: TYPE_STATEPOWER,
+    TYPE_SETPOWER: TYPE_STATEPOWER,
+    TYPE_GETLABEL: TYPE_STATELABEL,
+    TYPE_SETLABEL: TYPE_STATELABEL,
+    TYPE_GETVERSION: TYPE_STATEVERSION,
+    TYPE_GETINFO: TYPE_STATEINFO,
+    TYPE_GETLOCATION: TYPE_STATELOCATION,
+    TYPE_GETGROUP: TYPE_STATEGROUP,
+    TYPE_ECHOREQUEST: TYPE_ECHORESPONSE,
+    TYPE_LIGHT_GET: TYPE_LIGHT_STATE,
+    TYPE_LIGHT_SETCOLOR: TYPE_LIGHT_STATE,
+    TYPE_LIGHT_SETWAVEFORM: TYPE_LIGHT_STATE,
+    TYPE_LIGHT_GETPOWER: TYPE_LIGHT_STATEPOWER,
+    TYPE_LIGHT_SETPOWER: TYPE_LIGHT_STATEPOWER,
+}
+
+# Waveforms
+WAVEFORM_SAW = 0
+WAVEFORM_SINE = 1
+WAVEFORM_HALF_SINE = 2
+WAVEFORM_TRIANGLE = 3
+WAVEFORM_PULSE = 4
+
 # Service Types
 SERVICE_UDP = 1
 SERVICE_RESERVED1 = 2
@@ -353,6 +391,22 @@ messages = {
             'duration',
         ]),
     },
+    TYPE_LIGHT_SETWAVEFORM: {
+        'format': 'u8u8u16u16u16u16u32f32s16u8',
+        'byteswap': '1122224421',
+        'fields': namedtuple('payload_light_setwaveform', [
+            'reserved',
+            'transient',
+            'hue',
+            'saturation',
+            'brightness',
+            'kelvin',
+            'period',
+            'cycles',
+            'skew_ratio',
+            'waveform',
+        ]),
+    },
     TYPE_LIGHT_STATE: {
         'format': 'u16u16u16u16s16u16b256u64',
         'byteswap': '222222' + '1' * 32 + '8',
@@ -390,6 +444,25 @@ messages = {
     },
 }
 
+# Compile the headers and the built in messages
+for section in [frame_header, frame_address, protocol_header] + messages.values():
+    compile_section(section)
+
+FRAME_ADDRESS_OFFSET = frame_header['codec'].size
+PROTOCOL_HEADER_OFFSET = FRAME_ADDRESS_OFFSET + frame_address['codec'].size
+HEADER_SIZE = PROTOCOL_HEADER_OFFSET + protocol_header['codec'].size
+
+# Offsets of the fields that change between packets built from a template
+TARGET_OFFSET = FRAME_ADDRESS_OFFSET
+SEQUENCE_OFFSET = PROTOCOL_HEADER_OFFSET - 1
+_target_struct = Struct('<Q')
+
+# Reads size, source, target, sequence and type straight out of the headers
+_peek_struct = Struct('<H2xIQ6xxB8xH2x')
+
+# Cache of packet templates, see packet_template()
+_templates = {}
+
 def mac_string(device_id):
     """
     Converts a device id into a mac address hex string
@@ -462,73 +535,119 @@ def section_size(section):
     """
     return calcsize(section['format'])
 
+class PacketTemplate(object):
+    """
+    A preassembled header for packets that share a source, type and flags.
+    Only the target, sequence and payload change between packets built from
+    the same template, so those are all that get packed. Use
+    :func:`packet_template` to get a cached template rather than building
+    these directly.
+    """
+    def __init__(self, source, pkt_type, ack_required, res_required, tagged):
+        self._payload_codec = compile_section(messages[pkt_type])
+        self.size = HEADER_SIZE + self._payload_codec.size
+
+        header = bytearray(HEADER_SIZE)
+
+        frame_header['codec'].pack_into(
+                header,
+                0,
+                self.size,
+                0, # Origin is always zero
+                1 if tagged else 0,
+                1, # Addressable is always one
+                1024, # Only protocol 1024 so far
+                source,
+        )
+
+        frame_address['codec'].pack_into(
+                header,
+                FRAME_ADDRESS_OFFSET,
+                0, # Target, filled per packet
+                0, # Reserved
+                0, # Reserved
+                1 if ack_required else 0,
+                1 if res_required else 0,
+                0, # Sequence, filled per packet
+        )
+
+        protocol_header['codec'].pack_into(
+                header,
+                PROTOCOL_HEADER_OFFSET,
+                0, # Reserved
+                pkt_type,
+                0, # Reserved
+        )
+
+        self._header = bytes(header)
+
+    def pack_into(self, buf, target, sequence, *args):
+        """
+        Writes a whole packet to the start of a reusable buffer
+
+        :param buf: A writable buffer at least `size` bytes long
+        :param target: The device id to send to, zero for a tagged packet
+        :param sequence: The wrap around sequence number for the frame address header
+        :param \*args: Values for the payload in the order they are in the format
+        :returns: int -- The number of bytes written
+        """
+        buf[0:HEADER_SIZE] = self._header
+        _target_struct.pack_into(buf, TARGET_OFFSET, target)
+        buf[SEQUENCE_OFFSET] = sequence
+        self._payload_codec.pack_into(buf, HEADER_SIZE, *args)
+        return self.size
+
+    def build(self, target, sequence, *args):
+        """
+        Builds a packet into a new buffer
+
+        :param target: The device id to send to, zero for a tagged packet
+        :param sequence: The wrap around sequence number for the frame address header
+        :param \*args: Values for the payload in the order they are in the format
+        :returns: bytearray -- The packet represented as bytes
+        """
+        packet = bytearray(self.size)
+        self.pack_into(packet, target, sequence, *args)
+        return packet
+
+def packet_template(source, pkt_type, ack_required, res_required, tagged):
+    """
+    Gets the cached template for packets with these invariant header fields
+
+    :param source: The source field to put into the frame header
+    :param pkt_type: The type of packet being built
+    :param ack_required: Whether the device should acknowledge the packet
+    :param res_required: Whether the device should respond to the packet
+    :param tagged: True for packets addressed to every device
+    :returns: PacketTemplate -- The template for these header fields
+    """
+    key = (source, pkt_type, bool(ack_required), bool(res_required), bool(tagged))
+    template = _templates.get(key)
+    if template is None:
+        template = PacketTemplate(*key)
+        _templates[key] = template
+    return template
+
 def make_packet(*args, **kwargs):
     """
     Builds a packet from data supplied, required arguments depends on the packet type
     """
-
-    source = kwargs['source']
     target = kwargs['target']
-    ack_required = kwargs['ack_required']
-    res_required = kwargs['res_required']
-    sequence = kwargs['sequence']
-    pkt_type = kwargs['pkt_type']
-
-    # Frame header
-    packet_size = ( section_size(frame_header)
-           + section_size(frame_address)
-           + section_size(protocol_header)
-           + section_size(messages[pkt_type]) ) / 8
-
-    origin = 0 # Origin is always zero
-    tagged = 1 if target is None else 0
-    addressable = 1 # Addressable is always one
-    protocol = 1024 # Only protocol 1024 so far
-
-    frame_header_data = pack_section(
-            frame_header,
-            packet_size,
-            origin,
-            tagged,
-            addressable,
-            protocol,
-            source,
-    )
 
-    # Frame Address
-    target = 0 if target is None else target
-    res_required = 1 if res_required else 0
-    ack_required = 1 if ack_required else 0
-
-    frame_address_data = pack_section(
-            frame_address,
-            target,
-            0, # Reserved
-            0, # Reserved
-            ack_required,
-            res_required,
-            sequence,
+    template = packet_template(
+            kwargs['source'],
+            kwargs['pkt_type'],
+            kwargs['ack_required'],
+            kwargs['res_required'],
+            target is None,
     )
 
-    # Protocol Header
-    protocol_header_data = pack_section(
-            protocol_header,
-            0, # Reserved
-            pkt_type,
-            0, # Reserved
-    )
-
-    # Payload
-    payload_data = pack_section(
-            messages[pkt_type],
+    return template.build(
+            0 if target is None else target,
+            kwargs['sequence'],
             *args
     )
 
-    packet = frame_header_data + frame_address_data + protocol_header_data + payload_data
-
-    return packet
-
-
 def parse_packet(data):
     """
     Takes packet data as composes it into several namedtuple objects
@@ -536,54 +655,27 @@ def parse_packet(data):
     :param data: Byte data for the packet to be parsed
     :returns: namedtuple -- A named tuple representing the packet, with nested namedtuples for each header and the payload
     """
-    # Frame Header
-    frame_header_size = section_size(frame_header) / 8
-    frame_header_data = data[0:frame_header_size]
+    if len(data) < HEADER_SIZE:
+        return None
 
-    frame_header_struct = unpack_section(
-            frame_header,
-            frame_header_data
-    )
+    # Frame Header
+    frame_header_struct = frame_header['codec'].unpack_from(data, 0)
 
     if frame_header_struct.size != len(data):
         return None
 
     # Frame Address
-    frame_address_size = section_size(frame_address) / 8
-    frame_address_start = frame_header_size
-    frame_address_end = frame_header_size + frame_address_size
-    frame_address_data = data[frame_address_start:frame_address_end]
-    frame_address_struct = unpack_section(
-            frame_address,
-            frame_address_data
-    )
+    frame_address_struct = frame_address['codec'].unpack_from(data, FRAME_ADDRESS_OFFSET)
 
     # Protocol Header
-    protocol_header_size = section_size(protocol_header) / 8
-    protocol_header_start = frame_address_end
-    protocol_header_end = protocol_header_start + protocol_header_size
-    protocol_header_data = data[protocol_header_start:protocol_header_end]
-    protocol_header_struct = unpack_section(
-            protocol_header,
-            protocol_header_data
-    )
+    protocol_header_struct = protocol_header['codec'].unpack_from(data, PROTOCOL_HEADER_OFFSET)
 
     # Payload
-    payload_start = protocol_header_end
-    if protocol_header_struct.pkt_type in messages.keys():
-        payload = messages[protocol_header_struct.pkt_type]
-        payload_size = section_size(payload) / 8
-        payload_end = payload_start + payload_size
-        payload_data = data[payload_start:payload_end]
-        payload_struct = unpack_section(
-                payload,
-                payload_data
-        )
+    payload = messages.get(protocol_header_struct.pkt_type)
+    if payload is not None:
+        payload_struct = compile_section(payload).unpack_from(data, HEADER_SIZE)
     else:
-        payload_size = frame_header_struct.size - payload_start
-        payload_end = payload_start + payload_size
-        payload_struct = data[payload_start:payload_end]
-
+        payload_struct = data[HEADER_SIZE:frame_header_struct.size]
 
     return lifx_packet(
             frame_header_struct,
@@ -592,6 +684,126 @@ def parse_packet(data):
             payload_struct
     )
 
+class PacketView(object):
+    """
+    A lazily decoded packet backed by a memoryview of the receive buffer.
+    Each header and the payload is only decoded the first time it is used,
+    so packets nobody looks at cost next to nothing. The attributes match
+    those of :data:`lifx_packet`.
+
+    The view reads from the buffer it was made from, so anything that keeps
+    the packet after the handler returns should keep :meth:`materialize`
+    instead. Use :func:`view_packet` to make these.
+    """
+    __slots__ = ('_data', '_frame_header', '_frame_address', '_protocol_header', '_payload')
+
+    def __init__(self, data):
+        self._data = data if isinstance(data, memoryview) else memoryview(data)
+        self._frame_header = None
+        self._frame_address = None
+        self._protocol_header = None
+        self._payload = None
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+    @property
+    def frame_header(self):
+        if self._frame_header is None:
+            self._frame_header = frame_header['codec'].unpack_from(self._data, 0)
+        return self._frame_header
+
+    @property
+    def frame_address(self):
+        if self._frame_address is None:
+            self._frame_address = frame_address['codec'].unpack_from(self._data, FRAME_ADDRESS_OFFSET)
+        return self._frame_address
+
+    @property
+    def protocol_header(self):
+        if self._protocol_header is None:
+            self._protocol_header = protocol_header['codec'].unpack_from(self._data, PROTOCOL_HEADER_OFFSET)
+        return self._protocol_header
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            payload = messages.get(self.protocol_header.pkt_type)
+            if payload is not None:
+                self._payload = compile_section(payload).unpack_from(self._data, HEADER_SIZE)
+            else:
+                self._payload = self._data[HEADER_SIZE:].tobytes()
+        return self._payload
+
+    def materialize(self):
+        """
+        Decodes anything not yet decoded and copies the packet out of the
+        receive buffer.
+
+        :returns: namedtuple -- The same packet that :func:`parse_packet` would return
+        """
+        return lifx_packet(
+                self.frame_header,
+                self.frame_address,
+                self.protocol_header,
+                self.payload,
+        )
+
+def peek_header(data):
+    """
+    Reads just the fields needed to route a packet, at their fixed offsets,
+    without decoding the rest of the headers or the payload.
+
+    :param data: Byte data or a memoryview of the packet
+    :returns: namedtuple -- The size, source, target, sequence and pkt_type of the packet, or None if the size is wrong
+    """
+    if len(data) < HEADER_SIZE:
+        return None
+
+    header = packet_header(*_peek_struct.unpack_from(data, 0))
+
+    if header.size != len(data):
+        return None
+
+    return header
+
+def view_packet(data):
+    """
+    Wraps packet data in a :class:`PacketView` without decoding it
+
+    :param data: Byte data or a memoryview of the packet
+    :returns: PacketView -- A lazy view of the packet, or None if the size is wrong
+    """
+    if len(data) < HEADER_SIZE:
+        return None
+
+    view = PacketView(data)
+
+    if view.frame_header.size != len(data):
+        return None
+
+    return view
+
+def response_types(pkt_type, ack_required, res_required):
+    """
+    The packet types that answer a request
+
+    :param pkt_type: The type of packet sent
+    :param ack_required: Whether an acknowledgement was asked for
+    :param res_required: Whether a response was asked for
+    :returns: frozenset -- The packet types that count as a reply
+    """
+    types = set()
+    if ack_required:
+        types.add(TYPE_ACKNOWLEDGEMENT)
+    if res_required:
+        if pkt_type in responses:
+            types.add(responses[pkt_type])
+        else:
+            # We don't know this message, so any State message will do
+            types.update(CLASS_TYPE_STATE)
+    return frozenset(types)
+
 def discovery_packet(source, sequence):
     """
     Helper function for building a discovery packet easily
@@ -618,6 +830,10 @@ for entrypoint in iter_entry_points(ENTRYPOINT):
     CLASS_TYPE_STATE += getattr(protocol_module, 'CLASS_TYPE_STATE', ())
     CLASS_TYPE_OTHER += getattr(protocol_module, 'CLASS_TYPE_OTHER', ())
 
+    responses.update(getattr(protocol_module, 'responses', {}))
+
     new_messages = getattr(protocol_module, 'messages', {})
+    for section in new_messages.values():
+        compile_section(section)
     messages.update(new_messages)
 
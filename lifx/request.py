@@ -0,0 +1,540 @@
+"""
+Tracking for requests that are waiting on a reply from a device.
+"""
+from collections import deque, namedtuple
+import threading
+import time
+
+from protocol import TYPE_ACKNOWLEDGEMENT
+from util import PRIORITY_INTERACTIVE
+
+SEQUENCE_SPACE = pow(2, 8)
+DEFAULT_MAX_PENDING = 4096
+SWEEP_INTERVAL = 1.0
+
+# Retransmit timeout bounds in seconds, and the values from RFC 6298 used to
+# smooth the round trip time estimates
+INITIAL_RTO = 0.2
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+RTT_ALPHA = 1.0 / 8
+RTT_BETA = 1.0 / 4
+RTT_K = 4
+CLOCK_GRANULARITY = 0.001
+
+# Bounds on the number of requests in flight across every device
+INITIAL_WINDOW = 16
+MIN_WINDOW = 2
+MAX_WINDOW = 512
+
+WindowTuple = namedtuple('WindowTuple', ['window', 'threshold', 'in_flight', 'queued', 'losses'])
+
+class RttEstimator(object):
+    """
+    Keeps a smoothed round trip time and its variance for a device, and
+    works out how long to wait before retransmitting. Only replies to
+    requests sent once are sampled, since a reply to a retransmitted
+    request can't be matched to a particular send.
+    """
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self._min_rto = min_rto
+        self._max_rto = max_rto
+
+    def sample(self, rtt):
+        """
+        Update the estimates with a measured round trip.
+
+        :param rtt: The round trip time in seconds.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+
+        rto = self.srtt + max(CLOCK_GRANULARITY, RTT_K * self.rttvar)
+        self.rto = min(max(rto, self._min_rto), self._max_rto)
+
+    def timeout(self, attempt):
+        """
+        How long to wait for a reply, doubling for each retransmission.
+
+        :param attempt: The number of times the packet has been sent already, less one.
+        :returns: float -- The timeout in seconds
+        """
+        return min(self.rto * pow(2, attempt), self._max_rto)
+
+class PendingRequest(object):
+    """
+    A request waiting for a reply. The reply is stored on the request and
+    its event is set when a packet of an expected type arrives, or when the
+    request fails.
+    """
+    def __init__(self, target, sequence, pkt_types, expires):
+        self.target = target
+        self.sequence = sequence
+        self.pkt_types = pkt_types
+        self.expires = expires
+        self.response = None
+        self.error = None
+        self.timed_out = False
+        self.evicted = False
+        self.acknowledged = False
+        self.event = threading.Event()
+        self.received_at = None
+        self._callbacks = []
+
+        # Filled in by the Retransmitter
+        self.send = None
+        self.on_retransmit = None
+        self.rtt = None
+        self.deadline = None
+        self.retransmits = None
+        self.attempts = 0
+        self.sent_at = None
+        self.sending = False
+        self.priority = PRIORITY_INTERACTIVE
+        self.admitted = False
+        self.window_epoch = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        return (self.target, self.sequence)
+
+    @property
+    def done(self):
+        return self.event.is_set()
+
+    def _finish(self, response=None, error=None, timed_out=False):
+        """
+        Complete the request, only the first call has any effect.
+
+        :returns: bool -- True if this call completed the request.
+        """
+        with self._lock:
+            if self.event.is_set():
+                return False
+
+            self.response = response
+            self.error = error
+            self.timed_out = timed_out
+            if self._timer is not None:
+                self._timer.cancel()
+            self.event.set()
+            callbacks = self._callbacks
+
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self, callback):
+        """
+        Call a function with the request once it finishes, straight away if
+        it already has.
+
+        :param callback: Called with the request.
+        """
+        with self._lock:
+            if not self.event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def __repr__(self):
+        return '<PendingRequest target:%s sequence:%d>' % (self.target, self.sequence)
+
+class PendingTable(object):
+    """
+    Allocates sequence numbers per device and matches replies to the
+    requests waiting for them. Entries are removed when they complete, and
+    expired entries are swept out so the table stays bounded.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_PENDING):
+        """
+        :param max_entries: The most requests that can be waiting at once, the oldest are evicted beyond this.
+        """
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+        # (target, sequence) -> PendingRequest
+        self._entries = {}
+
+        # target -> the next sequence number to try
+        self._sequences = {}
+
+        self._next_sweep = time.time() + SWEEP_INTERVAL
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _allocate(self, target, dropped):
+        """
+        Picks the next sequence number for a target that no pending request
+        is using. Needs the lock.
+        """
+        start = self._sequences.get(target, 0)
+        for offset in range(0, SEQUENCE_SPACE):
+            sequence = (start + offset) % SEQUENCE_SPACE
+            if (target, sequence) not in self._entries:
+                self._sequences[target] = (sequence + 1) % SEQUENCE_SPACE
+                return sequence
+
+        # Every sequence is in use, so the oldest request for this target loses out
+        oldest = min((r for r in self._entries.values() if r.target == target), key=lambda r: r.expires)
+        self._evict(oldest, dropped)
+        self._sequences[target] = (oldest.sequence + 1) % SEQUENCE_SPACE
+        return oldest.sequence
+
+    def _evict(self, request, dropped, evicted=True):
+        """
+        Removes a request that is still waiting and adds it to dropped, to be
+        failed with _fail so nothing keeps resending with a sequence number
+        that is about to be reused. Needs the lock.
+        """
+        del self._entries[request.key]
+        request.evicted = evicted
+        dropped.append(request)
+
+    def _fail(self, dropped):
+        """
+        Fails the requests removed by _evict. Their done callbacks can start
+        new requests, so this must not hold the lock.
+        """
+        for request in dropped:
+            request._finish(timed_out=True)
+
+    def _sweep(self, now, dropped):
+        """
+        Removes requests that have expired. Needs the lock.
+        """
+        for request in self._entries.values():
+            if request.expires < now:
+                self._evict(request, dropped, False)
+        self._next_sweep = now + SWEEP_INTERVAL
+
+    def next_sequence(self, target):
+        """
+        Get a sequence number for a packet we don't track replies for.
+
+        :param target: The device id the packet is for, None for broadcasts.
+        :returns: int -- The sequence number
+        """
+        dropped = []
+        with self._lock:
+            sequence = self._allocate(target, dropped)
+
+        self._fail(dropped)
+        return sequence
+
+    def add(self, target, pkt_types, timeout):
+        """
+        Start tracking a request, allocating its sequence number.
+
+        :param target: The device id the request is for.
+        :param pkt_types: The packet types that answer the request.
+        :param timeout: The number of seconds before the entry may be evicted.
+        :returns: PendingRequest -- The new request
+        """
+        now = time.time()
+        dropped = []
+        with self._lock:
+            if now > self._next_sweep or len(self._entries) >= self._max_entries:
+                self._sweep(now, dropped)
+
+            # Still full of live requests, so drop the one closest to expiring
+            if len(self._entries) >= self._max_entries:
+                self._evict(min(self._entries.values(), key=lambda r: r.expires), dropped)
+
+            request = PendingRequest(target, self._allocate(target, dropped), frozenset(pkt_types), now + timeout)
+            self._entries[request.key] = request
+
+        self._fail(dropped)
+        return request
+
+    def remove(self, request):
+        """
+        Stop tracking a request.
+
+        :param request: The request to remove.
+        """
+        with self._lock:
+            if self._entries.get(request.key) is request:
+                del self._entries[request.key]
+
+    def complete(self, packet):
+        """
+        Hands a packet to the request waiting for it, if the packet is of a
+        type that answers the request. A request waiting for both an
+        acknowledgement and a response stays in the table until the response
+        arrives, which also stands in for a lost acknowledgement.
+
+        :param packet: The received packet.
+        :returns: PendingRequest -- The request that was completed, or None.
+        """
+        key = (packet.frame_address.target, packet.frame_address.sequence)
+        pkt_type = packet.protocol_header.pkt_type
+        with self._lock:
+            request = self._entries.get(key)
+            if request is None or pkt_type not in request.pkt_types:
+                return None
+
+            if pkt_type == TYPE_ACKNOWLEDGEMENT:
+                request.acknowledged = True
+                if len(request.pkt_types) > 1:
+                    return None
+            del self._entries[key]
+
+        # The packet outlives the receive buffer
+        request.received_at = time.time()
+        request._finish(response=packet.materialize())
+        return request
+
+class CongestionWindow(object):
+    """
+    Limits the number of requests in flight across every device, growing
+    the limit while replies come back and halving it when packets are lost
+    (AIMD), so a busy access point isn't buried in retransmissions.
+    Requests over the limit wait for a slot in order within each priority
+    class, interactive ones first.
+    """
+    def __init__(self, initial=INITIAL_WINDOW, minimum=MIN_WINDOW, maximum=MAX_WINDOW, priorities=2):
+        """
+        :param initial: The number of requests allowed in flight to start with.
+        :param minimum: The fewest requests the window shrinks to.
+        :param maximum: The most requests the window grows to.
+        :param priorities: The number of priority classes.
+        """
+        self._minimum = minimum
+        self._maximum = maximum
+        self._lock = threading.Lock()
+        self._queues = [deque() for i in range(0, priorities)]
+
+        self.size = float(initial)
+        self.threshold = float(maximum)
+        self.in_flight = 0
+        self.losses = 0
+
+        # Bumped on each decrease, so one burst of loss only halves it once
+        self._epoch = 0
+
+    @property
+    def stats(self):
+        """
+        The window size, the slow start threshold, the requests in flight
+        and waiting, and the number of times the window was cut.
+        """
+        return WindowTuple(
+                window=int(self.size),
+                threshold=int(self.threshold),
+                in_flight=self.in_flight,
+                queued=sum(len(queue) for queue in self._queues),
+                losses=self.losses,
+        )
+
+    def _take(self, request):
+        """
+        Give a request a slot. Needs the lock.
+        """
+        self.in_flight += 1
+        request.admitted = True
+        request.window_epoch = self._epoch
+
+    def admit(self, request):
+        """
+        Give a request a slot if there is one, otherwise queue it behind the
+        requests of its priority class.
+
+        :param request: The request about to be sent.
+        :returns: bool -- True if it can be sent now
+        """
+        with self._lock:
+            if self.in_flight < int(self.size) and not any(self._queues):
+                self._take(request)
+                return True
+            self._queues[request.priority].append(request)
+            return False
+
+    def release(self, request):
+        """
+        Free the slot of a finished request.
+
+        :param request: The finished request.
+        :returns: list -- The queued requests that can now be sent
+        """
+        ready = []
+        with self._lock:
+            if request.admitted:
+                self.in_flight -= 1
+
+            for queue in self._queues:
+                while queue and self.in_flight < int(self.size):
+                    waiting = queue.popleft()
+                    if not waiting.done:
+                        self._take(waiting)
+                        ready.append(waiting)
+        return ready
+
+    def on_success(self):
+        """
+        A reply came back, grow the window. It doubles each round trip until
+        it reaches the threshold, then grows by one.
+        """
+        with self._lock:
+            if self.size < self.threshold:
+                self.size += 1
+            else:
+                self.size += 1 / self.size
+            self.size = min(self.size, self._maximum)
+
+    def on_loss(self, request):
+        """
+        A request had to be resent or timed out, halve the window unless it
+        was already cut since the request was sent.
+
+        :param request: The request that saw the loss.
+        """
+        with self._lock:
+            if request.window_epoch != self._epoch:
+                return
+
+            self.losses += 1
+            self.size = max(self.size / 2, self._minimum)
+            self.threshold = self.size
+            self._epoch += 1
+
+class Retransmitter(object):
+    """
+    Resends every outstanding request from one scheduler thread until it is
+    answered or runs out of attempts, instead of blocking a thread for each.
+    """
+    def __init__(self, pending, scheduler, window=None):
+        """
+        :param pending: The PendingTable replies are matched in.
+        :param scheduler: The util.Scheduler that runs the resends.
+        :param window: The CongestionWindow that limits requests in flight, None for no limit.
+        """
+        self._pending = pending
+        self._scheduler = scheduler
+        self._window = window
+
+    def submit(self, target, pkt_types, send, timeout, retransmits, on_retransmit=None, rtt=None,
+            priority=PRIORITY_INTERACTIVE):
+        """
+        Send a request and keep resending it until it is answered.
+
+        :param target: The device id the request is for.
+        :param pkt_types: The packet types that answer the request.
+        :param send: Called with the sequence number to send the packet, and a function to call with None, or the error, once it has gone out.
+        :param timeout: The number of seconds to wait for a reply in total.
+        :param retransmits: The most times to send the packet.
+        :param on_retransmit: Called each time the packet has to be sent again.
+        :param rtt: The RttEstimator for the device, which sets the time between retransmits.
+        :param priority: The priority class it waits in for a slot in the window.
+        :returns: PendingRequest -- Wait on its event for the reply
+        """
+        request = self._pending.add(target, pkt_types, timeout)
+        request.deadline = time.time() + timeout
+        request.retransmits = retransmits
+        request.send = send
+        request.on_retransmit = on_retransmit
+        request.rtt = rtt if rtt is not None else RttEstimator()
+        request.priority = priority
+        request.add_done_callback(self._finished)
+
+        if self._window is None or self._window.admit(request):
+            self._transmit(request)
+        else:
+            # Give up on it if no slot frees up in time
+            with request._lock:
+                if not request.done:
+                    request._timer = self._scheduler.call_at(request.deadline, self._expire, request)
+        return request
+
+    def _finished(self, request):
+        # Karn's algorithm, a reply to a resent packet could be for any send
+        if request.response is not None and request.attempts == 1:
+            request.rtt.sample(request.received_at - request.sent_at)
+
+        if self._window is None:
+            return
+
+        if request.admitted:
+            if request.response is not None:
+                self._window.on_success()
+            elif request.timed_out and not request.evicted and not request.sending:
+                # A packet still waiting in the send queue wasn't lost
+                self._window.on_loss(request)
+
+        for waiting in self._window.release(request):
+            self._scheduler.call_later(0, self._admitted, waiting)
+
+    def _admitted(self, request):
+        with request._lock:
+            if request._timer is not None:
+                request._timer.cancel()
+        self._transmit(request)
+
+    def _expire(self, request):
+        if not request.admitted:
+            self._pending.remove(request)
+            request._finish(timed_out=True)
+
+    def _transmit(self, request):
+        if request.done:
+            return
+
+        now = time.time()
+        if now >= request.deadline:
+            self._pending.remove(request)
+            request._finish(timed_out=True)
+            return
+
+        # Out of attempts, but a late reply is still welcome until the deadline
+        if request.attempts >= request.retransmits:
+            self._arm(request, request.deadline - now)
+            return
+
+        if request.attempts > 0:
+            if self._window is not None:
+                self._window.on_loss(request)
+            if request.on_retransmit is not None:
+                request.on_retransmit()
+        request.attempts += 1
+
+        # The retransmit timer starts once the packet has really gone out,
+        # until then only the deadline applies
+        request.sending = True
+        self._arm(request, request.deadline - now)
+
+        try:
+            request.send(request.sequence, lambda error=None: self._sent(request, error))
+        except Exception as e:
+            self._pending.remove(request)
+            request._finish(error=e)
+
+    def _sent(self, request, error):
+        request.sending = False
+        if error is not None:
+            self._pending.remove(request)
+            request._finish(error=error)
+            return
+
+        now = time.time()
+        request.sent_at = now
+        self._arm(request, min(request.rtt.timeout(request.attempts - 1), request.deadline - now))
+
+    def _arm(self, request, delay):
+        """
+        Replace the request's timer with one that calls _transmit after the delay.
+        """
+        with request._lock:
+            if request._timer is not None:
+                request._timer.cancel()
+            if not request.done:
+                request._timer = self._scheduler.call_later(delay, self._transmit, request)
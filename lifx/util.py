@@ -1,10 +1,32 @@
 """
-@author: Brian Curtin
-http://code.activestate.com/lists/python-ideas/8982/
+Timing and threading helpers for the client.
+
+* RepeatTimer, and the Scheduler that runs periodic jobs and timed calls
+  from one thread, with JobStats for each job
+* LatestWriter, TokenBucket and SendQueue, which pace what is sent to a device
+* Helpers for making and chaining concurrent.futures Futures
 """
+import collections
+import heapq
+import itertools
+import logging
+import random
 import threading
+import time
+
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
 
 class RepeatTimer(threading.Thread):
+    """
+    Calls a function every interval from its own thread. Prefer
+    :meth:`Scheduler.call_every`, which runs any number of periodic calls
+    from one thread.
+
+    @author: Brian Curtin
+    http://code.activestate.com/lists/python-ideas/8982/
+    """
     def __init__(self, interval, callable, *args, **kwargs):
         threading.Thread.__init__(self)
         self.interval = interval
@@ -12,14 +34,503 @@ class RepeatTimer(threading.Thread):
         self.args = args
         self.kwargs = kwargs
         self.event = threading.Event()
-        self.event.set()
 
     def run(self):
-        while self.event.is_set():
-            t = threading.Timer(self.interval, self.callable,
-                                self.args, self.kwargs)
-            t.start()
-            t.join()
+        while not self.event.wait(self.interval):
+            self.callable(*self.args, **self.kwargs)
+
+    def cancel(self):
+        self.event.set()
+
+JobStats = collections.namedtuple('JobStats', ['runs', 'failures', 'total_time', 'mean_time', 'max_time', 'last_run'])
+
+class ScheduledCall(object):
+    """A call waiting in a :class:`Scheduler`, which can be cancelled"""
+    def __init__(self, when, func, args, name=None, interval=None, jitter=0):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.name = name or getattr(func, '__name__', repr(func))
+        self.interval = interval
+        self.jitter = jitter
+        self.cancelled = False
 
     def cancel(self):
-        self.event.clear()
+        self.cancelled = True
+
+class JobCounters(object):
+    """Run times of the calls with one name, see :class:`JobStats`"""
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_run = None
+
+    def record(self, started, run_time, failed):
+        self.runs += 1
+        if failed:
+            self.failures += 1
+        self.total_time += run_time
+        self.max_time = max(self.max_time, run_time)
+        self.last_run = started
+
+    @property
+    def stats(self):
+        return JobStats(
+                runs=self.runs,
+                failures=self.failures,
+                total_time=self.total_time,
+                mean_time=self.total_time / self.runs if self.runs else None,
+                max_time=self.max_time,
+                last_run=self.last_run,
+        )
+
+class Scheduler(threading.Thread):
+    """
+    Runs calls at set times from a single thread, using a heap ordered by
+    the time each call is due. The time each call takes is recorded under
+    its name, see :attr:`stats`.
+    """
+    def __init__(self, name='Scheduler'):
+        super(Scheduler, self).__init__(name=name)
+
+        # Exit on script exit
+        self.daemon = True
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._running = True
+
+        # call name -> JobCounters
+        self._counters = collections.defaultdict(JobCounters)
+        self._counters_lock = threading.Lock()
+
+    def _push(self, call):
+        with self._condition:
+            heapq.heappush(self._heap, (call.when, next(self._counter), call))
+
+            # Wake the thread if this is now the first call due
+            if self._heap[0][2] is call:
+                self._condition.notify()
+        return call
+
+    def call_at(self, when, func, *args):
+        """
+        Run a call at a set time.
+
+        :param when: The time.time() the call is due at.
+        :param func: The function to call.
+        :param \*args: Arguments for the function.
+        :returns: ScheduledCall -- A handle that can cancel the call
+        """
+        return self._push(ScheduledCall(when, func, args))
+
+    def call_later(self, delay, func, *args):
+        """
+        Run a call after a delay.
+
+        :param delay: The number of seconds to wait.
+        :param func: The function to call.
+        :param \*args: Arguments for the function.
+        :returns: ScheduledCall -- A handle that can cancel the call
+        """
+        return self.call_at(time.time() + delay, func, *args)
+
+    def call_every(self, interval, func, *args, **kwargs):
+        """
+        Run a call repeatedly, waiting the interval after each run finishes.
+        The first run is one interval from now.
+
+        :param interval: The number of seconds between runs.
+        :param func: The function to call.
+        :param \*args: Arguments for the function.
+        :param jitter: The most number of seconds to add at random to each wait, so periodic work spreads out.
+        :param name: The name the run times are recorded under, defaults to the function's name.
+        :returns: ScheduledCall -- A handle that cancels all the remaining runs
+        """
+        jitter = kwargs.pop('jitter', 0)
+        name = kwargs.pop('name', None)
+
+        call = ScheduledCall(None, func, args, name, interval, jitter)
+        call.when = self._next_run(call)
+        return self._push(call)
+
+    def _next_run(self, call):
+        return time.time() + call.interval + random.uniform(0, call.jitter)
+
+    def stop(self, timeout=None):
+        """
+        Stop the scheduler thread, calls that haven't run yet are dropped. A
+        call that is running is waited for, unless it is the one stopping.
+
+        :param timeout: The most number of seconds to wait for a running call, None for no limit.
+        """
+        with self._condition:
+            self._running = False
+            del self._heap[:]
+            self._condition.notify()
+
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    @property
+    def stats(self):
+        """
+        The run times of the calls, as JobStats keyed by call name. Read Only.
+        """
+        with self._counters_lock:
+            return dict((name, counters.stats) for name, counters in self._counters.items())
+
+    def _next_call(self):
+        with self._condition:
+            while self._running:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                when, count, call = heapq.heappop(self._heap)
+                if not call.cancelled:
+                    return call
+        return None
+
+    def run(self):
+        while True:
+            call = self._next_call()
+            if call is None:
+                return
+
+            started = time.time()
+            failed = False
+            try:
+                call.func(*call.args)
+            except Exception:
+                failed = True
+                logger.exception('Scheduled call %r failed', call.func)
+
+            with self._counters_lock:
+                self._counters[call.name].record(started, time.time() - started, failed)
+
+            # Periodic calls go back on the heap until they are cancelled
+            if call.interval is not None and not call.cancelled:
+                call.when = self._next_run(call)
+                with self._condition:
+                    if self._running:
+                        heapq.heappush(self._heap, (call.when, next(self._counter), call))
+
+class LatestWriter(object):
+    """
+    Sends writes no faster than a set rate from a :class:`Scheduler`. A
+    write that is still waiting to go out is replaced by a newer write with
+    the same key, so only the latest value is ever sent.
+    """
+    def __init__(self, scheduler, interval):
+        """
+        :param scheduler: The Scheduler that sends the writes.
+        :param interval: The least number of seconds between writes.
+        """
+        self._scheduler = scheduler
+        self._interval = interval
+        self._lock = threading.Lock()
+
+        # key -> (func, args, kwargs), oldest first
+        self._pending = collections.OrderedDict()
+        self._call = None
+        self._last_sent = 0
+
+        self.written = 0
+        self.sent = 0
+        self.superseded = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def write(self, key, func, *args, **kwargs):
+        """
+        Queue a write, replacing any unsent write with the same key.
+
+        :param key: Writes with equal keys replace each other.
+        :param func: The function that sends the write.
+        :param \*args: Arguments for the function.
+        """
+        with self._lock:
+            self.written += 1
+
+            # Nothing waiting and the rate allows it, so send it straight away
+            now = time.time()
+            send_now = self._call is None and now >= self._last_sent + self._interval
+            if send_now:
+                self._last_sent = now
+                self.sent += 1
+            else:
+                if key in self._pending:
+                    self.superseded += 1
+                self._pending[key] = (func, args, kwargs)
+
+                if self._call is None:
+                    self._call = self._scheduler.call_at(self._last_sent + self._interval, self._flush)
+
+        if send_now:
+            func(*args, **kwargs)
+
+    def _flush(self):
+        with self._lock:
+            key, (func, args, kwargs) = self._pending.popitem(last=False)
+            self._last_sent = time.time()
+            self.sent += 1
+
+            if self._pending:
+                self._call = self._scheduler.call_at(self._last_sent + self._interval, self._flush)
+            else:
+                self._call = None
+
+        func(*args, **kwargs)
+
+# Priority classes for a SendQueue, lower goes first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+class TokenBucket(object):
+    """
+    Allows a steady rate of events with bursts up to a set size.
+    """
+    def __init__(self, rate, burst):
+        """
+        :param rate: The number of tokens added each second.
+        :param burst: The most tokens that can be saved up.
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def consume(self, now=None):
+        """
+        Take a token if there is one.
+
+        :param now: The current time.time().
+        :returns: bool -- True if a token was taken
+        """
+        self._refill(now if now is not None else time.time())
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def delay(self, now=None):
+        """
+        How long until there is a token to take.
+
+        :param now: The current time.time().
+        :returns: float -- The number of seconds to wait
+        """
+        self._refill(now if now is not None else time.time())
+        return max(0, (1 - self._tokens) / self.rate)
+
+class SendQueue(object):
+    """
+    Sends calls no faster than a TokenBucket allows, queueing the rest by
+    priority and sending them from a :class:`Scheduler` as tokens come in.
+    """
+    def __init__(self, scheduler, bucket, priorities=2):
+        """
+        :param scheduler: The Scheduler that sends queued calls.
+        :param bucket: The TokenBucket that limits the rate, None for no limit.
+        :param priorities: The number of priority classes.
+        """
+        self._scheduler = scheduler
+        self._bucket = bucket
+        self._queues = [collections.deque() for i in range(0, priorities)]
+        self._lock = threading.Lock()
+        self._call = None
+
+        # key -> queued entry, for calls that replace each other
+        self._keyed = {}
+
+        self.sent = 0
+        self.replaced = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self):
+        """
+        The number of calls waiting in each priority class.
+        """
+        return tuple(len(queue) for queue in self._queues)
+
+    @property
+    def mean_wait(self):
+        """
+        The mean number of seconds calls have waited to be sent.
+        """
+        if self.sent == 0:
+            return 0.0
+        return self.total_wait / self.sent
+
+    def submit(self, priority, func, *args, **kwargs):
+        """
+        Send a call now if the rate allows, otherwise queue it.
+
+        :param priority: The priority class, PRIORITY_INTERACTIVE goes before PRIORITY_BACKGROUND.
+        :param func: The function that sends.
+        :param \*args: Arguments for the function.
+        :param on_sent: Called with None as the call goes out, and again with the exception if it raises.
+        :param key: A queued call with the same key is replaced by this one instead of both being sent.
+        """
+        on_sent = kwargs.pop('on_sent', None)
+        key = kwargs.pop('key', None)
+
+        if self._bucket is None:
+            self.sent += 1
+            return self._run(func, args, kwargs, on_sent)
+
+        with self._lock:
+            now = time.time()
+            send_now = self._call is None and self._bucket.consume(now)
+            if send_now:
+                self.sent += 1
+            elif key is not None and key in self._keyed:
+                # Only the newest copy goes out, in the place of the first
+                self._keyed[key][1:5] = [func, args, kwargs, on_sent]
+                self.replaced += 1
+            else:
+                entry = [now, func, args, kwargs, on_sent, key]
+                self._queues[priority].append(entry)
+                if key is not None:
+                    self._keyed[key] = entry
+                if self._call is None:
+                    self._call = self._scheduler.call_later(self._bucket.delay(now), self._drain)
+
+        if send_now:
+            return self._run(func, args, kwargs, on_sent)
+
+    def _run(self, func, args, kwargs, on_sent):
+        """
+        Make a call, telling on_sent first so that it knows the time before
+        any reply can arrive. Without on_sent, errors are raised to the caller.
+        """
+        if on_sent is None:
+            return func(*args, **kwargs)
+
+        on_sent(None)
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            on_sent(e)
+
+    def _drain(self):
+        ready = []
+        with self._lock:
+            now = time.time()
+            for queue in self._queues:
+                while queue and self._bucket.consume(now):
+                    queued_at, func, args, kwargs, on_sent, key = queue.popleft()
+                    if key is not None:
+                        del self._keyed[key]
+                    wait = now - queued_at
+                    self.sent += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                    ready.append((func, args, kwargs, on_sent))
+
+            if any(self._queues):
+                self._call = self._scheduler.call_later(self._bucket.delay(now), self._drain)
+            else:
+                self._call = None
+
+        for func, args, kwargs, on_sent in ready:
+            try:
+                self._run(func, args, kwargs, on_sent)
+            except Exception:
+                logger.exception('Queued send %r failed', func)
+
+def resolved_future(result=None):
+    """
+    A future that has already finished with a result.
+
+    :param result: The result of the future.
+    :returns: Future -- The finished future
+    """
+    future = Future()
+    future.set_result(result)
+    return future
+
+def chain_future(future, func):
+    """
+    Transform the result of a future once it is ready, passing any exception
+    straight through.
+
+    :param future: The future to transform.
+    :param func: Called with the result of the future.
+    :returns: Future -- A future for the return value of func
+    """
+    chained = Future()
+
+    def done(f):
+        error = f.exception()
+        if error is not None:
+            chained.set_exception(error)
+            return
+
+        try:
+            chained.set_result(func(f.result()))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+def failed_future(error):
+    """
+    A future that has already finished with an exception.
+
+    :param error: The exception.
+    :returns: Future -- The finished future
+    """
+    future = Future()
+    future.set_exception(error)
+    return future
+
+def compose_future(future, func):
+    """
+    Start another asynchronous step once a future is ready, passing any
+    exception straight through.
+
+    :param future: The future to wait for.
+    :param func: Called with the result of the future, returns another future.
+    :returns: Future -- A future for the result of the future func returns
+    """
+    composed = Future()
+
+    def second(f):
+        error = f.exception()
+        if error is None:
+            composed.set_result(f.result())
+        else:
+            composed.set_exception(error)
+
+    def first(f):
+        error = f.exception()
+        if error is not None:
+            composed.set_exception(error)
+            return
+
+        try:
+            func(f.result()).add_done_callback(second)
+        except Exception as e:
+            composed.set_exception(e)
+
+    future.add_done_callback(first)
+    return composed
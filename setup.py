@@ -11,7 +11,11 @@ setup(
     # Dependencies
     install_requires=[
         'bitstruct==1.0.0',
+        'futures',
     ],
+    extras_require={
+        'asyncio': ['trollius'],
+    },
 
     # Tests
     test_suite="nose.collector",
@@ -0,0 +1,119 @@
+"""
+A pretend bulb on the loopback interface, for testing the client and device
+against something that speaks the protocol.
+"""
+import socket
+import threading
+import time
+
+import lifx.protocol
+
+class FakeBulb(threading.Thread):
+    def __init__(self, device_id, label='Fake', group=None, location=None):
+        super(FakeBulb, self).__init__(name='FakeBulb')
+        self.daemon = True
+
+        self.device_id = device_id
+        self.label = bytearray(label.ljust(32, '\x00'))
+        self.power = 0
+        self.color = (0, 0, 65535, 3500)
+        self.group = bytearray(group or '\x01' * 16)
+        self.location = bytearray(location or '\x02' * 16)
+        self.group_label = bytearray('Room'.ljust(32, '\x00'))
+        self.location_label = bytearray('Home'.ljust(32, '\x00'))
+        self.updated_at = 1
+
+        # Set drop to a function of the request returning True to ignore it
+        self.drop = lambda request: False
+        self.delay = 0
+        self.received = []
+        self.waveform = None
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.address = self.socket.getsockname()
+
+    def reply(self, request, pkt_type, *args):
+        packet = lifx.protocol.make_packet(
+                *args,
+                source=request.frame_header.source,
+                target=self.device_id,
+                ack_required=False,
+                res_required=False,
+                sequence=request.frame_address.sequence,
+                pkt_type=pkt_type
+        )
+        return str(packet)
+
+    def state_packet(self, request, pkt_type):
+        if pkt_type == lifx.protocol.TYPE_STATESERVICE:
+            return self.reply(request, pkt_type, lifx.protocol.SERVICE_UDP, self.address[1])
+        if pkt_type in (lifx.protocol.TYPE_STATEPOWER, lifx.protocol.TYPE_LIGHT_STATEPOWER):
+            return self.reply(request, pkt_type, self.power)
+        if pkt_type == lifx.protocol.TYPE_STATELABEL:
+            return self.reply(request, pkt_type, self.label)
+        if pkt_type == lifx.protocol.TYPE_LIGHT_STATE:
+            return self.reply(request, pkt_type, *(self.color + (0, self.power, self.label, 0)))
+        if pkt_type == lifx.protocol.TYPE_STATEGROUP:
+            return self.reply(request, pkt_type, self.group, self.group_label, self.updated_at)
+        if pkt_type == lifx.protocol.TYPE_STATELOCATION:
+            return self.reply(request, pkt_type, self.location, self.location_label, self.updated_at)
+        if pkt_type == lifx.protocol.TYPE_ECHORESPONSE:
+            return self.reply(request, pkt_type, request.payload.payload)
+        if pkt_type == lifx.protocol.TYPE_STATEHOSTFIRMWARE:
+            return self.reply(request, pkt_type, 0, 0, 0x00020001)
+
+    def apply(self, request):
+        pkt_type = request.protocol_header.pkt_type
+        if pkt_type in (lifx.protocol.TYPE_SETPOWER, lifx.protocol.TYPE_LIGHT_SETPOWER):
+            self.power = request.payload.level
+        elif pkt_type == lifx.protocol.TYPE_SETLABEL:
+            self.label = request.payload.label
+        elif pkt_type == lifx.protocol.TYPE_LIGHT_SETCOLOR:
+            p = request.payload
+            self.color = (p.hue, p.saturation, p.brightness, p.kelvin)
+        elif pkt_type == lifx.protocol.TYPE_LIGHT_SETWAVEFORM:
+            p = request.payload
+            self.waveform = p
+            if not p.transient:
+                self.color = (p.hue, p.saturation, p.brightness, p.kelvin)
+
+    def handle(self, request, addr):
+        pkt_type = request.protocol_header.pkt_type
+
+        replies = []
+        if request.frame_address.ack_required:
+            replies.append(self.reply(request, lifx.protocol.TYPE_ACKNOWLEDGEMENT))
+
+        # Gets always answer, Sets only when asked to
+        response_type = lifx.protocol.responses.get(pkt_type)
+        if response_type is not None and (pkt_type in lifx.protocol.CLASS_TYPE_GET
+                or pkt_type == lifx.protocol.TYPE_ECHOREQUEST
+                or request.frame_address.res_required):
+            replies.append(self.state_packet(request, response_type))
+
+        # Like a real bulb, the reply to a Set holds the state from before it
+        self.apply(request)
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        for packet in replies:
+            self.socket.sendto(packet, addr)
+
+    def run(self):
+        while True:
+            data, addr = self.socket.recvfrom(1500)
+            request = lifx.protocol.parse_packet(data)
+            self.received.append(request)
+            if not self.drop(request):
+                self.handle(request, addr)
+
+    def announce(self, client):
+        """Pretend the client discovered this bulb"""
+        request = lifx.protocol.parse_packet(lifx.protocol.discovery_packet(client._source, 0))
+        client._transport._handle_packet(self.address, self.state_packet(request, lifx.protocol.TYPE_STATESERVICE))
+        return client._devices[self.device_id]
+
+    def requests(self, pkt_type):
+        return [r for r in self.received if r.protocol_header.pkt_type == pkt_type]
@@ -0,0 +1,132 @@
+import unittest
+
+import lifx.protocol
+from lifx.color import HSBK
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+    from lifx.aio import AsyncClient
+    from lifx.device import DeviceEvictedError
+except ImportError:
+    asyncio = None
+
+DEVICE_ID = 4930653221840
+
+def reply(request, pkt_type, *args):
+    return lifx.protocol.make_packet(
+            *args,
+            source=request.frame_header.source,
+            target=DEVICE_ID,
+            ack_required=False,
+            res_required=False,
+            sequence=request.frame_address.sequence,
+            pkt_type=pkt_type
+    )
+
+if asyncio is not None:
+    class FakeBulb(asyncio.DatagramProtocol):
+        """Answers just enough of the protocol to test the client, ignoring the first packet"""
+        def __init__(self):
+            self.label = bytearray('Fake')
+            self.received = 0
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            self.received += 1
+            if self.received == 1:
+                return
+
+            request = lifx.protocol.parse_packet(data)
+            pkt_type = request.protocol_header.pkt_type
+
+            if pkt_type == lifx.protocol.TYPE_GETLABEL:
+                self.transport.sendto(reply(request, lifx.protocol.TYPE_STATELABEL, self.label), addr)
+            elif pkt_type == lifx.protocol.TYPE_SETLABEL:
+                self.label = request.payload.label
+                self.transport.sendto(reply(request, lifx.protocol.TYPE_ACKNOWLEDGEMENT), addr)
+            elif pkt_type == lifx.protocol.TYPE_LIGHT_GET:
+                self.transport.sendto(reply(request, lifx.protocol.TYPE_LIGHT_STATE, 0, 0, 65535, 3500, 0, 65535, self.label, 0), addr)
+
+@unittest.skipIf(asyncio is None, 'trollius is not installed')
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_coroutine(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    @asyncio.coroutine
+    def make_client(self):
+        transport, bulb = yield From(self.loop.create_datagram_endpoint(FakeBulb, local_addr=('127.0.0.1', 0)))
+        client = yield From(AsyncClient.create(address='127.0.0.1', loop=self.loop))
+
+        # Pretend the bulb answered discovery
+        host, port = transport.get_extra_info('sockname')
+        service = reply(lifx.protocol.parse_packet(lifx.protocol.discovery_packet(client._source, 0)), lifx.protocol.TYPE_STATESERVICE, lifx.protocol.SERVICE_UDP, port)
+        client._transport.datagram_received(str(service), (host, port))
+
+        raise Return((client, bulb))
+
+    def test_request(self):
+        @asyncio.coroutine
+        def scenario():
+            client, bulb = yield From(self.make_client())
+            device = client.by_id(DEVICE_ID)
+
+            label = yield From(device.label())
+            yield From(device.set_label(u'Kitchen'))
+            new_label, color = yield From(asyncio.gather(device.label(), device.color(), loop=self.loop))
+
+            client.close()
+            raise Return((label, new_label, color, device))
+
+        label, new_label, color, device = self.run_coroutine(scenario())
+        self.assertEqual(label, u'Fake')
+        self.assertEqual(new_label, u'Kitchen')
+        self.assertEqual(color, HSBK(0, 0, 1, 3500))
+
+        # The first packet was ignored and resent
+        self.assertEqual(device._dropped_packets, 1)
+
+    def test_sequences_in_use_are_skipped(self):
+        @asyncio.coroutine
+        def scenario():
+            client, bulb = yield From(self.make_client())
+            device = client.by_id(DEVICE_ID)
+
+            # Another request is still waiting on the first sequence
+            waiting = (asyncio.Future(loop=self.loop), ())
+            client._pending[(DEVICE_ID, 0)] = waiting
+            label = yield From(device.label())
+
+            client.close()
+            raise Return((client, label, waiting))
+
+        client, label, waiting = self.run_coroutine(scenario())
+        self.assertEqual(label, u'Fake')
+        self.assertIs(client._pending[(DEVICE_ID, 0)], waiting)
+        self.assertFalse(waiting[0].done())
+
+    def test_sequences_exhausted(self):
+        @asyncio.coroutine
+        def scenario():
+            client, bulb = yield From(self.make_client())
+            client.close()
+            raise Return(client)
+
+        client = self.run_coroutine(scenario())
+        futures = []
+        for sequence in range(0, 256):
+            futures.append(asyncio.Future(loop=self.loop))
+            client._pending[(DEVICE_ID, sequence)] = (futures[-1], ())
+
+        # The request that has had its sequence longest is failed to make room
+        self.assertEqual(client._next_sequence(DEVICE_ID), 0)
+        self.assertIsInstance(futures[0].exception(), DeviceEvictedError)
+        self.assertFalse(futures[1].done())
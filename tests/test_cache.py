@@ -0,0 +1,43 @@
+import time
+import unittest
+
+from lifx.cache import StateCache, CACHED, FRESH
+
+class StateCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = StateCache(ttl=10)
+
+    def test_missing(self):
+        self.assertIsNone(self.cache.lookup('power'))
+        self.assertIsNone(self.cache.entry('power'))
+
+    def test_lookup(self):
+        self.cache.update('power', True)
+        entry = self.cache.lookup('power')
+        self.assertTrue(entry.value)
+        self.assertFalse(entry.stale)
+        self.assertLess(entry.age, 1)
+
+    def test_max_age(self):
+        self.cache.update('power', True, time.time() - 5)
+        self.assertIsNotNone(self.cache.lookup('power'))
+        self.assertIsNone(self.cache.lookup('power', max_age=1))
+        self.assertIsNone(self.cache.lookup('power', max_age=FRESH))
+
+    def test_stale(self):
+        self.cache.update('power', True, time.time() - 60)
+        self.assertIsNone(self.cache.lookup('power'))
+        self.assertIsNotNone(self.cache.lookup('power', max_age=CACHED))
+        self.assertTrue(self.cache.entry('power').stale)
+
+    def test_invalidate(self):
+        self.cache.update('power', True)
+        self.cache.invalidate('power')
+        self.assertIsNone(self.cache.lookup('power', max_age=CACHED))
+
+    def test_entries(self):
+        self.cache.update('power', True)
+        self.cache.update('label', u'Kitchen')
+        entries = self.cache.entries()
+        self.assertEqual(sorted(entries.keys()), ['label', 'power'])
+        self.assertEqual(entries['label'].value, u'Kitchen')
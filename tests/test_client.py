@@ -0,0 +1,410 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import lifx.color
+import lifx.protocol
+from lifx.cache import CACHED, FRESH
+from lifx.client import Client, CONFIRM_ACK, CONFIRM_STATE
+from lifx.color import HSBK
+from lifx.device import DeviceEvictedError, DeviceTimeoutError, LightState, Waveform, STATE_COLOR, STATE_LABEL, STATE_POWER
+from lifx.request import RttEstimator
+from tests.fakebulb import FakeBulb
+
+DEVICE_ID = 4930653221840
+
+class ClientTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client(broadcast='127.0.0.1', address='127.0.0.1')
+        self.bulb = FakeBulb(DEVICE_ID)
+        self.bulb.start()
+        self.device = self.bulb.announce(self.client)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_discovered(self):
+        self.assertEqual(self.client.by_id(DEVICE_ID), self.device)
+        self.assertEqual(self.device.udp_port, self.bulb.address[1])
+
+    def test_polls_on_scheduler(self):
+        client = Client(broadcast='127.0.0.1', address='127.0.0.1', discoverpoll=0.01, devicepoll=0.01)
+        time.sleep(0.1)
+        client.close()
+
+        stats = client.job_stats
+        self.assertGreater(stats['discover'].runs, 1)
+        self.assertGreater(stats['poll_devices'].runs, 1)
+        self.assertFalse(client._scheduler.is_alive())
+        self.assertFalse(client._transport._listener.is_alive())
+
+    def test_by_id_unknown(self):
+        self.assertRaises(IndexError, self.client.by_id, DEVICE_ID + 1)
+
+    def test_by_id_not_responding(self):
+        self.device._lastseen = datetime.now() - timedelta(hours=1)
+        self.assertRaises(IndexError, self.client.by_id, DEVICE_ID)
+
+    def test_by_label(self):
+        self.assertEqual(self.client.by_label(u'Fake'), [self.device])
+        self.assertEqual(self.client.by_label(u'Kitchen'), [])
+
+        # Only the first lookup had to ask the device
+        self.assertEqual(len(self.bulb.requests(lifx.protocol.TYPE_GETLABEL)), 1)
+
+        self.device.label = u'Kitchen'
+        self.assertEqual(self.client.by_label(u'Kitchen'), [self.device])
+        self.assertEqual(self.client.by_label(u'Fake'), [])
+
+    def test_by_power(self):
+        self.assertEqual(self.client.by_power(False), [self.device])
+        self.device.power = True
+        self.assertEqual(self.client.by_power(True), [self.device])
+        self.assertEqual(self.client.by_power(False), [])
+
+    def test_by_power_changed_elsewhere(self):
+        client = Client(broadcast='127.0.0.1', address='127.0.0.1', cache_ttl=0.05)
+        device = self.bulb.announce(client)
+        self.assertEqual(client.by_power(False), [device])
+
+        # Another controller turns it on
+        self.bulb.power = 65535
+        time.sleep(0.06)
+        self.assertEqual(client.by_power(True), [device])
+        self.assertEqual(client.by_power(False), [])
+        client.close()
+
+    def test_indexed_from_state(self):
+        self.device.get_state(STATE_COLOR)
+        self.assertEqual(self.client.by_label(u'Fake'), [self.device])
+        self.assertEqual(self.client.by_power(False), [self.device])
+        self.assertEqual(self.bulb.requests(lifx.protocol.TYPE_GETLABEL), [])
+        self.assertEqual(self.bulb.requests(lifx.protocol.TYPE_GETPOWER), [])
+
+    def test_get_and_set(self):
+        self.assertEqual(self.device.label, u'Fake')
+        self.device.label = u'Kitchen'
+        self.assertEqual(self.device.label, u'Kitchen')
+
+        self.device.power = True
+        self.assertTrue(self.device.power)
+
+        self.device.color = HSBK(0, 0, 0.5, 3000)
+        self.assertAlmostEqual(self.device.brightness, 0.5, places=2)
+
+    def test_retransmit(self):
+        self.bulb.drop = lambda request: len(self.bulb.received) == 1
+        self.assertEqual(self.device.label, u'Fake')
+        self.assertEqual(self.device.stats.dropped_packets, 1)
+
+        # Karn's algorithm, the resent request says nothing about the round trip
+        self.assertIsNone(self.device.rtt.srtt)
+
+    def test_rtt(self):
+        self.assertIsNone(self.device.rtt.srtt)
+        self.device.label
+        self.assertIsNotNone(self.device.rtt.srtt)
+        self.assertLess(self.device.rtt.rto, 0.2)
+
+    def test_queued_not_resent(self):
+        self.device._rtt = RttEstimator(initial_rto=0.02)
+        payload = bytearray('\x00' * 64)
+        requests = [self.device.request(lifx.protocol.TYPE_ECHOREQUEST, payload) for i in range(0, 15)]
+        self.client.gather(requests)
+
+        # Waiting for the send rate isn't loss, each packet went out once
+        self.assertEqual(len(self.bulb.requests(lifx.protocol.TYPE_ECHOREQUEST)), 15)
+        self.assertEqual(self.device.stats.dropped_packets, 0)
+
+    def test_timeout(self):
+        self.bulb.drop = lambda request: True
+        with self.assertRaises(DeviceTimeoutError):
+            self.device._block_for_response(pkt_type=lifx.protocol.TYPE_GETLABEL, timeout=0.2)
+
+    def test_async(self):
+        label = self.device.label_async()
+        power = self.device.power_async()
+        self.assertEqual(self.client.gather([label, power]), [u'Fake', False])
+
+        self.client.gather([self.device.set_label_async(u'Kitchen'), self.device.fade_power_async(True, 0)])
+        self.assertEqual(self.device.request(lifx.protocol.TYPE_GETLABEL).result().label.rstrip('\x00'), 'Kitchen')
+        self.assertTrue(self.device.power)
+
+    def test_gather_many(self):
+        bulbs = [FakeBulb(DEVICE_ID + i) for i in range(1, 20)]
+        for bulb in bulbs:
+            bulb.start()
+        devices = [bulb.announce(self.client) for bulb in bulbs]
+
+        colors = self.client.gather(d.color_async() for d in devices)
+        self.assertEqual(colors, [HSBK(0, 0, 1, 3500)] * len(devices))
+
+        # Every reply widened the window, and nothing is left in flight
+        self.assertGreater(self.client.congestion.window, 16)
+        self.assertEqual(self.client.congestion.in_flight, 0)
+
+    def test_evicted(self):
+        self.client._pending._max_entries = 1
+        self.bulb.drop = lambda request: True
+        first = self.device.request(lifx.protocol.TYPE_GETLABEL)
+
+        # Starting a request from the callback of an evicted one is fine
+        started = []
+        first.add_done_callback(lambda f: started.append(self.device.request(lifx.protocol.TYPE_GETPOWER, timeout=0.1)))
+        self.device.request(lifx.protocol.TYPE_LIGHT_GET, timeout=0.1)
+
+        self.assertIsInstance(first.exception(1), DeviceEvictedError)
+        self.assertIn('dropped for newer requests', str(first.exception()))
+        self.assertEqual(len(started), 1)
+
+    def test_gather_exceptions(self):
+        self.bulb.drop = lambda request: True
+        future = self.device.request(lifx.protocol.TYPE_GETLABEL, timeout=0.1)
+
+        with self.assertRaises(DeviceTimeoutError):
+            self.client.gather([future])
+        self.assertIsInstance(self.client.gather([future], return_exceptions=True)[0], DeviceTimeoutError)
+
+    def test_set_and_confirm(self):
+        self.assertEqual(self.device.set_color(HSBK(120, 1, 1, 3000)), HSBK(120, 1, 1, 3000))
+        self.assertTrue(self.device.set_power(True))
+        self.assertFalse(self.device.power_toggle())
+        self.assertEqual(self.device.set_label(u'Kitchen'), u'Kitchen')
+
+        # Each change was confirmed by an ack alone
+        for pkt_type in (lifx.protocol.TYPE_LIGHT_SETCOLOR, lifx.protocol.TYPE_SETLABEL):
+            request, = self.bulb.requests(pkt_type)
+            self.assertTrue(request.frame_address.ack_required)
+            self.assertFalse(request.frame_address.res_required)
+
+        # The values sent are cached, so reading them back asks nothing
+        self.bulb.received = []
+        self.assertEqual(self.device.color, HSBK(120, 1, 1, 3000))
+        self.assertFalse(self.device.power)
+        self.assertEqual(self.device.label, u'Kitchen')
+        self.assertEqual(self.bulb.received, [])
+
+    def test_set_reply_not_cached(self):
+        # The State reply to a Set holds the values from before it
+        payload = self.device.request(lifx.protocol.TYPE_LIGHT_SETPOWER, 65535, 0, res_required=True).result(2)
+        self.assertEqual(payload.level, 0)
+        self.assertNotIn(STATE_POWER, self.device.cached_state)
+        self.assertEqual(self.client.by_power(False), [])
+        self.assertTrue(self.device.power)
+
+    def test_cache_filled_from_light_state(self):
+        self.device.color
+        self.bulb.received = []
+
+        # One LIGHT_STATE answers for the power and label too
+        self.assertFalse(self.device.power)
+        self.assertEqual(self.device.label, u'Fake')
+        self.assertEqual(repr(self.device), "<Device MAC:d073d5017c04, Label:u'Fake'>")
+        self.assertEqual(self.bulb.received, [])
+
+        self.assertEqual(set(self.device.cached_state.keys()), set([STATE_COLOR, STATE_LABEL, STATE_POWER]))
+
+    def test_cache_max_age(self):
+        self.device.label
+        self.bulb.label = bytearray('Other'.ljust(32, '\x00'))
+
+        self.assertEqual(self.device.get_state(STATE_LABEL, CACHED), u'Fake')
+        self.assertEqual(self.device.label_async(max_age=FRESH).result(), u'Other')
+        self.assertEqual(len(self.bulb.requests(lifx.protocol.TYPE_GETLABEL)), 2)
+
+    def test_cache_invalidated_by_set(self):
+        self.assertFalse(self.device.power)
+        self.device.power = True
+        self.assertTrue(self.device.power)
+
+    def test_repr_without_state(self):
+        self.assertEqual(repr(self.device), "<Device MAC:d073d5017c04, Label:None>")
+        self.assertEqual(self.bulb.received, [])
+
+    def test_coalesced_reads(self):
+        self.bulb.delay = 0.05
+        futures = [self.device.color_async() for i in range(0, 10)]
+
+        self.assertEqual(self.client.gather(futures), [HSBK(0, 0, 1, 3500)] * 10)
+        self.assertEqual(len(self.bulb.requests(lifx.protocol.TYPE_LIGHT_GET)), 1)
+        self.assertEqual(self.device.stats.coalesced_requests, 9)
+
+        # Once answered the next fresh read goes out again
+        self.device.color_async(max_age=FRESH).result()
+        self.assertEqual(len(self.bulb.requests(lifx.protocol.TYPE_LIGHT_GET)), 2)
+
+    def test_sets_not_coalesced(self):
+        self.client.gather([self.device.fade_power_async(True), self.device.fade_power_async(True)])
+        self.assertEqual(len(self.bulb.requests(lifx.protocol.TYPE_LIGHT_SETPOWER)), 2)
+        self.assertEqual(self.device.stats.coalesced_requests, 0)
+
+    def test_stream(self):
+        for i in range(0, 10):
+            self.device.stream_color(HSBK(i, 1, 1, 3500))
+        self.device.stream_power(True)
+
+        deadline = time.time() + 2
+        while (len(self.bulb.received) < 3 or self.bulb.power != 65535) and time.time() < deadline:
+            time.sleep(0.01)
+
+        colors = self.bulb.requests(lifx.protocol.TYPE_LIGHT_SETCOLOR)
+        self.assertEqual(len(colors), 2)
+        self.assertFalse(colors[-1].frame_address.ack_required)
+        self.assertEqual(HSBK(*self.bulb.color).hue, lifx.color.message_from_color(HSBK(9, 1, 1, 3500)).hue)
+        self.assertEqual(self.bulb.power, 65535)
+        self.assertEqual(self.device.stats.superseded_writes, 8)
+
+    def test_stream_behind_send_rate(self):
+        for i in range(0, 10):
+            self.device.send_poll_packet()
+        for i in range(0, 10):
+            self.device.stream_color(HSBK(i, 1, 1, 3500))
+
+        # Writes waiting for the send rate are replaced too, only the last goes out
+        self.wait_for_bulb(lambda: len(self.bulb.received) >= 11)
+        colors = self.bulb.requests(lifx.protocol.TYPE_LIGHT_SETCOLOR)
+        self.assertEqual(len(colors), 1)
+        self.assertEqual(HSBK(*self.bulb.color).hue, lifx.color.message_from_color(HSBK(9, 1, 1, 3500)).hue)
+
+    def test_send_rate(self):
+        for i in range(0, 10):
+            self.device.send_poll_packet()
+        label = self.device.label_async()
+
+        # The burst goes straight out, the label jumps the queued polls
+        self.assertEqual(self.device.send_queue.background_depth, 5)
+        self.assertEqual(label.result(), u'Fake')
+        self.assertLess(self.bulb.received.index(self.bulb.requests(lifx.protocol.TYPE_GETLABEL)[0]), 6)
+
+    def wait_for_bulb(self, condition):
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_waveform(self):
+        self.assertTrue(self.device.waveform(HSBK(0, 1, 1, 3500), lifx.protocol.WAVEFORM_SINE, 1000, 2.5))
+        self.assertEqual(self.bulb.waveform.cycles, 2.5)
+        self.assertEqual(self.bulb.waveform.waveform, lifx.protocol.WAVEFORM_SINE)
+        self.assertEqual(self.bulb.waveform.skew_ratio, -1)
+
+    def test_broadcast_set(self):
+        self.device.power
+        result = self.client.broadcast_set(power=True, color=HSBK(0, 1, 1, 3500), port=self.bulb.address[1])
+        self.assertIsNone(result)
+
+        self.wait_for_bulb(lambda: self.bulb.color[1] == 65535)
+        self.assertEqual(self.bulb.power, 65535)
+        for pkt_type in (lifx.protocol.TYPE_LIGHT_SETPOWER, lifx.protocol.TYPE_LIGHT_SETCOLOR):
+            request, = self.bulb.requests(pkt_type)
+            self.assertTrue(request.frame_header.tagged)
+            self.assertEqual(request.frame_address.target, 0)
+
+        # What we knew about the power is out of date
+        self.assertNotIn(STATE_POWER, self.device.cached_state)
+
+    def test_broadcast_set_clears_index(self):
+        self.assertEqual(self.client.by_power(False), [self.device])
+        self.client.broadcast_set(power=True, duration=0, port=self.bulb.address[1])
+
+        deadline = time.time() + 2
+        while self.bulb.power != 65535 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.client.by_power(True), [self.device])
+
+    def test_broadcast_waveform(self):
+        wave = Waveform(HSBK(0, 1, 1, 3500), lifx.protocol.WAVEFORM_PULSE, 500, 3, 0.5, False)
+        self.client.broadcast_set(waveform=wave, port=self.bulb.address[1])
+        self.wait_for_bulb(lambda: self.bulb.waveform is not None)
+        self.assertEqual(self.bulb.waveform.period, 500)
+
+    def test_broadcast_confirm_ack(self):
+        result = self.client.broadcast_set(power=True, confirm=CONFIRM_ACK, port=self.bulb.address[1])
+        self.assertTrue(result.success)
+        self.assertEqual(result.succeeded, [self.device])
+
+        tagged, unicast = self.bulb.requests(lifx.protocol.TYPE_LIGHT_SETPOWER)
+        self.assertTrue(tagged.frame_header.tagged)
+        self.assertTrue(unicast.frame_address.ack_required)
+
+    def test_broadcast_confirm_state(self):
+        result = self.client.broadcast_set(power=True, confirm=CONFIRM_STATE, port=self.bulb.address[1])
+        self.assertEqual(result[0].value, LightState(True, HSBK(0, 0, 1, 3500), u'Fake'))
+
+    def test_broadcast_group(self):
+        result = self.client.broadcast_set(power=True, group_id=self.bulb.group, confirm=CONFIRM_ACK)
+        self.assertTrue(result.success)
+
+        # Only sent to the member, nothing tagged
+        request, = self.bulb.requests(lifx.protocol.TYPE_LIGHT_SETPOWER)
+        self.assertFalse(request.frame_header.tagged)
+        self.assertEqual(self.bulb.power, 65535)
+
+        self.assertEqual(len(self.client.broadcast_set(power=True, group_id=bytearray(16), confirm=CONFIRM_ACK)), 0)
+
+    def test_broadcast_nothing(self):
+        with self.assertRaises(ValueError):
+            self.client.broadcast_set()
+
+    def test_snapshot(self):
+        others = [FakeBulb(DEVICE_ID + i) for i in range(1, 4)]
+        for bulb in others:
+            bulb.start()
+            bulb.announce(self.client)
+        others[0].power = 65535
+        others[1].drop = lambda request: True
+
+        # Only the first bulb hears the broadcast, the rest are asked directly
+        snapshot = self.client.snapshot(wait=0.1, timeout=0.2, port=self.bulb.address[1])
+        self.assertEqual([d.id for d in snapshot.keys()], [DEVICE_ID + i for i in range(0, 4)])
+        self.assertEqual(snapshot.values(), [
+            LightState(False, HSBK(0, 0, 1, 3500), u'Fake'),
+            LightState(True, HSBK(0, 0, 1, 3500), u'Fake'),
+            None,
+            LightState(False, HSBK(0, 0, 1, 3500), u'Fake'),
+        ])
+
+        request, = self.bulb.requests(lifx.protocol.TYPE_LIGHT_GET)
+        self.assertTrue(request.frame_header.tagged)
+        self.assertEqual(len(self.bulb.requests(lifx.protocol.TYPE_LIGHT_GET)), 1)
+
+    def test_broadcast_reply_does_not_answer_request(self):
+        setcolor = lifx.protocol.TYPE_LIGHT_SETCOLOR
+        self.bulb.drop = lambda request: request.protocol_header.pkt_type == setcolor and len(self.bulb.requests(setcolor)) == 1
+        future = self.device.request(setcolor, 0, 0, 65535, 65535, 3500, 0, res_required=True)
+
+        deadline = time.time() + 2
+        while not self.bulb.requests(setcolor) and time.time() < deadline:
+            time.sleep(0.001)
+
+        # The broadcast has the same sequence as the lost Set
+        self.client._pending._sequences[None] = self.bulb.requests(setcolor)[0].frame_address.sequence
+        self.client.snapshot(wait=0.1, port=self.bulb.address[1])
+
+        future.result(2)
+        self.assertEqual(len(self.bulb.requests(setcolor)), 2)
+        self.assertEqual(self.bulb.color, (0, 65535, 65535, 3500))
+
+        # Only the reply to the Set itself is left out of the cache
+        self.assertFalse(self.device.cached_state[STATE_POWER].value)
+
+    def test_broadcast_query(self):
+        handlers = dict(self.client._transport._packet_handlers)
+        results = list(self.client.broadcast_query(lifx.protocol.TYPE_GETLABEL, port=self.bulb.address[1]))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].device, self.device)
+        self.assertIsNone(results[0].error)
+        self.assertEqual(lifx.protocol.bytes_to_label(results[0].payload.label), u'Fake')
+
+        # The handler for the replies is gone again
+        self.assertEqual(self.client._transport._packet_handlers, handlers)
+
+    def test_wrong_response_type_is_ignored(self):
+        # Answer the first label request with a power state
+        def drop(request):
+            if len(self.bulb.received) == 1:
+                self.bulb.socket.sendto(self.bulb.state_packet(request, lifx.protocol.TYPE_STATEPOWER), self.client._transport._socket.getsockname())
+                return True
+            return False
+
+        self.bulb.drop = drop
+        self.assertEqual(self.device.label, u'Fake')
@@ -0,0 +1,76 @@
+import unittest
+from binascii import hexlify, unhexlify
+
+import lifx.protocol
+from lifx.codec import compile_section, parse_format, Codec, BitstructCodec
+
+SECTIONS = [
+        lifx.protocol.frame_header,
+        lifx.protocol.frame_address,
+        lifx.protocol.protocol_header,
+] + lifx.protocol.messages.values()
+
+def sample_values(section, seed):
+    """
+    Makes some awkward values that fill every field in a section
+    """
+    values = []
+    for i, (fieldtype, bits) in enumerate(parse_format(section['format'])):
+        if fieldtype == 'u':
+            values.append((0x9e3779b97f4a7c15 * (seed + i + 1)) % pow(2, bits))
+        elif fieldtype == 's':
+            values.append(-((seed + i + 1) % pow(2, bits - 1)))
+        elif fieldtype == 'f':
+            values.append(1.5 * (seed + i))
+        elif fieldtype == 'b':
+            values.append(bytearray(chr((seed + i + j) % 256) for j in range(bits / 8)))
+    return tuple(values)
+
+class CodecTests(unittest.TestCase):
+    def test_pack_matches_bitstruct(self):
+        for section in SECTIONS:
+            codec = compile_section(section)
+            for seed in range(0, 5):
+                values = sample_values(section, seed)
+                self.assertEqual(codec.pack(*values), lifx.protocol.pack_section(section, *values))
+
+    def test_unpack_matches_bitstruct(self):
+        for section in SECTIONS:
+            codec = compile_section(section)
+            for seed in range(0, 5):
+                data = lifx.protocol.pack_section(section, *sample_values(section, seed))
+                self.assertEqual(codec.unpack_from(data), lifx.protocol.unpack_section(section, data))
+
+    def test_pack_test_cases(self):
+        from tests.test_protocol import PACK_TEST_CASES
+        for section, args, packet in PACK_TEST_CASES:
+            self.assertEqual(hexlify(compile_section(section).pack(*args)), packet)
+            self.assertEqual(compile_section(section).unpack_from(unhexlify(packet)), args)
+
+    def test_pack_into_offset(self):
+        codec = compile_section(lifx.protocol.protocol_header)
+        buf = bytearray(16)
+        codec.pack_into(buf, 4, 0, 117, 0)
+        self.assertEqual(hexlify(buf), '00000000000000000000000075000000')
+        self.assertEqual(codec.unpack_from(buf, 4).pkt_type, 117)
+
+    def test_short_bytes_are_padded(self):
+        codec = compile_section(lifx.protocol.messages[lifx.protocol.TYPE_SETLABEL])
+        self.assertEqual(codec.pack(bytearray('Hi')), bytearray('Hi' + '\x00' * 30))
+
+    def test_compile_is_cached(self):
+        section = lifx.protocol.messages[lifx.protocol.TYPE_LIGHT_STATE]
+        self.assertIs(compile_section(section), compile_section(section))
+        self.assertIsInstance(compile_section(section), Codec)
+
+    def test_fallback_codec(self):
+        # A 16 bit field spread across two swapped groups can't be a struct
+        section = {
+            'format': 'u4u16u4',
+            'byteswap': '21',
+            'fields': lifx.protocol.namedtuple('odd', ['a', 'b', 'c']),
+        }
+        codec = compile_section(section)
+        self.assertIsInstance(codec, BitstructCodec)
+        self.assertEqual(codec.pack(1, 2, 3), lifx.protocol.pack_section(section, 1, 2, 3))
+        self.assertEqual(codec.unpack_from(codec.pack(1, 2, 3)), (1, 2, 3))
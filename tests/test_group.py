@@ -0,0 +1,183 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import lifx.protocol
+from lifx.client import Client
+from lifx.color import HSBK
+from lifx.device import Device, DeviceTimeoutError
+from lifx.group import Group, MembershipIndex
+from tests.fakebulb import FakeBulb
+
+DEVICE_ID = 4930653221840
+
+class MembershipIndexTests(unittest.TestCase):
+    def test_update(self):
+        index = MembershipIndex()
+        self.assertTrue(index.update(1, 'kitchen'))
+        self.assertFalse(index.update(1, 'kitchen'))
+        index.update(2, 'kitchen')
+
+        self.assertEqual(index.members('kitchen'), set([1, 2]))
+        self.assertEqual(index.group_of(1), 'kitchen')
+        self.assertIn(1, index)
+        self.assertNotIn(3, index)
+
+    def test_move(self):
+        index = MembershipIndex()
+        index.update(1, 'kitchen')
+        self.assertTrue(index.update(1, 'lounge'))
+
+        self.assertEqual(index.members('kitchen'), set())
+        self.assertEqual(index.members('lounge'), set([1]))
+
+    def test_remove(self):
+        index = MembershipIndex()
+        index.update(1, 'kitchen')
+        index.remove(1)
+        self.assertIsNone(index.group_of(1))
+        self.assertEqual(index.members('kitchen'), set())
+
+    def test_unknown(self):
+        index = MembershipIndex()
+        index.expect(1)
+        index.expect(2)
+        index.update(2, 'kitchen')
+        self.assertEqual(index.unknown(), set([1]))
+
+        index.invalidate(2)
+        self.assertEqual(index.unknown(), set([1, 2]))
+        self.assertEqual(index.members('kitchen'), set())
+
+        index.remove(1)
+        self.assertEqual(index.unknown(), set([2]))
+
+    def test_ttl(self):
+        index = MembershipIndex(ttl=0.05)
+        index.update(1, 'kitchen')
+        self.assertEqual(index.unknown(), set())
+
+        # Still answers with the old group until told otherwise
+        time.sleep(0.06)
+        self.assertEqual(index.unknown(), set([1]))
+        self.assertEqual(index.members('kitchen'), set([1]))
+
+        index.update(1, 'kitchen')
+        self.assertEqual(index.unknown(), set())
+
+class MembershipTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client(broadcast='127.0.0.1', address='127.0.0.1')
+        self.bulbs = [FakeBulb(DEVICE_ID + i, group=chr(i % 2) * 16, location='\x09' * 16) for i in range(0, 6)]
+        for bulb in self.bulbs:
+            bulb.start()
+        self.devices = [bulb.announce(self.client) for bulb in self.bulbs]
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_get_groups(self):
+        groups = self.client.get_groups()
+        self.assertEqual([g.id for g in groups], [bytearray('\x00' * 16), bytearray('\x01' * 16)])
+        self.assertEqual(groups[1].members, self.devices[1::2])
+        self.assertEqual(len(self.client.get_locations()), 1)
+
+        # Everything after the first lookup comes from the index
+        for bulb in self.bulbs:
+            self.assertEqual(len(bulb.requests(lifx.protocol.TYPE_GETGROUP)), 1)
+        groups[0].members
+        self.client.by_location_id(bytearray('\x09' * 16))
+        for bulb in self.bulbs:
+            self.assertEqual(len(bulb.requests(lifx.protocol.TYPE_GETGROUP)), 1)
+            self.assertEqual(len(bulb.requests(lifx.protocol.TYPE_GETLOCATION)), 1)
+
+    def test_moved_device(self):
+        self.assertEqual(self.client.by_group_id(bytearray('\x00' * 16)), self.devices[0::2])
+
+        # The bulb tells us it moved when next asked
+        self.bulbs[0].group = bytearray('\x01' * 16)
+        self.client.gather(self.client.refresh_membership())
+        self.assertEqual(self.client.by_group_id(bytearray('\x00' * 16)), self.devices[2::2])
+        self.assertEqual(self.client.by_group_id(bytearray('\x01' * 16)), [self.devices[0]] + self.devices[1::2])
+
+    def test_refresh_skips_unresponsive(self):
+        self.devices[0]._lastseen = datetime.now() - timedelta(hours=1)
+        futures = self.client.refresh_membership()
+        self.client.gather(futures)
+
+        # Two Gets for each device still answering polls
+        self.assertEqual(len(futures), 10)
+        self.assertEqual(len(self.bulbs[0].requests(lifx.protocol.TYPE_GETGROUP)), 0)
+        self.assertEqual(len(self.bulbs[1].requests(lifx.protocol.TYPE_GETGROUP)), 1)
+
+class GroupTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client(broadcast='127.0.0.1', address='127.0.0.1')
+        self.bulbs = [FakeBulb(DEVICE_ID + i) for i in range(0, 5)]
+        for bulb in self.bulbs:
+            bulb.start()
+        self.devices = [bulb.announce(self.client) for bulb in self.bulbs]
+        self.group = Group(bytearray('\x01' * 16), self.client, lambda group_id: self.devices, Device._get_group_data_async)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_fade_power(self):
+        result = self.group.fade_power(True)
+
+        self.assertTrue(result.success)
+        self.assertEqual(len(result), 5)
+        self.assertEqual(result.succeeded, self.devices)
+        self.assertTrue(all(r.latency is not None for r in result))
+        self.assertTrue(all(bulb.power == 65535 for bulb in self.bulbs))
+
+    def test_fade_color(self):
+        self.assertTrue(self.group.fade_color(HSBK(0, 1, 1, 3500)).success)
+        self.assertTrue(all(HSBK(*bulb.color).saturation == 65535 for bulb in self.bulbs))
+
+    def test_power_toggle(self):
+        self.bulbs[0].power = 65535
+        result = self.group.power_toggle()
+
+        self.assertEqual([r.value for r in result], [False, True, True, True, True])
+
+    def test_partial_failure(self):
+        self.bulbs[2].drop = lambda request: True
+        result = self.group.fade_power(True)
+
+        self.assertFalse(result.success)
+        self.assertEqual(result.timed_out, [self.devices[2]])
+        self.assertIsInstance(result[2].error, DeviceTimeoutError)
+        self.assertEqual(len(result.succeeded), 4)
+
+    def test_sent_at_once(self):
+        for bulb in self.bulbs:
+            bulb.delay = 0.2
+        result = self.group.fade_power(True)
+
+        self.assertTrue(result.success)
+        self.assertLess(max(r.latency for r in result), 0.8)
+
+    def test_label_newest(self):
+        self.bulbs[3].group_label = bytearray('Kitchen'.ljust(32, '\x00'))
+        self.bulbs[3].updated_at = 2
+        self.assertEqual(self.group.label, 'Kitchen')
+        self.assertEqual(self.group.updated_at, 2)
+
+        # An older label arriving later doesn't replace it
+        self.assertFalse(self.group.update(bytearray('Room'.ljust(32, '\x00')), 1))
+        self.assertEqual(self.group.label, 'Kitchen')
+
+    def test_label_cached(self):
+        self.group.update(bytearray('Lounge'.ljust(32, '\x00')), 5)
+        self.assertEqual(self.group.label, 'Lounge')
+        for bulb in self.bulbs:
+            self.assertEqual(bulb.requests(lifx.protocol.TYPE_GETGROUP), [])
+
+    def test_label_stale(self):
+        group = Group(bytearray('\x01' * 16), self.client, lambda group_id: self.devices, Device._get_group_data_async, 0)
+        group.update(bytearray('Lounge'.ljust(32, '\x00')), 0)
+        time.sleep(0.01)
+        self.assertEqual(group.label, 'Room')
+        for bulb in self.bulbs:
+            self.assertEqual(len(bulb.requests(lifx.protocol.TYPE_GETGROUP)), 1)
@@ -0,0 +1,158 @@
+import socket
+import time
+import unittest
+
+import lifx.protocol
+from lifx.network import NetworkTransport, DispatchWorker, OVERFLOW_DROP_OLDEST
+
+ADDRESS = ('192.168.0.10', 56700)
+DEVICE_ID = 4930653221840
+
+def make_packet(source, pkt_type, *args, **kwargs):
+    return str(lifx.protocol.make_packet(
+            *args,
+            source=source,
+            target=kwargs.get('target', DEVICE_ID),
+            ack_required=False,
+            res_required=False,
+            sequence=1,
+            pkt_type=pkt_type
+    ))
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+class NetworkTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = NetworkTransport(address='127.0.0.1')
+        self.received = []
+        self.handler = lambda host, port, packet: self.received.append(packet.materialize())
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_handle_packet(self):
+        self.transport.register_packet_handler(self.handler)
+        self.assertTrue(self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0)))
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.received[0].frame_address.target, DEVICE_ID)
+
+    def test_reject_other_source(self):
+        self.transport.register_source(1)
+        self.transport.register_packet_handler(self.handler)
+        self.assertFalse(self.transport._handle_packet(ADDRESS, make_packet(2, lifx.protocol.TYPE_STATEPOWER, 0)))
+        self.assertTrue(self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0)))
+        self.assertEqual(len(self.received), 1)
+
+    def test_reject_unwanted_type(self):
+        self.transport.register_packet_handler(self.handler, pkt_types=(lifx.protocol.TYPE_STATEPOWER,))
+        self.assertFalse(self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_ACKNOWLEDGEMENT)))
+        self.assertTrue(self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0)))
+        self.assertEqual(len(self.received), 1)
+
+    def test_reject_bad_size(self):
+        self.transport.register_packet_handler(self.handler)
+        self.assertFalse(self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0)[:-1]))
+        self.assertEqual(len(self.received), 0)
+
+    def test_dispatch_by_target(self):
+        calls = []
+        for device_id in range(1, 401):
+            handler = lambda host, port, packet, device_id=device_id: calls.append(device_id)
+            self.transport.register_packet_handler(handler, (lifx.protocol.TYPE_STATEPOWER,), device_id)
+
+        self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0, target=123))
+        self.assertEqual(calls, [123])
+
+        # Nobody listens for this device
+        self.assertFalse(self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0, target=999)))
+
+    def test_dispatch_wildcards(self):
+        calls = []
+        self.transport.register_packet_handler(lambda h, p, pkt: calls.append('exact'), (lifx.protocol.TYPE_STATEPOWER,), DEVICE_ID)
+        self.transport.register_packet_handler(lambda h, p, pkt: calls.append('target'), target=DEVICE_ID)
+        self.transport.register_packet_handler(lambda h, p, pkt: calls.append('type'), (lifx.protocol.TYPE_STATEPOWER,))
+        self.transport.register_packet_handler(lambda h, p, pkt: calls.append('any'))
+
+        self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0))
+        self.assertEqual(sorted(calls), ['any', 'exact', 'target', 'type'])
+
+        del calls[:]
+        self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_ACKNOWLEDGEMENT, target=5))
+        self.assertEqual(calls, ['any'])
+
+    def test_unregister_packet_handler(self):
+        handle = self.transport.register_packet_handler(self.handler, (lifx.protocol.TYPE_STATEPOWER, lifx.protocol.TYPE_STATELABEL))
+        self.transport.register_packet_handler(self.handler, (lifx.protocol.TYPE_STATEPOWER,))
+        self.transport.unregister_packet_handler(handle)
+
+        self.assertTrue(self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0)))
+        self.assertEqual(len(self.received), 1)
+        self.assertFalse(self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATELABEL, bytearray())))
+
+    def test_listener_drains_burst(self):
+        self.transport.register_packet_handler(self.handler, (lifx.protocol.TYPE_STATEPOWER,))
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        destination = self.transport._socket.getsockname()
+        for level in range(0, 200):
+            sender.sendto(make_packet(1, lifx.protocol.TYPE_STATEPOWER, level), destination)
+        sender.sendto(make_packet(1, lifx.protocol.TYPE_ACKNOWLEDGEMENT), destination)
+
+        wait_for(lambda: self.transport.stats.received_packets >= 201)
+
+        stats = self.transport.stats
+        self.assertEqual(stats.received_packets + (stats.kernel_drops or 0), 201)
+        self.assertEqual(stats.rejected_packets, 1)
+        self.assertEqual([p.payload.level for p in self.received], range(0, stats.received_packets - 1))
+
+    def test_close(self):
+        transport = NetworkTransport(address='127.0.0.1', workers=2)
+        transport.close()
+        self.assertFalse(transport._listener.is_alive())
+        self.assertFalse(any(worker.is_alive() for worker in transport._workers))
+
+        # Closing again does nothing
+        transport.close()
+
+    def test_rcvbuf(self):
+        transport = NetworkTransport(address='127.0.0.1', rcvbuf=65536)
+        self.assertGreaterEqual(transport._socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536)
+        transport.close()
+
+    def test_dispatch_workers_keep_device_order(self):
+        transport = NetworkTransport(address='127.0.0.1', workers=3)
+        received = []
+        transport.register_packet_handler(lambda h, p, pkt: received.append((pkt.frame_address.target, pkt.payload.level)))
+
+        for level in range(0, 50):
+            for target in range(1, 5):
+                transport._enqueue_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, level, target=target))
+
+        wait_for(lambda: len(received) >= 200)
+        for target in range(1, 5):
+            self.assertEqual([l for t, l in received if t == target], range(0, 50))
+        transport.close()
+
+    def test_dispatch_worker_drop_oldest(self):
+        dispatched = []
+        worker = DispatchWorker(lambda *item: dispatched.append(item), 2, OVERFLOW_DROP_OLDEST, 0)
+        for i in range(0, 5):
+            worker.put((ADDRESS, i, (), None))
+
+        self.assertEqual(worker.counters.dropped_packets, 3)
+        self.assertEqual([worker._queue.get_nowait()[1] for i in range(0, 2)], [3, 4])
+
+    def test_dispatch_worker_bad_overflow(self):
+        self.assertRaises(ValueError, DispatchWorker, None, 2, 'sometimes', 0)
+
+    def test_dispatch_latency(self):
+        self.transport.register_packet_handler(self.handler)
+        self.transport._handle_packet(ADDRESS, make_packet(1, lifx.protocol.TYPE_STATEPOWER, 0), time.time() - 1)
+
+        stats = self.transport.dispatch_stats
+        self.assertEqual(stats.dispatched_packets, 1)
+        self.assertGreaterEqual(stats.mean_latency, 1)
+        self.assertGreaterEqual(stats.max_latency, 1)
@@ -25,6 +25,7 @@ PACK_TEST_CASES = [
         (lifx.protocol.frame_header,     (49, 0, 1, 1, 1024, 4752,),   '3100003490120000'),
         (lifx.protocol.protocol_header,  (0, 0, 0),                    '000000000000000000000000'),
         (lifx.protocol.protocol_header,  (0, 117, 0),                  '000000000000000075000000'),
+        (lifx.protocol.messages[lifx.protocol.TYPE_LIGHT_SETWAVEFORM], (0, 1, 0, 65535, 65535, 3500, 1000, 2.5, 0, 1), '00010000ffffffffac0de803000000002040000001'),
 ]
 
 SIZE_TEST_CASES = [
@@ -33,6 +34,7 @@ SIZE_TEST_CASES = [
         (lifx.protocol.protocol_header, 96),
         (lifx.protocol.messages[lifx.protocol.TYPE_GETSERVICE], 0),
         (lifx.protocol.messages[lifx.protocol.TYPE_STATESERVICE], 40),
+        (lifx.protocol.messages[lifx.protocol.TYPE_LIGHT_SETWAVEFORM], 168),
 ]
 
 EXAMPLE_PACKETS = [
@@ -81,6 +83,27 @@ class ProtocolTests(unittest.TestCase):
         for kwargs, args, packet, vals in EXAMPLE_PACKETS:
             self.assertEqual(hexlify(lifx.protocol.make_packet(*args, **kwargs)), packet)
 
+    def test_packet_template(self):
+        for kwargs, args, packet, vals in EXAMPLE_PACKETS:
+            template = lifx.protocol.packet_template(
+                    kwargs['source'],
+                    kwargs['pkt_type'],
+                    kwargs['ack_required'],
+                    kwargs['res_required'],
+                    kwargs['target'] is None,
+            )
+            self.assertEqual(hexlify(template.build(kwargs['target'], kwargs['sequence'], *args)), packet)
+
+            # Reusing a buffer overwrites everything from the last packet
+            buf = bytearray('\xff' * 64)
+            size = template.pack_into(buf, kwargs['target'], kwargs['sequence'], *args)
+            self.assertEqual(hexlify(buf[:size]), packet)
+
+    def test_packet_template_is_cached(self):
+        first = lifx.protocol.packet_template(1, lifx.protocol.TYPE_GETPOWER, False, True, False)
+        second = lifx.protocol.packet_template(1, lifx.protocol.TYPE_GETPOWER, 0, 1, 0)
+        self.assertIs(first, second)
+
     def test_parse_packet(self):
         for kwargs, args, packet, vals in EXAMPLE_PACKETS:
             parsed = lifx.protocol.parse_packet(unhexlify(packet))
@@ -110,6 +133,58 @@ class ProtocolTests(unittest.TestCase):
         self.assertEqual(parsed.protocol_header.pkt_type, 111)
         self.assertEqual(parsed.payload, '\x89\x0c')
 
+    def test_peek_header(self):
+        for kwargs, args, packet, vals in EXAMPLE_PACKETS:
+            data = unhexlify(packet)
+            header = lifx.protocol.peek_header(data)
+            self.assertEqual(header.size, len(data))
+            self.assertEqual(header.source, kwargs['source'])
+            self.assertEqual(header.target, kwargs['target'])
+            self.assertEqual(header.sequence, kwargs['sequence'])
+            self.assertEqual(header.pkt_type, kwargs['pkt_type'])
+
+    def test_peek_header_with_incorrect_size(self):
+        packet = '240000142d000000d073d5017c0400000000000000000161000000000000000014'
+        self.assertIsNone(lifx.protocol.peek_header(unhexlify(packet)))
+        self.assertIsNone(lifx.protocol.peek_header(unhexlify('2400')))
+
+    def test_view_packet(self):
+        for kwargs, args, packet, vals in EXAMPLE_PACKETS:
+            data = unhexlify(packet)
+            view = lifx.protocol.view_packet(data)
+
+            self.assertEqual(view.frame_header.size, len(data))
+            self.assertEqual(view.frame_header.source, kwargs['source'])
+            self.assertEqual(view.frame_address.target, kwargs['target'])
+            self.assertEqual(view.frame_address.sequence, kwargs['sequence'])
+            self.assertEqual(view.protocol_header.pkt_type, kwargs['pkt_type'])
+            self.assertEqual(view.materialize(), lifx.protocol.parse_packet(data))
+
+    def test_view_packet_is_lazy(self):
+        for kwargs, args, packet, vals in EXAMPLE_PACKETS:
+            data = bytearray(unhexlify(packet))
+            view = lifx.protocol.view_packet(data)
+
+            # Changing the buffer before a header is read shows through
+            data[lifx.protocol.SEQUENCE_OFFSET] = 3
+            self.assertEqual(view.frame_address.sequence, 3)
+
+            # Once materialized the packet no longer depends on the buffer
+            materialized = view.materialize()
+            data[lifx.protocol.SEQUENCE_OFFSET] = 4
+            self.assertEqual(materialized.frame_address.sequence, 3)
+
+    def test_view_packet_with_incorrect_size(self):
+        packet = '240000142d000000d073d5017c0400000000000000000161000000000000000014'
+        self.assertIsNone(lifx.protocol.view_packet(unhexlify(packet)))
+        self.assertIsNone(lifx.protocol.view_packet(unhexlify('2400')))
+
+    def test_view_packet_with_unknown_type(self):
+        packet = '2600005442524b52d073d501cf2c00004c49465856320000842e3128d92cf7136f000000890c'
+        view = lifx.protocol.view_packet(unhexlify(packet))
+        self.assertEqual(view.protocol_header.pkt_type, 111)
+        self.assertEqual(view.payload, '\x89\x0c')
+
     def test_discovery_packet(self):
         self.assertEqual(
                 hexlify(lifx.protocol.discovery_packet(23, 5)),
@@ -0,0 +1,379 @@
+import threading
+import time
+import unittest
+
+import lifx.protocol
+from lifx.request import CongestionWindow, PendingTable, PendingRequest, Retransmitter, RttEstimator
+from lifx.request import SEQUENCE_SPACE, MIN_RTO, MAX_RTO
+from lifx.util import Scheduler, PRIORITY_BACKGROUND
+
+DEVICE_ID = 4930653221840
+
+def make_packet(target, sequence, pkt_type, *args):
+    return lifx.protocol.view_packet(lifx.protocol.make_packet(
+            *args,
+            source=1,
+            target=target,
+            ack_required=False,
+            res_required=False,
+            sequence=sequence,
+            pkt_type=pkt_type
+    ))
+
+class PendingTableTests(unittest.TestCase):
+    def setUp(self):
+        self.table = PendingTable()
+        self.power_types = lifx.protocol.response_types(lifx.protocol.TYPE_GETPOWER, False, True)
+
+    def test_sequences_per_target(self):
+        self.assertEqual([self.table.next_sequence(1) for i in range(0, 3)], [0, 1, 2])
+        self.assertEqual(self.table.next_sequence(2), 0)
+        self.assertEqual(self.table.next_sequence(None), 0)
+
+    def test_sequences_wrap(self):
+        sequences = [self.table.next_sequence(1) for i in range(0, SEQUENCE_SPACE + 1)]
+        self.assertEqual(sequences[-1], 0)
+
+    def test_sequences_skip_pending(self):
+        request = self.table.add(1, self.power_types, 10)
+        for i in range(0, SEQUENCE_SPACE - 1):
+            self.assertNotEqual(self.table.next_sequence(1), request.sequence)
+
+    def test_complete(self):
+        request = self.table.add(DEVICE_ID, self.power_types, 10)
+        completed = self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATEPOWER, 65535))
+
+        self.assertIs(completed, request)
+        self.assertTrue(request.event.is_set())
+        self.assertEqual(request.response.payload.level, 65535)
+        self.assertEqual(len(self.table), 0)
+
+    def test_complete_wrong_type(self):
+        request = self.table.add(DEVICE_ID, self.power_types, 10)
+        self.assertIsNone(self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATESERVICE, 1, 56700)))
+        self.assertFalse(request.event.is_set())
+        self.assertEqual(len(self.table), 1)
+
+    def test_complete_ack_and_response(self):
+        types = lifx.protocol.response_types(lifx.protocol.TYPE_SETPOWER, True, True)
+        request = self.table.add(DEVICE_ID, types, 10)
+
+        self.assertIsNone(self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_ACKNOWLEDGEMENT)))
+        self.assertTrue(request.acknowledged)
+        self.assertFalse(request.event.is_set())
+
+        self.assertIs(self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATEPOWER, 65535)), request)
+        self.assertEqual(request.response.payload.level, 65535)
+        self.assertEqual(len(self.table), 0)
+
+    def test_complete_ack_only(self):
+        types = lifx.protocol.response_types(lifx.protocol.TYPE_SETPOWER, True, False)
+        request = self.table.add(DEVICE_ID, types, 10)
+
+        self.assertIs(self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_ACKNOWLEDGEMENT)), request)
+        self.assertTrue(request.acknowledged)
+
+    def test_complete_wrong_target(self):
+        request = self.table.add(DEVICE_ID, self.power_types, 10)
+        self.assertIsNone(self.table.complete(make_packet(DEVICE_ID + 1, request.sequence, lifx.protocol.TYPE_STATEPOWER, 0)))
+        self.assertFalse(request.event.is_set())
+
+    def test_remove(self):
+        request = self.table.add(DEVICE_ID, self.power_types, 10)
+        self.table.remove(request)
+        self.assertEqual(len(self.table), 0)
+        self.assertIsNone(self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATEPOWER, 0)))
+
+    def test_expired_entries_are_swept(self):
+        for i in range(0, 10):
+            self.table.add(i, self.power_types, -1)
+        self.table._next_sweep = 0
+        self.table.add(DEVICE_ID, self.power_types, 10)
+        self.assertEqual(len(self.table), 1)
+
+    def test_bounded(self):
+        table = PendingTable(max_entries=5)
+        requests = [table.add(DEVICE_ID, self.power_types, 10 + i) for i in range(0, 8)]
+        self.assertEqual(len(table), 5)
+
+        # The requests closest to expiring were evicted
+        self.assertIsNone(table.complete(make_packet(DEVICE_ID, requests[0].sequence, lifx.protocol.TYPE_STATEPOWER, 0)))
+        self.assertIs(table.complete(make_packet(DEVICE_ID, requests[7].sequence, lifx.protocol.TYPE_STATEPOWER, 0)), requests[7])
+
+    def test_evicted_outside_lock(self):
+        table = PendingTable(max_entries=1)
+        first = table.add(DEVICE_ID, self.power_types, 10)
+
+        # A callback that starts another request must not deadlock the table
+        started = []
+        first.add_done_callback(lambda request: started.append(table.add(DEVICE_ID, self.power_types, 10)))
+        thread = threading.Thread(target=table.add, args=(DEVICE_ID, self.power_types, 10))
+        thread.daemon = True
+        thread.start()
+        thread.join(2)
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(first.timed_out)
+        self.assertTrue(first.evicted)
+        self.assertEqual(len(started), 1)
+
+    def test_expired_not_evicted(self):
+        request = self.table.add(DEVICE_ID, self.power_types, -1)
+        self.table._next_sweep = 0
+        self.table.add(DEVICE_ID, self.power_types, 10)
+        self.assertTrue(request.timed_out)
+        self.assertFalse(request.evicted)
+
+class RttEstimatorTests(unittest.TestCase):
+    def test_first_sample(self):
+        rtt = RttEstimator()
+        rtt.sample(0.1)
+        self.assertEqual(rtt.srtt, 0.1)
+        self.assertEqual(rtt.rttvar, 0.05)
+        self.assertAlmostEqual(rtt.rto, 0.3)
+
+    def test_converges(self):
+        rtt = RttEstimator()
+        for i in range(0, 50):
+            rtt.sample(0.05)
+        self.assertAlmostEqual(rtt.srtt, 0.05)
+        self.assertLess(rtt.rto, 0.06)
+
+    def test_variance_raises_rto(self):
+        steady = RttEstimator()
+        jittery = RttEstimator()
+        for i in range(0, 50):
+            steady.sample(0.05)
+            jittery.sample(0.01 if i % 2 else 0.09)
+        self.assertGreater(jittery.rto, steady.rto)
+
+    def test_bounds(self):
+        rtt = RttEstimator()
+        rtt.sample(0.0001)
+        self.assertEqual(rtt.rto, MIN_RTO)
+        rtt.sample(60)
+        self.assertEqual(rtt.rto, MAX_RTO)
+
+    def test_backoff(self):
+        rtt = RttEstimator(initial_rto=0.1)
+        self.assertEqual([rtt.timeout(i) for i in range(0, 3)], [0.1, 0.2, 0.4])
+        self.assertEqual(rtt.timeout(10), MAX_RTO)
+
+class CongestionWindowTests(unittest.TestCase):
+    def request(self):
+        return PendingRequest(DEVICE_ID, 0, (), 0)
+
+    def test_admit_and_release(self):
+        window = CongestionWindow(initial=2)
+        requests = [self.request() for i in range(0, 3)]
+        self.assertEqual([window.admit(r) for r in requests], [True, True, False])
+        self.assertEqual(window.stats.queued, 1)
+
+        self.assertEqual(window.release(requests[0]), [requests[2]])
+        self.assertEqual(window.stats.in_flight, 2)
+
+    def test_interactive_first(self):
+        window = CongestionWindow(initial=1)
+        requests = [self.request() for i in range(0, 4)]
+        for r in requests[1:3]:
+            r.priority = PRIORITY_BACKGROUND
+        for r in requests:
+            window.admit(r)
+        self.assertEqual(window.stats.queued, 3)
+
+        # The interactive request jumps the background ones queued before it
+        self.assertEqual(window.release(requests[0]), [requests[3]])
+        self.assertEqual(window.release(requests[3]), [requests[1]])
+
+    def test_release_skips_finished(self):
+        window = CongestionWindow(initial=1)
+        requests = [self.request() for i in range(0, 3)]
+        for r in requests:
+            window.admit(r)
+        requests[1]._finish(timed_out=True)
+
+        self.assertEqual(window.release(requests[0]), [requests[2]])
+
+    def test_slow_start_then_additive(self):
+        window = CongestionWindow(initial=4, maximum=100)
+        for i in range(0, 4):
+            window.on_success()
+        self.assertEqual(window.stats.window, 8)
+
+        window.threshold = 8
+        for i in range(0, 8):
+            window.on_success()
+        self.assertEqual(window.stats.window, 8)
+        window.on_success()
+        self.assertEqual(window.stats.window, 9)
+
+    def test_halved_once_per_loss_burst(self):
+        window = CongestionWindow(initial=32)
+        requests = [self.request() for i in range(0, 10)]
+        for r in requests:
+            window.admit(r)
+        for r in requests:
+            window.on_loss(r)
+
+        self.assertEqual(window.stats.window, 16)
+        self.assertEqual(window.stats.threshold, 16)
+        self.assertEqual(window.stats.losses, 1)
+
+        # A request sent after the cut can cut it again
+        late = self.request()
+        window.admit(late)
+        window.on_loss(late)
+        self.assertEqual(window.stats.window, 8)
+
+    def test_minimum(self):
+        window = CongestionWindow(initial=4, minimum=3)
+        request = self.request()
+        window.admit(request)
+        window.on_loss(request)
+        self.assertEqual(window.stats.window, 3)
+
+class RetransmitterTests(unittest.TestCase):
+    def setUp(self):
+        self.table = PendingTable()
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.retransmitter = Retransmitter(self.table, self.scheduler)
+        self.power_types = lifx.protocol.response_types(lifx.protocol.TYPE_GETPOWER, False, True)
+        self.sent = []
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def send(self, sequence, on_sent):
+        self.sent.append(sequence)
+        on_sent()
+
+    def test_timeout(self):
+        retransmits = []
+        rtt = RttEstimator(initial_rto=0.01)
+        request = self.retransmitter.submit(DEVICE_ID, self.power_types, self.send, 0.5, 5, lambda: retransmits.append(1), rtt)
+
+        self.assertTrue(request.event.wait(2))
+        self.assertTrue(request.timed_out)
+        self.assertIsNone(request.response)
+        self.assertEqual(self.sent, [request.sequence] * 5)
+        self.assertEqual(len(retransmits), 4)
+        self.assertEqual(len(self.table), 0)
+
+    def test_answered(self):
+        request = self.retransmitter.submit(DEVICE_ID, self.power_types, self.send, 10, 5)
+        self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATEPOWER, 1))
+
+        self.assertTrue(request.event.is_set())
+        self.assertEqual(request.response.payload.level, 1)
+        self.assertEqual(self.sent, [request.sequence])
+        self.assertTrue(request._timer.cancelled)
+
+    def test_answered_samples_rtt(self):
+        rtt = RttEstimator()
+        request = self.retransmitter.submit(DEVICE_ID, self.power_types, self.send, 10, 5, rtt=rtt)
+        self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATEPOWER, 1))
+
+        self.assertIsNotNone(rtt.srtt)
+        self.assertEqual(rtt.rto, MIN_RTO)
+
+    def test_retransmitted_not_sampled(self):
+        rtt = RttEstimator(initial_rto=0.01)
+        request = self.retransmitter.submit(DEVICE_ID, self.power_types, self.send, 10, 5, rtt=rtt)
+        while len(self.sent) < 2:
+            request.event.wait(0.01)
+        self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATEPOWER, 1))
+
+        self.assertIsNone(rtt.srtt)
+
+    def test_send_error(self):
+        def send(sequence, on_sent):
+            raise IOError('Network is unreachable')
+
+        request = self.retransmitter.submit(DEVICE_ID, self.power_types, send, 10, 5)
+        self.assertIsInstance(request.error, IOError)
+        self.assertEqual(len(self.table), 0)
+
+    def test_send_error_from_queue(self):
+        request = self.retransmitter.submit(DEVICE_ID, self.power_types, lambda sequence, on_sent: on_sent(IOError('Network is unreachable')), 10, 5)
+        self.assertIsInstance(request.error, IOError)
+        self.assertEqual(len(self.table), 0)
+
+    def test_timer_starts_when_sent(self):
+        queued = []
+        rtt = RttEstimator(initial_rto=0.01)
+        request = self.retransmitter.submit(DEVICE_ID, self.power_types, lambda sequence, on_sent: queued.append(on_sent), 10, 5, rtt=rtt)
+
+        # Waiting in the send queue is not a reason to resend
+        time.sleep(0.05)
+        self.assertEqual(len(queued), 1)
+        self.assertIsNone(request.sent_at)
+
+        queued[0]()
+        self.assertIsNotNone(request.sent_at)
+        deadline = time.time() + 1
+        while len(queued) < 2 and time.time() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(len(queued), 2)
+        self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATEPOWER, 1))
+
+    def test_timeout_while_queued_not_loss(self):
+        window = CongestionWindow(initial=4)
+        retransmitter = Retransmitter(self.table, self.scheduler, window)
+        request = retransmitter.submit(DEVICE_ID, self.power_types, lambda sequence, on_sent: None, 0.05, 5)
+
+        self.assertTrue(request.event.wait(1))
+        self.assertTrue(request.timed_out)
+        self.assertEqual(window.stats.losses, 0)
+        self.assertEqual(window.stats.window, 4)
+
+    def test_window_queues(self):
+        window = CongestionWindow(initial=2)
+        retransmitter = Retransmitter(self.table, self.scheduler, window)
+        requests = [retransmitter.submit(DEVICE_ID, self.power_types, self.send, 10, 5) for i in range(0, 3)]
+        self.assertEqual(len(self.sent), 2)
+
+        # Answering one lets the next go
+        self.table.complete(make_packet(DEVICE_ID, requests[0].sequence, lifx.protocol.TYPE_STATEPOWER, 1))
+        deadline = time.time() + 1
+        while len(self.sent) < 3 and time.time() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(self.sent, [r.sequence for r in requests])
+        self.assertEqual(window.stats.in_flight, 2)
+        self.assertEqual(window.stats.window, 3)
+
+    def test_window_queued_timeout(self):
+        window = CongestionWindow(initial=1)
+        retransmitter = Retransmitter(self.table, self.scheduler, window)
+        retransmitter.submit(DEVICE_ID, self.power_types, self.send, 10, 5)
+        queued = retransmitter.submit(DEVICE_ID, self.power_types, self.send, 0.05, 5)
+
+        self.assertTrue(queued.event.wait(1))
+        self.assertTrue(queued.timed_out)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(window.stats.losses, 0)
+
+    def test_retransmit_shrinks_window(self):
+        window = CongestionWindow(initial=8)
+        retransmitter = Retransmitter(self.table, self.scheduler, window)
+        rtt = RttEstimator(initial_rto=0.01)
+        request = retransmitter.submit(DEVICE_ID, self.power_types, self.send, 10, 5, rtt=rtt)
+        while len(self.sent) < 2:
+            time.sleep(0.005)
+
+        self.assertEqual(window.stats.window, 4)
+        self.table.complete(make_packet(DEVICE_ID, request.sequence, lifx.protocol.TYPE_STATEPOWER, 1))
+
+    def test_many_outstanding(self):
+        # Room for all of them, so none are evicted early
+        retransmitter = Retransmitter(PendingTable(max_entries=5000), self.scheduler)
+
+        threads = threading.active_count()
+        rtt = RttEstimator(initial_rto=0.05)
+        requests = [retransmitter.submit(i, self.power_types, self.send, 1, 2, rtt=rtt) for i in range(0, 5000)]
+
+        self.assertLessEqual(threading.active_count(), threads)
+        for request in requests:
+            self.assertTrue(request.event.wait(5))
+            self.assertTrue(request.timed_out)
+        self.assertEqual(len(self.sent), 10000)
@@ -1,7 +1,12 @@
+import threading
 import unittest
 import time
 
-from lifx.util import RepeatTimer
+from concurrent.futures import Future
+
+from lifx.util import LatestWriter, RepeatTimer, Scheduler, SendQueue, TokenBucket
+from lifx.util import chain_future, compose_future, failed_future, resolved_future
+from lifx.util import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
 
 class UtilTests(unittest.TestCase):
     def test_timer(self):
@@ -18,3 +23,240 @@ class UtilTests(unittest.TestCase):
 
         self.assertGreaterEqual(trigger.counter, 6)
 
+
+class SchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.calls = []
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_call_order(self):
+        done = threading.Event()
+        self.scheduler.call_later(0.03, done.set)
+        self.scheduler.call_later(0.02, self.calls.append, 2)
+        self.scheduler.call_later(0.01, self.calls.append, 1)
+
+        self.assertTrue(done.wait(1))
+        self.assertEqual(self.calls, [1, 2])
+
+    def test_cancel(self):
+        done = threading.Event()
+        call = self.scheduler.call_later(0.01, self.calls.append, 1)
+        self.scheduler.call_later(0.02, done.set)
+        call.cancel()
+
+        self.assertTrue(done.wait(1))
+        self.assertEqual(self.calls, [])
+
+    def test_failing_call(self):
+        done = threading.Event()
+        self.scheduler.call_later(0, lambda: 1 / 0)
+        self.scheduler.call_later(0.01, done.set)
+        self.assertTrue(done.wait(1))
+
+    def test_stop(self):
+        self.scheduler.call_later(0.05, self.calls.append, 1)
+        self.scheduler.stop()
+        self.scheduler.join(1)
+
+        self.assertFalse(self.scheduler.is_alive())
+        self.assertEqual(self.calls, [])
+
+    def test_stop_waits_for_running_call(self):
+        started = threading.Event()
+        def slow():
+            started.set()
+            time.sleep(0.05)
+            self.calls.append(1)
+
+        self.scheduler.call_later(0, slow)
+        self.assertTrue(started.wait(1))
+        self.scheduler.stop()
+
+        self.assertFalse(self.scheduler.is_alive())
+        self.assertEqual(self.calls, [1])
+
+    def test_call_every(self):
+        call = self.scheduler.call_every(0.005, self.calls.append, 1)
+        time.sleep(0.05)
+        call.cancel()
+        count = len(self.calls)
+        time.sleep(0.02)
+
+        self.assertGreaterEqual(count, 4)
+        self.assertLessEqual(len(self.calls), count + 1)
+
+    def test_jitter(self):
+        times = []
+        call = self.scheduler.call_every(0.01, lambda: times.append(time.time()), jitter=0.01)
+        deadline = time.time() + 2
+        while len(times) < 5 and time.time() < deadline:
+            time.sleep(0.005)
+        call.cancel()
+
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        self.assertTrue(all(0.01 <= gap < 0.05 for gap in gaps))
+
+    def test_stats(self):
+        def failing():
+            1 / 0
+
+        done = threading.Event()
+        self.scheduler.call_later(0, time.sleep, 0.01)
+        self.scheduler.call_later(0, failing)
+        self.scheduler.call_later(0.01, done.set)
+        self.assertTrue(done.wait(1))
+
+        stats = self.scheduler.stats
+        self.assertEqual(stats['sleep'].runs, 1)
+        self.assertGreaterEqual(stats['sleep'].max_time, 0.01)
+        self.assertEqual(stats['failing'].failures, 1)
+
+class LatestWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.writes = []
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def wait_for(self, count):
+        deadline = time.time() + 2
+        while len(self.writes) < count and time.time() < deadline:
+            time.sleep(0.005)
+
+    def test_latest_wins(self):
+        writer = LatestWriter(self.scheduler, 0.05)
+        for i in range(0, 10):
+            writer.write('color', self.writes.append, i)
+        writer.write('power', self.writes.append, 'on')
+        self.wait_for(3)
+
+        # The first goes straight out, then only the newest of each key
+        self.assertEqual(self.writes, [0, 9, 'on'])
+        self.assertEqual(writer.superseded, 8)
+        self.assertEqual(writer.sent, 3)
+        self.assertEqual(len(writer), 0)
+
+    def test_rate(self):
+        writer = LatestWriter(self.scheduler, 0.05)
+        sent_at = []
+        for i in range(0, 3):
+            writer.write(i, lambda: sent_at.append(time.time()))
+            self.writes.append(i)
+        while len(sent_at) < 3:
+            time.sleep(0.005)
+
+        self.assertGreaterEqual(sent_at[2] - sent_at[0], 0.09)
+
+class TokenBucketTests(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(10, 3)
+        now = time.time()
+        self.assertEqual([bucket.consume(now) for i in range(0, 4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.delay(now), 0.1, places=3)
+        self.assertTrue(bucket.consume(now + 0.11))
+        self.assertFalse(bucket.consume(now + 0.11))
+
+    def test_burst_is_capped(self):
+        bucket = TokenBucket(10, 2)
+        now = time.time()
+        self.assertEqual([bucket.consume(now + 60) for i in range(0, 3)], [True, True, False])
+
+class SendQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.sent = []
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_priority(self):
+        queue = SendQueue(self.scheduler, TokenBucket(100, 1))
+        queue.submit(PRIORITY_BACKGROUND, self.sent.append, 'first')
+        for i in range(0, 3):
+            queue.submit(PRIORITY_BACKGROUND, self.sent.append, 'poll')
+        queue.submit(PRIORITY_INTERACTIVE, self.sent.append, 'set')
+        self.assertEqual(queue.depth, (1, 3))
+
+        deadline = time.time() + 2
+        while len(self.sent) < 5 and time.time() < deadline:
+            time.sleep(0.005)
+
+        self.assertEqual(self.sent, ['first', 'set', 'poll', 'poll', 'poll'])
+        self.assertEqual(queue.depth, (0, 0))
+        self.assertGreater(queue.max_wait, 0)
+        self.assertGreater(queue.mean_wait, 0)
+
+    def test_on_sent_and_replace(self):
+        queue = SendQueue(self.scheduler, TokenBucket(100, 1))
+        sent_at = []
+        queue.submit(PRIORITY_INTERACTIVE, self.sent.append, 'first', on_sent=lambda error: sent_at.append(error))
+        queue.submit(PRIORITY_INTERACTIVE, self.sent.append, 'old', key=1, on_sent=lambda error: sent_at.append('old'))
+        queue.submit(PRIORITY_INTERACTIVE, self.sent.append, 'other', key=2)
+        queue.submit(PRIORITY_INTERACTIVE, self.sent.append, 'new', key=1, on_sent=lambda error: sent_at.append(error))
+        self.assertEqual(queue.depth, (2, 0))
+
+        deadline = time.time() + 2
+        while len(self.sent) < 3 and time.time() < deadline:
+            time.sleep(0.005)
+
+        # The newer copy went out in the place of the old one
+        self.assertEqual(self.sent, ['first', 'new', 'other'])
+        self.assertEqual(sent_at, [None, None])
+        self.assertEqual(queue.replaced, 1)
+
+    def test_on_sent_error(self):
+        def fail():
+            raise IOError('Network is unreachable')
+
+        errors = []
+        queue = SendQueue(self.scheduler, None)
+        queue.submit(PRIORITY_INTERACTIVE, fail, on_sent=errors.append)
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], IOError)
+
+    def test_unlimited(self):
+        queue = SendQueue(self.scheduler, None)
+        for i in range(0, 100):
+            queue.submit(PRIORITY_BACKGROUND, self.sent.append, i)
+        self.assertEqual(len(self.sent), 100)
+        self.assertEqual(queue.mean_wait, 0)
+
+class FutureTests(unittest.TestCase):
+    def test_chain(self):
+        future = Future()
+        chained = chain_future(future, lambda x: x * 2)
+        self.assertFalse(chained.done())
+        future.set_result(21)
+        self.assertEqual(chained.result(0), 42)
+
+    def test_chain_exception(self):
+        future = Future()
+        chained = chain_future(future, lambda x: x * 2)
+        future.set_exception(IOError())
+        self.assertIsInstance(chained.exception(0), IOError)
+
+        chained = chain_future(resolved_future(None), lambda x: x * 2)
+        self.assertIsInstance(chained.exception(0), TypeError)
+
+    def test_compose(self):
+        future = Future()
+        second = Future()
+        composed = compose_future(future, lambda x: second)
+        future.set_result(1)
+        self.assertFalse(composed.done())
+        second.set_result(2)
+        self.assertEqual(composed.result(0), 2)
+
+    def test_compose_exception(self):
+        composed = compose_future(failed_future(IOError()), resolved_future)
+        self.assertIsInstance(composed.exception(0), IOError)
+
+        composed = compose_future(resolved_future(1), lambda x: failed_future(ValueError()))
+        self.assertIsInstance(composed.exception(0), ValueError)